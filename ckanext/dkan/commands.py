@@ -0,0 +1,135 @@
+import sys
+
+from ckan.lib.cli import CkanCommand
+
+
+class DKANHarvesterCommand(CkanCommand):
+    '''DKAN harvester commands
+
+    Usage:
+
+      dkan-harvester import-batch {job-id} [--chunk-size=N]
+        - Imports the gathered harvest objects of a DKAN harvest job in
+          chunks of N objects (default: 100), each of them in a single
+          transaction and with a single search index commit. The job's
+          source should have "batch_import" set in its configuration and
+          be gathered with "gather-all", which then does not queue the
+          objects to be fetched. The fetch consumer skips the objects
+          that were already imported, but it marks them as errored if
+          the job has been finished in the meantime.
+
+      dkan-harvester gather-all [--workers=N] [--max-in-flight=N]
+        - Gathers the new jobs of all the active DKAN harvest sources at
+          once, from N processes (default: 8), and queues their harvest
+          objects to be fetched. The sources that change the most and take
+          the longest go first, each remote host gets a fair share of the
+          processes and no more than --max-in-flight requests (default: 64)
+          are made at the same time. The objects of the sources with
+          "batch_import" set are not queued, see "import-batch". Run it
+          after "harvester job-all" and before "harvester run", which would
+          otherwise send the jobs to the gather consumer.
+
+    The commands should be run from the ckanext-dkan directory and expect
+    a development.ini file to be present. Most of the time you will
+    specify the config explicitly though::
+
+        paster dkan-harvester import-batch {job-id} --config=../ckan/development.ini
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 2
+    min_args = 1
+
+    def __init__(self, name):
+        super(DKANHarvesterCommand, self).__init__(name)
+        self.parser.add_option('--chunk-size', dest='chunk_size', type='int',
+                               default=100,
+                               help='Harvest objects imported per transaction')
+        self.parser.add_option('--workers', dest='workers', type='int',
+                               default=8,
+                               help='Harvest jobs gathered at the same time')
+        self.parser.add_option('--max-in-flight', dest='max_in_flight',
+                               type='int', default=64,
+                               help='Requests made at the same time to all '
+                                    'the remote hosts')
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'import-batch':
+            if len(self.args) < 2:
+                print 'Please provide a harvest job id'
+                sys.exit(1)
+            self.import_batch(self.args[1])
+        elif cmd == 'gather-all':
+            self.gather_all()
+        else:
+            print 'Command %s not recognized' % cmd
+
+    def import_batch(self, job_id):
+        from ckan import model
+        from ckanext.harvest.model import HarvestJob, HarvestObject
+        from ckanext.dkan.harvesters.dkanharvester import DKANHarvester
+
+        if self.options.chunk_size < 1:
+            print '--chunk-size must be a positive integer'
+            sys.exit(1)
+        job = HarvestJob.get(job_id)
+        if not job:
+            print 'Harvest job %s not found' % job_id
+            sys.exit(1)
+        harvester = DKANHarvester()
+        if job.source.type != harvester.info()['name']:
+            print 'Harvest job %s is not from a DKAN harvest source' % job_id
+            sys.exit(1)
+
+        object_ids = [row[0] for row in
+                      model.Session.query(HarvestObject.id)
+                      .filter(HarvestObject.harvest_job_id == job.id)
+                      .filter(HarvestObject.state == 'WAITING')
+                      .order_by(HarvestObject.gathered)]
+        chunk_size = self.options.chunk_size
+        imported = 0
+        for start in range(0, len(object_ids), chunk_size):
+            chunk = model.Session.query(HarvestObject) \
+                .filter(HarvestObject.id.in_(
+                    object_ids[start:start + chunk_size])) \
+                .all()
+            imported += harvester.import_stage_batch(chunk)
+            print 'Imported %d of %d harvest objects (%d with errors)' % (
+                min(start + chunk_size, len(object_ids)), len(object_ids),
+                start + len(chunk) - imported)
+            # Keep the session small between chunks
+            model.Session.remove()
+
+    def gather_all(self):
+        import multiprocessing
+
+        from ckan import model
+        from ckanext.dkan.harvesters import runner
+
+        if self.options.workers < 1 or self.options.max_in_flight < 1:
+            print '--workers and --max-in-flight must be positive integers'
+            sys.exit(1)
+        tasks = runner.get_gather_tasks('dkan')
+        if not tasks:
+            print 'There are no new DKAN harvest jobs'
+            return
+        runner.start_jobs(tasks)
+        # The processes must not share the database connections of this one
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        results = runner.run_gathers(
+            tasks, runner.gather_job, workers=self.options.workers,
+            initializer=runner.init_worker,
+            initargs=(multiprocessing.BoundedSemaphore(
+                self.options.max_in_flight),))
+        failed = [job_id for job_id, result in results.items()
+                  if result is None]
+        print 'Gathered %d harvest jobs, %d harvest objects queued' % (
+            len(results), sum(result or 0 for result in results.values()))
+        if failed:
+            print 'Failed harvest jobs: %s' % ', '.join(failed)
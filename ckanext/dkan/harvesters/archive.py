@@ -0,0 +1,135 @@
+import base64
+import collections
+import fcntl
+import json
+import threading
+import time
+import zlib
+
+log = __import__('logging').getLogger(__name__)
+
+MODES = ('record', 'replay')
+
+RecordedResponse = collections.namedtuple(
+    'RecordedResponse', ['url', 'elapsed', 'body', 'error'])
+
+
+class ResponseArchive(object):
+    '''Archive of the responses of a remote portal, to harvest it again
+    without requesting anything.
+
+    In "record" mode every request made is appended to the archive, with
+    its body, or the error it failed with, and how long it took. In
+    "replay" mode the requests are answered from the archive instead. If
+    ``latency`` is set each answer takes as long as the recorded request
+    did, otherwise they are given straight away.
+
+    The archive at ``path`` is a gzip file with one JSON line per request,
+    each compressed as a separate gzip member so that it can be read on its
+    own. ``path`` + ".index" has a JSON line per request with the URL and
+    where its member starts and ends. Recording appends to the archive, and
+    several processes can record to the same one; a URL requested more than
+    once is replayed in the same order, and its last response is given once
+    they run out.
+    '''
+
+    def __init__(self, path, mode, latency=False):
+        if mode not in MODES:
+            raise ValueError('Unknown archive mode: %s' % mode)
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self._lock = threading.Lock()
+        if self.replaying:
+            self._file = open(path, 'rb')
+            self._index = self._read_index()
+            self._replayed = collections.Counter()
+        else:
+            self._file = open(path, 'ab')
+            self._index_file = open(self.index_path, 'ab')
+
+    @property
+    def index_path(self):
+        return self.path + '.index'
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def _read_index(self):
+        index = collections.defaultdict(list)
+        with open(self.index_path, 'rb') as index_file:
+            for line in index_file:
+                entry = json.loads(line)
+                index[entry['url']].append((entry['offset'], entry['size']))
+        log.debug('Replaying %d requests to %d URLs from %s',
+                  sum(len(entries) for entries in index.values()),
+                  len(index), self.path)
+        return dict(index)
+
+    def record(self, url, elapsed, body=None, error=None):
+        '''Appends the response to a request for ``url``.
+
+        ``body`` is the response body, or ``error`` a dict describing why
+        the request failed.
+        '''
+        entry = {'url': url, 'recorded': time.time(), 'elapsed': elapsed,
+                 'error': error}
+        if body is not None:
+            try:
+                entry['body'] = body.decode('utf-8')
+            except UnicodeDecodeError:
+                entry['body_base64'] = base64.b64encode(body)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        member = compressor.compress(json.dumps(entry) + '\n') + \
+            compressor.flush()
+
+        with self._lock:
+            # Other processes may be recording to the same archive
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                self._file.seek(0, 2)
+                offset = self._file.tell()
+                self._file.write(member)
+                self._file.flush()
+                self._index_file.write(json.dumps(
+                    {'url': url, 'offset': offset, 'size': len(member)}) +
+                    '\n')
+                self._index_file.flush()
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def replay(self, url):
+        '''Returns the next RecordedResponse for ``url``, or None if it was
+        never requested.'''
+        entries = self._index.get(url)
+        if not entries:
+            return None
+        with self._lock:
+            offset, size = entries[min(self._replayed[url],
+                                       len(entries) - 1)]
+            self._replayed[url] += 1
+            self._file.seek(offset)
+            member = self._file.read(size)
+        entry = json.loads(zlib.decompress(member, 16 + zlib.MAX_WBITS))
+        if 'body_base64' in entry:
+            body = base64.b64decode(entry['body_base64'])
+        elif entry.get('body') is not None:
+            body = entry['body'].encode('utf-8')
+        else:
+            body = None
+        return RecordedResponse(url, entry['elapsed'], body, entry['error'])
+
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+def get_response_archive(path, mode, latency=False):
+    '''Returns the ResponseArchive for ``path``, opening it if needed.'''
+    with _archives_lock:
+        archive = _archives.get((path, mode))
+        if archive is None:
+            archive = _archives[(path, mode)] = ResponseArchive(path, mode)
+        archive.latency = latency
+        return archive
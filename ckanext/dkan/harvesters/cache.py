@@ -0,0 +1,89 @@
+import collections
+import threading
+import time
+
+_UNKNOWN = object()
+
+
+class LookupCache(object):
+    '''Least recently used cache for lookups made while importing a job.
+
+    Besides values it can remember that something was not found, so that a
+    missing group or organization is not looked up again for every dataset
+    that references it. Entries are evicted once there are more than
+    ``max_size`` of them or when they are older than ``ttl`` seconds (if
+    given).
+    '''
+
+    # Value returned by ``get`` for keys stored with ``set_missing``
+    MISSING = object()
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._key_locks = {}
+
+    def get(self, key, default=None):
+        '''Returns the cached value for ``key``, or ``default``.'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or (self.ttl is not None and
+                                 time.time() - entry[0] > self.ttl):
+                self.misses += 1
+                return default
+            # Re-insert it to mark it as the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def set_missing(self, key):
+        self.set(key, self.MISSING)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._key_locks.clear()
+
+    def lock_for(self, key):
+        '''Returns a lock to serialize the creation of the object for a key.'''
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get_or_load(self, key, loader, not_found=None):
+        '''Returns the cached value for ``key``, calling ``loader`` if needed.
+
+        If ``loader`` raises the ``not_found`` exception class, the key is
+        remembered as missing and the exception re-raised, now and on the
+        following calls, until the entry is evicted or replaced.
+        '''
+        value = self.get(key, _UNKNOWN)
+        if value is self.MISSING:
+            raise not_found('Not found: %s (cached)' % (key,))
+        if value is not _UNKNOWN:
+            return value
+
+        if not_found is None:
+            value = loader()
+        else:
+            try:
+                value = loader()
+            except not_found:
+                self.set_missing(key)
+                raise
+        self.set(key, value)
+        return value
@@ -0,0 +1,239 @@
+import httplib
+import socket
+import threading
+import urllib
+import urlparse
+import zlib
+
+log = __import__('logging').getLogger(__name__)
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class HTTPClient(object):
+    '''Small HTTP client that keeps persistent connections per remote host.
+
+    Connections are returned to a per-host idle pool once a response has
+    been read completely, so paging through a remote portal or looking up
+    its groups and organizations reuses the same TCP/TLS connections.
+    Responses are requested gzip compressed and decompressed transparently.
+
+    The client is safe to share between threads: each request checks a
+    connection out of the pool and only gives it back when done with it.
+    '''
+
+    def __init__(self, timeout=90, max_idle=10, max_redirects=5):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_redirects = max_redirects
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def open(self, url, headers=None):
+        '''Requests ``url`` and returns a ``StreamingResponse``.
+
+        Redirects are followed. Responses with error status codes are
+        returned like any other response, it is up to the caller to decide
+        what to do with them. Network and protocol errors are raised as
+        ``socket.error`` and ``httplib.HTTPException``.
+
+        The body is not read yet. The connection goes back to the pool once
+        the body has been read completely; the response must be closed if it
+        is not.
+        '''
+        for i in range(self.max_redirects + 1):
+            response = self._open(url, headers)
+            location = response.getheader('location')
+            if response.status not in REDIRECT_CODES or not location:
+                return response
+            response.read()
+            url = urlparse.urljoin(url, location)
+            log.debug('Following redirect to %s', url)
+        raise httplib.HTTPException('Too many redirects: %s' % url)
+
+    def close(self):
+        '''Closes all the idle connections.'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _open(self, url, headers):
+        key, path, host_header = self._parse_url(url)
+        request_headers = {
+            'Host': host_header,
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+        }
+        request_headers.update(headers or {})
+
+        connection, reused = self._get_connection(key)
+        try:
+            response = self._send(connection, path, request_headers)
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+            # The remote end most probably closed the idle connection, give
+            # it another go with a new one
+            log.debug('Stale connection to %s, reconnecting', key[1])
+            connection, reused = self._new_connection(key), False
+            try:
+                response = self._send(connection, path, request_headers)
+            except Exception:
+                connection.close()
+                raise
+        except Exception:
+            connection.close()
+            raise
+
+        return StreamingResponse(self, key, connection, url, response)
+
+    def _send(self, connection, path, headers):
+        connection.request('GET', path, headers=headers)
+        return connection.getresponse()
+
+    def _parse_url(self, url):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise ValueError('Unsupported URL scheme: %s' % url)
+        if not parts.hostname:
+            raise ValueError('No host in URL: %s' % url)
+        port = parts.port or (443 if scheme == 'https' else 80)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        host_header = parts.netloc.rsplit('@', 1)[-1]
+
+        proxy = None
+        if not urllib.proxy_bypass(parts.hostname):
+            proxy = urllib.getproxies().get(scheme)
+        if proxy and scheme == 'http':
+            # Plain HTTP proxies get the full URL in the request line
+            path = urlparse.urlunsplit(
+                (scheme, host_header, parts.path or '/', parts.query, ''))
+
+        return (scheme, parts.hostname, port, proxy), path, host_header
+
+    def _get_connection(self, key):
+        with self._lock:
+            connections = self._idle.get(key)
+            if connections:
+                return connections.pop(), True
+        return self._new_connection(key), False
+
+    def _new_connection(self, key):
+        scheme, host, port, proxy = key
+        connection_class = httplib.HTTPSConnection if scheme == 'https' \
+            else httplib.HTTPConnection
+        if not proxy:
+            return connection_class(host, port, timeout=self.timeout)
+
+        proxy_parts = urlparse.urlsplit(
+            proxy if '://' in proxy else 'http://' + proxy)
+        proxy_port = proxy_parts.port or 80
+        if scheme == 'https':
+            connection = connection_class(proxy_parts.hostname, proxy_port,
+                                          timeout=self.timeout)
+            connection.set_tunnel(host, port)
+            return connection
+        return httplib.HTTPConnection(proxy_parts.hostname, proxy_port,
+                                      timeout=self.timeout)
+
+    def _release_connection(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+
+class StreamingResponse(object):
+    '''A response whose body is read from the connection on demand.'''
+
+    def __init__(self, client, key, connection, url, response):
+        self.url = url
+        self.status = response.status
+        self.headers = dict((name.lower(), value)
+                            for name, value in response.getheaders())
+        self._client = client
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def iter_content(self, chunk_size=65536):
+        '''Yields the decompressed body in chunks.'''
+        decompressor = _get_decompressor(self.getheader('content-encoding'))
+        try:
+            while True:
+                chunk = self._response.read(chunk_size)
+                if not chunk:
+                    break
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                if chunk:
+                    yield chunk
+            if decompressor:
+                chunk = decompressor.flush()
+                if chunk:
+                    yield chunk
+        except Exception:
+            self.close()
+            raise
+        self._release()
+
+    def read(self):
+        return ''.join(self.iter_content())
+
+    def close(self):
+        '''Closes the connection, unless the body was read completely.'''
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _release(self):
+        if self._connection is None:
+            return
+        if self._response.will_close:
+            self._connection.close()
+        else:
+            self._client._release_connection(self._key, self._connection)
+        self._connection = None
+
+
+class _DeflateDecompressor(object):
+    '''Decompresses deflate bodies, with or without the zlib header.'''
+
+    def __init__(self):
+        self._decompressor = None
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj()
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                # Some servers send raw deflate streams without the header
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return self._decompressor.flush() if self._decompressor else ''
+
+
+def _get_decompressor(content_encoding):
+    content_encoding = (content_encoding or '').strip().lower()
+    if content_encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if content_encoding == 'deflate':
+        return _DeflateDecompressor()
+    return None
+
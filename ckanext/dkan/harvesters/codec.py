@@ -0,0 +1,41 @@
+import base64
+import json
+import zlib
+
+# Marks content compressed with zlib and then base64 encoded, as the content
+# column of the harvest objects is text. The version allows changing the
+# encoding later on without breaking the objects already stored.
+COMPRESSED_PREFIX = 'dkan:z1:'
+
+# Content shorter than this is not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+
+def encode_content(package_dict, compress=False):
+    '''Serializes a package dict for the content of a harvest object.
+
+    The JSON has no extra whitespace. With ``compress`` it is also zlib
+    compressed, unless it is too small for that to save anything.
+    '''
+    content = json.dumps(package_dict, separators=(',', ':'))
+    if compress and len(content) >= MIN_COMPRESS_SIZE:
+        encoded = COMPRESSED_PREFIX + base64.b64encode(
+            zlib.compress(content, 6))
+        if len(encoded) < len(content):
+            return encoded
+    return content
+
+
+def decode_content(content):
+    '''Returns the package dict in the content of a harvest object.
+
+    Both plain JSON and content compressed by ``encode_content`` are
+    accepted. Raises ValueError if the content can not be decoded.
+    '''
+    if content.startswith(COMPRESSED_PREFIX):
+        try:
+            content = zlib.decompress(base64.b64decode(
+                content[len(COMPRESSED_PREFIX):]))
+        except (TypeError, zlib.error), e:
+            raise ValueError('Invalid compressed content: %s' % e)
+    return json.loads(content)
@@ -0,0 +1,83 @@
+import collections
+import hashlib
+import json
+
+from ckanext.dkan.harvesters.cache import LookupCache
+
+log = __import__('logging').getLogger(__name__)
+
+
+class HarvestConfig(collections.namedtuple('HarvestConfig', [
+        'settings',
+        'default_tags',
+        'default_tag_names',
+        'default_group_dicts',
+        'default_group_ids',
+        'default_extras',
+        'override_extras',
+        'remote_groups',
+        'remote_orgs',
+        'api_version',
+        'digest'])):
+    '''Harvest source configuration, parsed and prepared once.
+
+    ``settings`` is the parsed configuration dict, which must not be
+    modified as it is shared by every object harvested with it. The rest
+    are the settings used for each dataset during the import, in a form that
+    is ready to use: tuples, sets for the membership checks and the default
+    extras as (key, value, is_template) tuples. ``digest`` is a hash of the
+    configuration string.
+    '''
+
+    @classmethod
+    def from_dict(cls, settings, digest=None):
+        default_tags = tuple(settings.get('default_tags') or ())
+        default_group_dicts = tuple(settings.get('default_group_dicts') or ())
+        default_extras = tuple(
+            (key, value, isinstance(value, basestring) and
+             ('{' in value or '}' in value))
+            for key, value in (settings.get('default_extras') or {}).items())
+        api_version = settings.get('api_version')
+        return cls(
+            settings=settings,
+            default_tags=default_tags,
+            default_tag_names=frozenset(tag.get('name')
+                                        for tag in default_tags),
+            default_group_dicts=default_group_dicts,
+            default_group_ids=frozenset(group['id']
+                                        for group in default_group_dicts),
+            default_extras=default_extras,
+            override_extras=bool(settings.get('override_extras', False)),
+            remote_groups=settings.get('remote_groups'),
+            remote_orgs=settings.get('remote_orgs'),
+            api_version=int(api_version) if api_version is not None
+            else None,
+            digest=digest)
+
+
+_config_cache = LookupCache(max_size=100)
+
+
+def get_harvest_config(config_str, source_id=None):
+    '''Returns the HarvestConfig for a harvest source configuration string.
+
+    Parsed configurations are cached by source id and a hash of their
+    content, so the JSON (which includes the default group dicts) is only
+    parsed again when the source configuration changes.
+    '''
+    if not config_str:
+        return HarvestConfig.from_dict({})
+
+    if isinstance(config_str, unicode):
+        digest = hashlib.sha1(config_str.encode('utf-8')).hexdigest()
+    else:
+        digest = hashlib.sha1(config_str).hexdigest()
+    key = (source_id, digest)
+
+    harvest_config = _config_cache.get(key)
+    if harvest_config is None:
+        harvest_config = HarvestConfig.from_dict(json.loads(config_str),
+                                                 digest)
+        log.debug('Using config: %r', harvest_config.settings)
+        _config_cache.set(key, harvest_config)
+    return harvest_config
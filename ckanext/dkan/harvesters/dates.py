@@ -0,0 +1,108 @@
+import calendar
+import datetime
+import re
+
+CKAN_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# 2016-10-01T12:00:00 or 2016-10-01T12:00:00.123456
+ISO_DATE_RE = re.compile(
+    r'(\d{4})-(\d{1,2})-(\d{1,2})T(\d{1,2}):(\d{1,2}):(\d{1,2})'
+    r'(?:\.\d{1,6})?\Z')
+# 10/01/2016 - 12:00:00, once the "Sat, " prefix has been cut off
+DKAN_DATE_RE = re.compile(
+    r'(\d{1,2})/(\d{1,2})/(\d{4})\s+-\s+(\d{1,2}):(\d{1,2}):(\d{1,2})\Z')
+
+
+def _is_valid_date(year, month, day, hour, minute, second):
+    # The same checks strptime and datetime do, without raising. Years
+    # before 1900 are left to the slow path, as strftime rejects them.
+    return (1900 <= year and 1 <= month <= 12 and
+            1 <= day <= calendar.monthrange(year, month)[1] and
+            hour < 24 and minute < 60 and second < 60)
+
+
+def _strip_dkan_prefix(date, last_modified):
+    if last_modified:
+        date = date.replace('Date changed\t', '')
+    return date[4:].lstrip()
+
+
+def convert_date_slow(date, last_modified=False):
+    '''Converts a date by trying each known format with strptime.
+
+    Raises ValueError (or TypeError) if the date is not in any of them.
+    '''
+    for date_format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            datetime.datetime.strptime(date, date_format)
+            return date
+        except ValueError:
+            pass
+
+    date_object = datetime.datetime.strptime(
+        _strip_dkan_prefix(date, last_modified), '%m/%d/%Y - %H:%M:%S')
+    return date_object.strftime(CKAN_DATE_FORMAT)
+
+
+def convert_date_fast(date, last_modified=False):
+    '''Converts a date in one of the usual shapes with a single regex match.
+
+    ISO dates are returned as they are and DKAN dates like
+    "Sat, 10/01/2016 - 12:00:00" are returned in the CKAN format. Returns
+    None if the date does not have one of these shapes, so the caller can
+    fall back to ``convert_date_slow``.
+    '''
+    if not isinstance(date, basestring):
+        return None
+
+    match = ISO_DATE_RE.match(date)
+    if match:
+        if _is_valid_date(*[int(part) for part in match.groups()]):
+            return date
+        return None
+
+    match = DKAN_DATE_RE.match(_strip_dkan_prefix(date, last_modified))
+    if match:
+        month, day, year, hour, minute, second = \
+            [int(part) for part in match.groups()]
+        if _is_valid_date(year, month, day, hour, minute, second):
+            return '%04d-%02d-%02dT%02d:%02d:%02d.000000' % (
+                year, month, day, hour, minute, second)
+    return None
+
+
+class DateConverter(object):
+    '''Converts remote dates to the CKAN format, remembering the results.
+
+    Datasets and their resources tend to repeat the same timestamps, so the
+    last ``max_cache_size`` conversions are kept (dates that could not be
+    converted too). The cache is simply emptied when it gets full.
+    ``fallbacks`` counts the dates that needed the slow strptime path.
+    '''
+
+    def __init__(self, max_cache_size=10000):
+        self.max_cache_size = max_cache_size
+        self.fallbacks = 0
+        self._cache = {}
+
+    def convert(self, date, last_modified=False):
+        key = (date, last_modified)
+        converted = self._cache.get(key)
+        if converted is None:
+            if key in self._cache:
+                raise ValueError('Unknown date format: %r' % date)
+            converted = convert_date_fast(date, last_modified)
+            if converted is None:
+                self.fallbacks += 1
+                try:
+                    converted = convert_date_slow(date, last_modified)
+                except ValueError:
+                    self._remember(key, None)
+                    raise
+            self._remember(key, converted)
+        return converted
+
+    def _remember(self, key, value):
+        if len(self._cache) >= self.max_cache_size:
+            self._cache.clear()
+        self._cache[key] = value
@@ -1,40 +1,90 @@
+import collections
 import json
+import os
 import urllib
-import urllib2
+import urlparse
 import httplib
 import datetime
+import hashlib
 import socket
+import threading
+import time
+import zlib
 import datetime
+from itertools import izip
+
+from sqlalchemy import bindparam, func, update
 
 # from ckanext.harvest.harvesters.ckanharvester import CKANHarvester
 from ckanext.harvest.harvesters.base import HarvesterBase
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestJob, HarvestObject, \
+    HarvestObjectExtra, harvest_object_table
 from ckan.logic import ValidationError, NotFound, get_action
+from ckan.logic.schema import default_create_package_schema
+from ckan.lib.navl.validators import ignore_missing, ignore
 from ckan import model
-import ckan.lib.munge as munge
+from ckan.model.types import make_uuid
+import ckan.lib.search as search
 from ckan.plugins import toolkit
 
+from ckanext.dkan.harvesters.archive import MODES as ARCHIVE_MODES, \
+    get_response_archive
+from ckanext.dkan.harvesters.cache import LookupCache
+from ckanext.dkan.harvesters.client import HTTPClient
+from ckanext.dkan.harvesters.codec import decode_content, encode_content
+from ckanext.dkan.harvesters.config import get_harvest_config
+from ckanext.dkan.harvesters.dates import DateConverter
+from ckanext.dkan.harvesters.engine import ENGINES, Deadline, get_engine
+from ckanext.dkan.harvesters.enrich import Enrichment
+from ckanext.dkan.harvesters.fingerprint import content_fingerprint
+from ckanext.dkan.harvesters.governor import backoff_delay, get_governor, \
+    parse_retry_after
+from ckanext.dkan.harvesters.httpcache import get_response_cache
+from ckanext.dkan.harvesters.jsonstream import iter_array_items
+from ckanext.dkan.harvesters.licenses import LicenseIndex
+from ckanext.dkan.harvesters.mapping import compile_spec, validate_spec
+from ckanext.dkan.harvesters.metrics import Metrics, get_sinks
+from ckanext.dkan.harvesters.pager import AdaptivePager
+from ckanext.dkan.harvesters.resources import diff_resources
+
 log = __import__('logging').getLogger(__name__)
 
-MIMETYPE_FORMATS = {
-    'text/html': 'HTML',
-    'text/csv': 'CSV',
-    'text/xml': 'XML',
-    'application/pdf': 'PDF',
-    'application/zip': 'ZIP',
-    'application/rdf+xml': 'RDF',
-    'application/json': 'JSON',
-    'application/vnd.ms-excel': 'XLS',
-    'application/vnd.google-earth.kml+xml': 'KML',
-    'application/msword': 'DOC',
-}
+# Harvest object extra with the fingerprint of the imported content
+FINGERPRINT_EXTRA = 'content_fingerprint'
+# Harvest object extra with the remote modification date of the dataset
+MODIFIED_EXTRA = 'remote_metadata_modified'
 
 
 class DKANHarvester(HarvesterBase):
     ckan_revision_api_works = False
     config = None
+    harvest_config = None
     api_version = 2
     action_api_version = 3
+    _http_client = None
+    _license_index = None
+    _date_converter = DateConverter()
+    _mapping = None
+    # Datasets of the gather stage being run that could not be converted
+    _rejections = None
+    _lookup_cache = None
+    _lookup_cache_job_id = None
+    _enrichment = None
+    _enrichment_key = None
+    _skipped_unchanged = 0
+    # Metrics of the stage being run, there are none outside of a job
+    _metrics = Metrics()
+    _metrics_pending = 0
+    # Chunk being imported by import_stage_batch, if any
+    _batch = None
+    # Time budget of the requests of the gather stage being run
+    _deadline = None
+    # Semaphore limiting the requests in flight to all hosts, set by the
+    # gather runner
+    _request_budget = None
+    # Seconds taken by the last request of each thread that got a response,
+    # leaving out the time it waited for the governor
+    _request_timing = threading.local()
 
     def info(self):
         return {
@@ -50,35 +100,309 @@ class DKANHarvester(HarvesterBase):
     def _get_search_api_offset(self):
         return '%s/current_package_list_with_resources' % self._get_action_api_offset()
 
-    def _get_content(self, url):
-        http_request = urllib2.Request(url=url)
+    def _get_http_client(self):
+        if self._http_client is None:
+            self._http_client = HTTPClient(timeout=90)
+        return self._http_client
+
+    def _get_content(self, url, retry_timeouts=True):
+        return self._retry(url, lambda: ''.join(self._open_content(url)),
+                           retry_timeouts)
+
+    def _retry(self, url, fetch, retry_timeouts=True):
+        '''Calls ``fetch`` until it does not fail with a transient error.
+
+        Timeouts (unless ``retry_timeouts`` is False), connection errors,
+        429 and 5xx responses are retried up to ``max_retries`` times, with
+        an exponential backoff that honours the Retry-After header, as long
+        as the fetch deadline allows. If all the attempts fail, the error
+        raised lists the errors of every attempt.
+        '''
+        max_retries = int(self.config.get('max_retries', 3))
+        errors = []
+        while True:
+            try:
+                return fetch()
+            except ContentFetchError, e:
+                errors.append(str(e))
+                retryable = e.transient or e.status == 429 or \
+                    (e.status or 0) >= 500 or \
+                    (e.timeout and retry_timeouts)
+                if retryable and len(errors) <= max_retries:
+                    delay = backoff_delay(
+                        len(errors) - 1,
+                        base=self.config.get('retry_backoff', 1.0),
+                        max_delay=self.config.get('retry_max_delay', 60.0),
+                        retry_after=e.retry_after)
+                    remaining = self._deadline.remaining() \
+                        if self._deadline else None
+                    retryable = remaining is None or delay < remaining
+                if not retryable or len(errors) > max_retries:
+                    if len(errors) == 1:
+                        raise
+                    raise e.__class__(
+                        '%s (failed %d attempts: %s)' %
+                        (e, len(errors), '; '.join(errors)),
+                        status=e.status, timeout=e.timeout,
+                        retry_after=e.retry_after, transient=e.transient)
+
+            self._metrics.incr('http.retries')
+            log.warning('Request to %s failed (%s), retrying in %.1fs '
+                        '(attempt %d of %d)', url, e, delay,
+                        len(errors) + 1, max_retries + 1)
+            archive = self._get_response_archive()
+            if archive is None or not archive.replaying or archive.latency:
+                time.sleep(delay)
+
+    def _get_lookup_content(self, url):
+        '''Gets a group, organization or dataset like _get_content, within
+        the bound of the fetch engine if it is shared with the searches.'''
+        if self.config.get('fetch_engine') == 'bounded':
+            return self._get_fetch_engine().call(self._get_content, url)
+        return self._get_content(url)
+
+    def _get_fetch_engine(self):
+        '''Returns the engine making the requests of the source.
+
+        The default ``threads`` engine requests ``gather_workers`` search
+        pages at once from threads of its own, and makes the lookups from
+        the calling thread. The ``bounded`` one keeps ``fetch_concurrency``
+        search pages in flight, from a pool kept for the process, and never
+        has more than that many requests in flight, search pages and lookups
+        together.
+        '''
+        return get_engine(self.config.get('fetch_engine', 'threads'),
+                          self._get_fetch_concurrency())
+
+    def _get_fetch_concurrency(self):
+        if self.config.get('fetch_engine') == 'bounded':
+            return int(self.config.get('fetch_concurrency', 32))
+        return int(self.config.get('gather_workers', 1))
+
+    def _get_governor(self, url):
+        rate = self.config.get('requests_per_second')
+        # By default every request the fetch engine makes at once can be in
+        # flight
+        max_in_flight = self.config.get('max_in_flight') or \
+            max(4, self._get_fetch_concurrency())
+        return get_governor(
+            urlparse.urlsplit(url).netloc.lower(),
+            max_in_flight=int(max_in_flight),
+            rate=rate, burst=max(1, int(rate or 1)),
+            budget=self._request_budget)
+
+    def _open_content(self, url):
+        '''Requests ``url`` and yields the response body in chunks.
+
+        The body is read from the network as it is consumed, so large
+        responses do not need to be held in memory in one piece. Nothing is
+        requested until the first chunk is asked for. Errors are raised as
+        ContentFetchErrors.
+
+        No request is made once the fetch deadline of the stage has passed.
+        If the source has a response archive, the response is recorded to it
+        or replayed from it.
+        '''
+        if self._deadline is not None and self._deadline.expired():
+            raise ContentFetchError('Fetch deadline of %ss exceeded' %
+                                    self._deadline.seconds)
+        archive = self._get_response_archive()
+        if archive is None:
+            content = self._fetch_content(url)
+        elif archive.replaying:
+            content = self._replay_content(archive, url)
+        else:
+            content = self._record_content(archive, url)
+        for chunk in content:
+            yield chunk
+
+    def _fetch_content(self, url):
+        '''Requests ``url`` from the remote server, yielding the body in
+        chunks.
+
+        Requests to the same host go through its governor, which limits how
+        many of them are made at the same time and how often.
+        '''
+        headers = {}
 
         api_key = self.config.get('api_key')
         if api_key:
-            http_request.add_header('Authorization', api_key)
+            headers['Authorization'] = api_key
+
+        # Revalidate what is in the response cache instead of downloading it
+        # again
+        response_cache = self._get_response_cache()
+        cached = response_cache.get(url) if response_cache else None
+        if cached:
+            headers.update(cached.conditional_headers())
 
+        governor = self._get_governor(url)
+        governor.acquire()
         try:
-            http_response = urllib2.urlopen(http_request, timeout=90)
-        except urllib2.HTTPError, e:
-            if e.getcode() == 404:
-                raise ContentNotFoundError('HTTP error: %s' % e.code)
-            else:
-                raise ContentFetchError('HTTP error: %s' % e.code)
-        except urllib2.URLError, e:
-            raise ContentFetchError('URL error: %s' % e.reason)
-        except httplib.HTTPException, e:
-            raise ContentFetchError('HTTP Exception: %s' % e)
-        except socket.error, e:
-            raise ContentFetchError('HTTP socket error: %s' % e)
-        except Exception, e:
-            raise ContentFetchError('HTTP general exception: %s' % e)
-        return http_response.read()
+            started = time.time()
+            try:
+                http_response = self._get_http_client().open(url, headers)
+            except Exception, e:
+                self._metrics.incr('http.errors')
+                raise self._request_error(e)
+            finally:
+                self._metrics.timing('http.request', time.time() - started)
+            self._metrics.incr('http.status.%d' % http_response.status)
+
+            if http_response.status == 304 and cached:
+                log.debug('Not modified, using cached response for %s', url)
+                http_response.read()
+                self._request_timing.seconds = time.time() - started
+                yield cached.body
+                return
+            if http_response.status >= 400:
+                http_response.close()
+                if http_response.status == 404:
+                    raise ContentNotFoundError(
+                        'HTTP error: %s' % http_response.status,
+                        status=http_response.status)
+                retry_after = parse_retry_after(
+                    http_response.getheader('retry-after'))
+                if retry_after and http_response.status in (429, 503):
+                    # The host asks to slow down, for every request to it
+                    governor.pause(min(
+                        retry_after, self.config.get('retry_max_delay', 60.0)))
+                raise ContentFetchError(
+                    'HTTP error: %s' % http_response.status,
+                    status=http_response.status, retry_after=retry_after)
+
+            etag = http_response.getheader('etag')
+            last_modified = http_response.getheader('last-modified')
+            if not (etag or last_modified):
+                response_cache = None
+            for chunk in self._iter_response(url, http_response,
+                                             response_cache):
+                yield chunk
+            self._request_timing.seconds = time.time() - started
+        finally:
+            governor.release()
+
+    def _record_content(self, archive, url):
+        '''Requests ``url`` like _fetch_content and records the response,
+        or the error, to ``archive``.'''
+        started = time.time()
+        body = []
+        try:
+            for chunk in self._fetch_content(url):
+                body.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            # The caller stopped reading, eg at invalid JSON, which is all
+            # it will read when replayed too
+            archive.record(url, time.time() - started, body=''.join(body))
+            raise
+        except ContentFetchError, e:
+            archive.record(url, time.time() - started, error={
+                'message': str(e), 'not_found':
+                isinstance(e, ContentNotFoundError), 'status': e.status,
+                'timeout': e.timeout, 'retry_after': e.retry_after,
+                'transient': e.transient})
+            raise
+        # Without the time spent waiting for the governor, which a replay
+        # with latency waits for again
+        archive.record(url, self._request_timing.seconds,
+                       body=''.join(body))
+
+    def _replay_content(self, archive, url):
+        '''Yields the body of the response to ``url`` recorded in
+        ``archive``, or raises the error the request failed with.
+
+        Nothing is requested. If the archive replays the recorded latency,
+        the request is held for as long as it took, going through the
+        governor of the host like a real one.
+        '''
+        recorded = archive.replay(url)
+        if recorded is None:
+            raise ContentFetchError('No recorded response for %s' % url)
+        self._metrics.incr('http.replayed')
+        if archive.latency:
+            governor = self._get_governor(url)
+            governor.acquire()
+            try:
+                time.sleep(recorded.elapsed)
+            finally:
+                governor.release()
+        error = recorded.error
+        if error:
+            error_class = ContentNotFoundError if error['not_found'] \
+                else ContentFetchError
+            raise error_class(error['message'], status=error['status'],
+                              timeout=error['timeout'],
+                              retry_after=error['retry_after'],
+                              transient=error['transient'])
+        self._request_timing.seconds = recorded.elapsed
+        yield recorded.body
+
+    def _iter_response(self, url, http_response, response_cache=None):
+        max_bytes = self.config.get('max_response_bytes')
+        # The body is only kept around if it is going to the cache
+        body = [] if response_cache else None
+        size = 0
+        try:
+            for chunk in http_response.iter_content():
+                size += len(chunk)
+                if max_bytes and size > int(max_bytes):
+                    raise ContentFetchError(
+                        'Response bigger than %s bytes' % max_bytes)
+                if body is not None:
+                    body.append(chunk)
+                yield chunk
+        except (httplib.HTTPException, socket.error, zlib.error), e:
+            self._metrics.incr('http.errors')
+            if isinstance(e, zlib.error):
+                raise ContentFetchError('HTTP Exception: %s' % e,
+                                        transient=True)
+            raise self._request_error(e)
+        finally:
+            http_response.close()
+            self._metrics.incr('http.bytes', size)
+
+        if body is not None:
+            response_cache.set(url, http_response.getheader('etag'),
+                               http_response.getheader('last-modified'),
+                               ''.join(body))
+
+    def _request_error(self, e):
+        '''Returns the ContentFetchError for an error making a request.'''
+        if isinstance(e, ValueError):
+            return ContentFetchError('URL error: %s' % e)
+        elif isinstance(e, httplib.HTTPException):
+            return ContentFetchError('HTTP Exception: %s' % e, transient=True)
+        elif isinstance(e, socket.timeout):
+            return ContentFetchError('HTTP socket error: %s' % e,
+                                     timeout=True)
+        elif isinstance(e, socket.error):
+            return ContentFetchError('HTTP socket error: %s' % e,
+                                     transient=True)
+        return ContentFetchError('HTTP general exception: %s' % e)
+
+    def _get_response_cache(self):
+        '''Returns the response cache set up for the source, if any.'''
+        cache_config = self.config.get('response_cache')
+        if not cache_config:
+            return None
+        max_size = int(cache_config.get('max_size_mb', 100)) * 1024 * 1024
+        return get_response_cache(cache_config['path'], max_size)
+
+    def _get_response_archive(self):
+        '''Returns the response archive set up for the source, if any.'''
+        archive_config = (self.config or {}).get('response_archive')
+        if not archive_config:
+            return None
+        return get_response_archive(archive_config['path'],
+                                    archive_config['mode'],
+                                    archive_config.get('latency', False))
 
     def _get_group(self, base_url, group):
         url = base_url + self._get_action_api_offset() + '/group_show?id=' + \
             group['id']
         try:
-            content = self._get_content(url)
+            content = self._get_lookup_content(url)
             data = json.loads(content)
             if self.action_api_version == 3:
                 return data.pop('result')
@@ -91,7 +415,7 @@ class DKANHarvester(HarvesterBase):
         url = base_url + self._get_action_api_offset() + \
             '/organization_show?id=' + org_name
         try:
-            content = self._get_content(url)
+            content = self._get_lookup_content(url)
             content_dict = json.loads(content)
             return content_dict['result']
         except (ContentFetchError, ValueError, KeyError):
@@ -99,15 +423,18 @@ class DKANHarvester(HarvesterBase):
             raise RemoteResourceError(
                 'Could not fetch/decode remote organization')
 
-    def _set_config(self, config_str):
-        if config_str:
-            self.config = json.loads(config_str)
-            if 'api_version' in self.config:
-                self.api_version = int(self.config['api_version'])
+    def _get_license_index(self):
+        if self._license_index is None:
+            self._license_index = LicenseIndex(
+                (self.config or {}).get('license_aliases'))
+        return self._license_index
 
-            log.debug('Using config: %r', self.config)
-        else:
-            self.config = {}
+    def _set_config(self, config_str, source_id=None):
+        # Parsed configurations are shared, self.config must not be modified
+        self.harvest_config = get_harvest_config(config_str, source_id)
+        self.config = self.harvest_config.settings
+        if self.harvest_config.api_version is not None:
+            self.api_version = self.harvest_config.api_version
 
     def validate_config(self, config):
         if not config:
@@ -158,6 +485,59 @@ class DKANHarvester(HarvesterBase):
                 if not isinstance(config_obj['default_extras'], dict):
                     raise ValueError('default_extras must be a dictionary')
 
+            if config_obj.get('page_target_seconds') is not None:
+                if not isinstance(config_obj['page_target_seconds'],
+                                  (int, float)):
+                    raise ValueError('page_target_seconds must be a number')
+
+            if config_obj.get('lookup_cache_ttl') is not None:
+                if not isinstance(config_obj['lookup_cache_ttl'], (int, float)):
+                    raise ValueError('lookup_cache_ttl must be a number of '
+                                     'seconds')
+
+            if 'response_cache' in config_obj:
+                cache_config = config_obj['response_cache']
+                if not isinstance(cache_config, dict) or \
+                        not isinstance(cache_config.get('path'), basestring):
+                    raise ValueError('response_cache must be a dictionary '
+                                     'with the path of the cache file')
+                try:
+                    int(cache_config.get('max_size_mb', 100))
+                except (TypeError, ValueError):
+                    raise ValueError('response_cache max_size_mb must be an '
+                                     'integer')
+                cache_dir = os.path.dirname(
+                    os.path.abspath(cache_config['path']))
+                if not os.access(cache_dir, os.W_OK):
+                    raise ValueError('response_cache path must be in a '
+                                     'writable directory')
+
+            if 'response_archive' in config_obj:
+                archive_config = config_obj['response_archive']
+                if not isinstance(archive_config, dict) or \
+                        not isinstance(archive_config.get('path'),
+                                       basestring):
+                    raise ValueError('response_archive must be a dictionary '
+                                     'with the path of the archive file')
+                if archive_config.get('mode') not in ARCHIVE_MODES:
+                    raise ValueError('response_archive mode must be one of: '
+                                     '%s' % ', '.join(ARCHIVE_MODES))
+                if not isinstance(archive_config.get('latency', False),
+                                  bool):
+                    raise ValueError('response_archive latency must be '
+                                     'boolean')
+                if archive_config['mode'] == 'replay' and \
+                        not os.path.isfile(archive_config['path']):
+                    raise ValueError('response_archive to replay does not '
+                                     'exist')
+
+            if 'license_aliases' in config_obj:
+                if not isinstance(config_obj['license_aliases'], dict):
+                    raise ValueError('license_aliases must be a dictionary')
+
+            if 'mapping' in config_obj:
+                validate_spec(config_obj['mapping'])
+
             if 'organizations_filter_include' in config_obj \
                 and 'organizations_filter_exclude' in config_obj:
                 raise ValueError('Harvest configuration cannot contain both '
@@ -172,7 +552,55 @@ class DKANHarvester(HarvesterBase):
                 except NotFound:
                     raise ValueError('User not found')
 
-            for key in ('read_only', 'force_all'):
+            for key in ('gather_workers', 'gather_batch_size',
+                        'lookup_cache_size', 'page_size', 'page_size_min',
+                        'page_size_max', 'page_max_bytes',
+                        'max_response_bytes', 'metrics_flush_every',
+                        'max_in_flight', 'fetch_concurrency'):
+                if key in config_obj:
+                    try:
+                        value = int(config_obj[key])
+                    except (TypeError, ValueError):
+                        raise ValueError('%s must be an integer' % key)
+                    if value < 1:
+                        raise ValueError('%s must be greater than 0' % key)
+
+            if 'metrics' in config_obj:
+                metrics_config = config_obj['metrics']
+                if not isinstance(metrics_config, dict):
+                    raise ValueError('metrics must be a dictionary')
+                if metrics_config.get('statsd') is not None and \
+                        not isinstance(metrics_config['statsd'], basestring):
+                    raise ValueError('metrics statsd must be "host:port"')
+                if metrics_config.get('dir') is not None and \
+                        not os.path.isdir(metrics_config['dir']):
+                    raise ValueError('metrics dir must be an existing '
+                                     'directory')
+
+            if config_obj.get('fetch_engine') is not None and \
+                    config_obj['fetch_engine'] not in ENGINES:
+                raise ValueError('fetch_engine must be one of: %s' %
+                                 ', '.join(ENGINES))
+
+            for key in ('requests_per_second', 'retry_backoff',
+                        'retry_max_delay', 'fetch_deadline'):
+                if config_obj.get(key) is not None:
+                    if not isinstance(config_obj[key], (int, float)) or \
+                            config_obj[key] <= 0:
+                        raise ValueError('%s must be a positive number' % key)
+
+            if 'max_retries' in config_obj:
+                try:
+                    if int(config_obj['max_retries']) < 0:
+                        raise ValueError()
+                except (TypeError, ValueError):
+                    raise ValueError('max_retries must be an integer, 0 or '
+                                     'greater')
+
+            for key in ('read_only', 'force_all', 'skip_unchanged',
+                        'incremental_early_stop', 'stream_search_pages',
+                        'compress_content', 'diff_resources',
+                        'batch_import'):
                 if key in config_obj:
                     if not isinstance(config_obj[key], bool):
                         raise ValueError('%s must be boolean' % key)
@@ -187,7 +615,7 @@ class DKANHarvester(HarvesterBase):
         url = base_url + '/api/3/action/package_list'
         log.debug('Getting all DKAN packages: %s', url)
         try:
-            content = self._get_content(url)
+            content = self._get_lookup_content(url)
         except Exception, e:
             self._save_gather_error('Unable to get content for URL: %s - %s'
                                     % (url, e), harvest_job)
@@ -203,7 +631,7 @@ class DKANHarvester(HarvesterBase):
 
         # Get contents
         try:
-            content = self._get_content(url)
+            content = self._get_lookup_content(url)
         except Exception, e:
             self._save_object_error(
                 'Unable to get content for package: %s - %r' % (url, e),
@@ -211,7 +639,8 @@ class DKANHarvester(HarvesterBase):
             return None, None
 
         package = json.loads(content)['result'][0]
-        return url, json.dumps(package)
+        return url, encode_content(package,
+                                   self.config.get('compress_content', False))
 
     def fetch_stage(self, harvest_object):
         # Nothing to do here - we got the package dict in the search in the
@@ -222,9 +651,27 @@ class DKANHarvester(HarvesterBase):
         log.debug('In DKANHarvester gather_stage (%s)',
                   harvest_job.source.url)
         toolkit.requires_ckan_version(min_version='2.0')
+
+        self._set_config(harvest_job.source.config, harvest_job.source.id)
+        self._metrics = Metrics(get_sinks(self.config.get('metrics')),
+                                harvest_job.id, 'gather')
+        self._deadline = Deadline(self.config.get('fetch_deadline'))
+        try:
+            with self._metrics.timer('gather.total'):
+                return self._gather_stage(harvest_job)
+        finally:
+            self._deadline = None
+            self._log_rejections()
+            self._metrics.flush()
+
+    def _gather_stage(self, harvest_job):
         get_all_packages = True
 
-        self._set_config(harvest_job.source.config)
+        # License titles are indexed and the mapping compiled once per
+        # harvest run
+        self._license_index = None
+        self._mapping = None
+        self._rejections = []
 
         # Get source URL
         remote_ckan_base_url = harvest_job.source.url.rstrip('/')
@@ -244,94 +691,186 @@ class DKANHarvester(HarvesterBase):
         # modified since the last completely successful harvest.
         last_error_free_job = self.last_error_free_job(harvest_job)
         log.debug('Last error-free job: %r', last_error_free_job)
+        package_ids = set()
+        object_ids = []
         if (last_error_free_job and
                 not self.config.get('force_all', False)):
-            get_all_packages = False
-
-            # Request only the datasets modified since
+            # DKAN does not filter the datasets by modification date, that is
+            # done as the pages come in, against the most recent modification
+            # date harvested up to the last error-free job. It comes from the
+            # remote clock, unlike the time of the job: DKAN dates are in the
+            # local time of the remote, so the job time could miss datasets.
             last_time = last_error_free_job.gather_started
-            # Note: SOLR works in UTC, and gather_started is also UTC, so
-            # this should work as long as local and remote clocks are
-            # relatively accurate. Going back a little earlier, just in case.
-            get_changes_since = \
-                (last_time - datetime.timedelta(hours=1)).isoformat()
-            log.info('Searching for datasets modified since: %s UTC',
-                     get_changes_since)
-
-            fq_since_last_time = 'metadata_modified:[{since}Z TO *]' \
-                .format(since=get_changes_since)
-
-            try:
-                pkg_dicts = self._search_for_datasets(
-                    remote_ckan_base_url,
-                    fq_terms + [fq_since_last_time])
-            except SearchError, e:
-                log.info('Searching for datasets changed since last time '
-                         'gave an error: %s', e)
-                get_all_packages = True
-
-            if not get_all_packages and not pkg_dicts:
-                log.info('No datasets have been updated on the remote '
-                         'DKAN instance since the last harvest job %s',
-                         last_time)
-                return None
+            modified_since = self._get_high_water_mark(
+                harvest_job, last_error_free_job)
+            if modified_since is None:
+                log.info('No remote modification dates harvested yet, '
+                         'searching for all the datasets')
+            else:
+                get_all_packages = False
+                log.info('Searching for datasets modified since: %s',
+                         modified_since)
+                try:
+                    self._gather_harvest_objects(
+                        harvest_job,
+                        self._search_for_datasets(
+                            remote_ckan_base_url, fq_terms,
+                            modified_since=modified_since),
+                        package_ids, object_ids)
+                except SearchError, e:
+                    log.info('Searching for datasets changed since last time '
+                             'gave an error: %s', e)
+                    get_all_packages = True
+                except Exception, e:
+                    self._save_gather_error('%r' % e.message, harvest_job)
+                    return object_ids or None
+
+                if not get_all_packages and not object_ids:
+                    log.info('No datasets have been updated on the remote '
+                             'DKAN instance since the last harvest job %s',
+                             last_time)
+                    return None
 
         # Fall-back option - request all the datasets from the remote CKAN
         if get_all_packages:
-            # Request all remote packages
+            # Request all remote packages. Datasets that already got a harvest
+            # object from a failed search above are skipped as duplicates.
             try:
-                pkg_dicts = self._search_for_datasets(remote_ckan_base_url,
-                                                      fq_terms)
+                self._gather_harvest_objects(
+                    harvest_job,
+                    self._search_for_datasets(remote_ckan_base_url, fq_terms),
+                    package_ids, object_ids)
             except SearchError, e:
                 log.info('Searching for all datasets gave an error: %s', e)
                 self._save_gather_error(
                     'Unable to search remote DKAN for datasets:%s url:%s'
                     'terms:%s' % (e, remote_ckan_base_url, fq_terms),
                     harvest_job)
-                return None
-        if not pkg_dicts:
+                # Harvest objects are created as the pages come in, so the
+                # ones from the pages before the error can still be imported
+                return object_ids or None
+            except Exception, e:
+                self._save_gather_error('%r' % e.message, harvest_job)
+                return object_ids or None
+        if not object_ids:
             self._save_gather_error(
                 'No datasets found at DKAN: %s' % remote_ckan_base_url,
                 harvest_job)
             return None
 
-        # Create harvest objects for each dataset
+        return object_ids
+
+    def _gather_harvest_objects(self, harvest_job, pages, package_ids,
+                                object_ids):
+        '''Creates a HarvestObject for each dataset, page by page.
+
+        ``pages`` is an iterable of lists of converted package dicts, such as
+        the one returned by ``_search_for_datasets``. The ids of the datasets
+        and of the new harvest objects are added to ``package_ids`` and
+        ``object_ids``, so the caller keeps what has been created so far even
+        if fetching a later page fails.
+        '''
+        # Harvest objects are committed in batches rather than one by one
+        batch_size = int(self.config.get('gather_batch_size', 100))
+        compress = self.config.get('compress_content', False)
+        batch = []
         try:
-            package_ids = set()
-            object_ids = []
-            for pkg_dict in pkg_dicts:
-                if pkg_dict is None:
-                    continue
-
-                if pkg_dict['id'] in package_ids:
-                    log.info('Discarding duplicate dataset %s - probably due '
-                             'to datasets being changed at the same time as '
-                             'when the harvester was paging through',
-                             pkg_dict['id'])
-                    continue
-                package_ids.add(pkg_dict['id'])
-
-                log.debug('Package: %s', pkg_dict)
-                log.debug('Creating HarvestObject for %s %s',
-                          pkg_dict['name'], pkg_dict['id'])
-
-                obj = HarvestObject(guid=pkg_dict['id'],
-                                    job=harvest_job,
-                                    content=json.dumps(pkg_dict))
-                obj.save()
-                object_ids.append(obj.id)
-
-            return object_ids
+            for pkg_dicts in pages:
+                for pkg_dict in pkg_dicts:
+                    if pkg_dict is None:
+                        continue
+
+                    if pkg_dict['id'] in package_ids:
+                        log.info('Discarding duplicate dataset %s - probably '
+                                 'due to datasets being changed at the same '
+                                 'time as when the harvester was paging '
+                                 'through', pkg_dict['id'])
+                        continue
+                    package_ids.add(pkg_dict['id'])
+
+                    log.debug('Package: %s', pkg_dict)
+                    log.debug('Creating HarvestObject for %s %s',
+                              pkg_dict['name'], pkg_dict['id'])
+
+                    # Set the id up front so it is known without having to
+                    # reload the object after the commit
+                    obj = HarvestObject(id=make_uuid(),
+                                        guid=pkg_dict['id'],
+                                        job=harvest_job,
+                                        content=encode_content(
+                                            pkg_dict, compress))
+                    model.Session.add(obj)
+                    if pkg_dict.get('metadata_modified'):
+                        # Used to work out the high-water mark of the source
+                        # in the next jobs
+                        model.Session.add(HarvestObjectExtra(
+                            object=obj, key=MODIFIED_EXTRA,
+                            value=pkg_dict['metadata_modified']))
+                    batch.append((obj.id, pkg_dict['id']))
+
+                    if len(batch) >= batch_size:
+                        self._save_harvest_objects(harvest_job, batch,
+                                                   package_ids, object_ids)
+        finally:
+            if batch:
+                self._save_harvest_objects(harvest_job, batch, package_ids,
+                                           object_ids)
+
+    def _get_high_water_mark(self, harvest_job, last_error_free_job):
+        '''Returns the most recent remote modification date harvested.
+
+        Only the harvest objects of jobs up to the last error-free one count,
+        so datasets that failed in later jobs are harvested again.
+        '''
+        return model.Session.query(func.max(HarvestObjectExtra.value)) \
+            .join(HarvestObject,
+                  HarvestObjectExtra.harvest_object_id == HarvestObject.id) \
+            .join(HarvestJob, HarvestObject.harvest_job_id == HarvestJob.id) \
+            .filter(HarvestJob.source_id == harvest_job.source_id) \
+            .filter(HarvestJob.gather_started <=
+                    last_error_free_job.gather_started) \
+            .filter(HarvestObjectExtra.key == MODIFIED_EXTRA) \
+            .scalar()
+
+    def _save_harvest_objects(self, harvest_job, batch, package_ids,
+                              object_ids):
+        '''Commits a batch of pending HarvestObjects in one transaction.
+
+        ``batch`` is a list of (harvest object id, dataset id) tuples for the
+        objects added to the session. If the commit fails only the objects
+        of this batch are lost: the error is saved for the job and their
+        datasets are removed from ``package_ids``. The batch is emptied.
+        '''
+        try:
+            with self._metrics.timer('gather.commit'):
+                model.Session.commit()
         except Exception, e:
-            self._save_gather_error('%r' % e.message, harvest_job)
+            model.Session.rollback()
+            self._metrics.incr('gather.objects_failed', len(batch))
+            log.error('Unable to save %d harvest objects: %r', len(batch), e)
+            package_ids.difference_update(
+                package_id for obj_id, package_id in batch)
+            self._save_gather_error(
+                'Unable to save harvest objects for %d datasets: %r' %
+                (len(batch), e), harvest_job)
+        else:
+            self._metrics.incr('gather.objects_created', len(batch))
+            object_ids.extend(obj_id for obj_id, package_id in batch)
+        del batch[:]
 
-    def _search_for_datasets(self, remote_ckan_base_url, fq_terms=None):
-        '''Does a dataset search on a remote CKAN and returns the results.
+    def _search_for_datasets(self, remote_ckan_base_url, fq_terms=None,
+                             modified_since=None):
+        '''Does a dataset search on a remote DKAN and yields the results.
 
         Deals with paging to return all the results, not just the first page.
+        Each page is yielded as a list of converted package dicts as soon as
+        it has been fetched, so callers never hold the whole portal in memory.
+
+        If ``modified_since`` is given only the datasets modified since then
+        are returned. While the remote returns the datasets newest first,
+        paging stops at the first page that only has older datasets.
         '''
         base_search_url = remote_ckan_base_url + self._get_search_api_offset()
-        params = {'limit': '100', 'offset': '0'}
         # There is the worry that datasets will be changed whilst we are paging
         # through them.
         # * In SOLR 4.7 there is a cursor, but not using that yet
@@ -350,61 +889,452 @@ class DKANHarvester(HarvesterBase):
         #   we are at risk of seeing datasets twice in the paging, so we detect
         #   and remove any duplicates.
 
-        pkg_dicts = []
-        pkg_ids = set()
-        previous_content = None
-        while True:
-            url = base_search_url + '?' + urllib.urlencode(params)
-            log.debug('Searching for DKAN datasets: %s', url)
-            try:
-                content = self._get_content(url)
-            except ContentFetchError, e:
-                raise SearchError(
-                    'Error sending request to search remote '
-                    'DKAN instance %s using URL %r. Error: %s' %
-                    (remote_ckan_base_url, url, e))
-
-            if previous_content and content == previous_content:
-                raise SearchError('The paging doesn\'t seem to work. URL: %s' %
-                                  url)
-            try:
-                response_dict = json.loads(content)
-            except ValueError:
-                raise SearchError('Response from remote DKAN was not JSON: %r'
-                                  % content)
-            try:
-                pkg_dicts_page = response_dict.get('result', [])
-            except ValueError:
-                raise SearchError('Response JSON did not contain '
-                                  'result/results: %r' % response_dict)
+        # The page size adapts to how the remote copes with the pages
+        pager = self._get_pager()
+        metrics = self._metrics
+        # Number of pages requested concurrently. With a single worker the
+        # pages are requested one after the other, as they always were.
+        engine = self._get_fetch_engine()
+        workers = engine.concurrency
 
-            if len(pkg_dicts_page) == 0:
-                break
-            # Weed out any datasets found on previous pages (should datasets be
-            # changing while we page)
-
-            if type(pkg_dicts_page[0]) == list:
-                pkg_dicts_page = pkg_dicts_page[0]
-
-            pkg_dicts_page = [self._convert_dkan_package_to_ckan(p) for p in pkg_dicts_page]
+        pkg_ids = set()
+        previous_digest = None
+        offset = 0
+        # Number of datasets in the last page, if it was not a full one
+        short_page_count = None
+        # Whether the datasets seen so far came newest first
+        sorted_by_modified = self.config.get('incremental_early_stop', True)
+        last_modified_seen = None
+        try:
+            while True:
+                limit = pager.limit
+                offsets = [offset + i * limit for i in range(workers)]
+                urls = [self._get_search_url(base_search_url, page_offset,
+                                             limit)
+                        for page_offset in offsets]
+                pages = engine.imap(self._fetch_search_page, urls)
+
+                # Pages are handled in offset order, each one as soon as it
+                # is in, so the checks below work exactly as if they had
+                # been requested one by one
+                for url, page_offset, (pkg_dicts_page, digest, size, error,
+                                       elapsed) in izip(urls, offsets, pages):
+                    log.debug('Searching for DKAN datasets: %s', url)
+                    if isinstance(error, SearchError):
+                        raise error
+                    if error is not None:
+                        metrics.incr('gather.page_errors')
+                        if self._is_retryable_error(error) and pager.shrink():
+                            # Ask again for the same datasets in smaller
+                            # pages, starting with this one
+                            log.warning('Search page at offset %d failed '
+                                        '(%s), retrying with pages of %d '
+                                        'datasets', page_offset, error,
+                                        pager.limit)
+                            offset = page_offset
+                            break
+                        raise SearchError(
+                            'Error sending request to search remote '
+                            'DKAN instance %s using URL %r. Error: %s' %
+                            (remote_ckan_base_url, url, error))
+
+                    if previous_digest and digest == previous_digest:
+                        raise SearchError('The paging doesn\'t seem to work. '
+                                          'URL: %s' % url)
+                    previous_digest = digest
+
+                    if len(pkg_dicts_page) == 0:
+                        # Any page requested after this one is empty too
+                        return
+                    # Weed out any datasets found on previous pages (should
+                    # datasets be changing while we page)
+
+                    page_count = len(pkg_dicts_page)
+                    if short_page_count is not None:
+                        # The previous page was not the last one, so it had
+                        # as many datasets as the remote returns per page
+                        pager.cap(short_page_count)
+                        short_page_count = None
+                    pager.record(limit, elapsed, size, page_count)
+                    metrics.incr('gather.pages')
+                    metrics.timing('gather.page_fetch', elapsed)
+
+                    fallbacks = self._date_converter.fallbacks
+                    with metrics.timer('gather.convert'):
+                        pkg_dicts_page, rejections = \
+                            self._get_mapping().apply(pkg_dicts_page,
+                                                      metrics)
+                    metrics.incr('gather.converted', len(pkg_dicts_page))
+                    if rejections:
+                        metrics.incr('gather.rejected', len(rejections))
+                        # They are only kept to be logged by the gather stage
+                        if self._rejections is not None:
+                            self._rejections.extend(rejections)
+                    if self._date_converter.fallbacks > fallbacks:
+                        metrics.incr('gather.date_fallbacks',
+                                     self._date_converter.fallbacks -
+                                     fallbacks)
+
+                    ids_in_page = set(p['id'] for p in pkg_dicts_page)
+                    duplicate_ids = ids_in_page & pkg_ids
+                    if duplicate_ids:
+                        pkg_dicts_page = [p for p in pkg_dicts_page
+                                          if p['id'] not in duplicate_ids]
+                    pkg_ids |= ids_in_page
+
+                    only_older = False
+                    if modified_since:
+                        modified = [p['metadata_modified']
+                                    for p in pkg_dicts_page
+                                    if p.get('metadata_modified')]
+                        if sorted_by_modified and modified:
+                            sequence = modified
+                            if last_modified_seen:
+                                sequence = [last_modified_seen] + modified
+                            if any(newer < older for newer, older
+                                   in zip(sequence, sequence[1:])):
+                                log.info('Remote datasets are not sorted by '
+                                         'modification date, checking all '
+                                         'of them')
+                                sorted_by_modified = False
+                            else:
+                                last_modified_seen = modified[-1]
+                        only_older = bool(modified) and \
+                            max(modified) < modified_since
+                        pkg_dicts_page = [
+                            p for p in pkg_dicts_page
+                            if p.get('metadata_modified', modified_since) >=
+                            modified_since]
+
+                    yield pkg_dicts_page
+
+                    if sorted_by_modified and only_older:
+                        log.info('The remaining datasets were modified '
+                                 'before %s, stopping', modified_since)
+                        return
+
+                    # Move on by the datasets actually returned, which may be
+                    # fewer than asked for
+                    offset = page_offset + page_count
+                    if page_count < limit:
+                        # Either this is the last page or the remote limits
+                        # the page size. In the latter case the next pages
+                        # of this batch started at the wrong offset, so they
+                        # are requested again.
+                        short_page_count = page_count
+                        break
+        finally:
+            engine.close()
+
+    def _get_pager(self):
+        return AdaptivePager(
+            page_size=int(self.config.get('page_size', 100)),
+            min_size=int(self.config.get('page_size_min', 10)),
+            max_size=int(self.config.get('page_size_max', 1000)),
+            target_seconds=self.config.get('page_target_seconds', 10.0),
+            max_bytes=self.config.get('page_max_bytes'))
+
+    def _is_retryable_error(self, error):
+        '''Checks if a failed request may work with a smaller page.'''
+        return getattr(error, 'timeout', False) or \
+            (getattr(error, 'status', None) or 0) >= 500
+
+    def _get_search_url(self, base_search_url, offset, limit):
+        params = {'limit': str(limit), 'offset': str(offset)}
+        return base_search_url + '?' + urllib.urlencode(params)
+
+    def _fetch_search_page(self, url):
+        '''Fetches and parses one page of search results.
+
+        Returns a (datasets, digest, size, error, elapsed seconds) tuple
+        instead of raising, so that pages fetched in a worker thread can be
+        checked in order by the caller. ``digest`` is a hash of the response,
+        used to detect a remote that ignores the offset.
+
+        With the ``stream_search_pages`` option the datasets are decoded as
+        the response is read, instead of reading the whole response and
+        decoding it afterwards.
+
+        The elapsed seconds of a page that could be fetched are those of the
+        request that got it, not counting the time waiting for the governor
+        or between retries, which say nothing about how the remote copes
+        with the page size.
+        '''
+        started = time.time()
+        self._request_timing.seconds = None
+        try:
+            if self.config.get('stream_search_pages', False):
+                pkg_dicts, digest, size = self._retry(
+                    url, lambda: self._stream_search_page(url),
+                    retry_timeouts=False)
+            else:
+                # Timeouts are not retried, the page size is reduced instead
+                content = self._get_content(url, retry_timeouts=False)
+                digest = hashlib.sha1(content).digest()
+                size = len(content)
+                pkg_dicts = self._parse_search_page(content)
+        except (ContentFetchError, SearchError), e:
+            return None, None, None, e, time.time() - started
+        elapsed = self._request_timing.seconds
+        if elapsed is None:
+            elapsed = time.time() - started
+        return pkg_dicts, digest, size, None, elapsed
+
+    def _stream_search_page(self, url):
+        '''Returns the (datasets, digest, size) of a search page, decoding
+        the datasets as the response is read.'''
+        sha1 = hashlib.sha1()
+        counter = [0]
+
+        def chunks():
+            for chunk in self._open_content(url):
+                sha1.update(chunk)
+                counter[0] += len(chunk)
+                yield chunk
+
+        body = chunks()
+        try:
+            pkg_dicts = list(iter_array_items(body, 'result'))
+        except ValueError, e:
+            raise SearchError('Response from remote DKAN was not '
+                              'JSON: %s' % e)
+        # Read what is left after the results, so the connection can be
+        # reused
+        for chunk in body:
+            pass
+        return pkg_dicts, sha1.digest(), counter[0]
 
-            ids_in_page = set(p['id'] for p in pkg_dicts_page if p is not None)
-            duplicate_ids = ids_in_page & pkg_ids
-            if duplicate_ids:
-                pkg_dicts_page = [p for p in pkg_dicts_page if p['id'] not in duplicate_ids]
-            pkg_ids |= ids_in_page
+    def _parse_search_page(self, content):
+        try:
+            response_dict = json.loads(content)
+        except ValueError:
+            raise SearchError('Response from remote DKAN was not '
+                              'JSON: %r' % content)
+        try:
+            pkg_dicts_page = response_dict.get('result', [])
+        except ValueError:
+            raise SearchError('Response JSON did not contain '
+                              'result/results: %r' % response_dict)
+        if pkg_dicts_page and type(pkg_dicts_page[0]) == list:
+            pkg_dicts_page = pkg_dicts_page[0]
+        return pkg_dicts_page
 
-            pkg_dicts.extend(pkg_dicts_page)
+    def import_stage(self, harvest_object):
+        if harvest_object and harvest_object.import_finished is not None:
+            # It was imported by import_stage_batch after being queued to be
+            # fetched, which the gather-all command does not do for the
+            # sources with batch_import set
+            log.info('Harvest object %s was already imported, skipping',
+                     harvest_object.id)
+            return 'unchanged'
+        started = time.time()
+        try:
+            return self._import_stage(harvest_object)
+        finally:
+            self._metrics.timing('import.total', time.time() - started)
+            self._metrics_pending += 1
+            # There is no config if the harvest object was missing.
+            # import_stage_batch flushes them itself
+            if self._metrics_pending >= \
+                    int((self.config or {}).get('metrics_flush_every', 100)) \
+                    or (harvest_object and self._batch is None and
+                        self._is_job_imported(harvest_object)):
+                self._metrics.flush()
+                self._metrics_pending = 0
+
+    def import_stage_batch(self, harvest_objects):
+        '''Imports a chunk of harvest objects of the same job at once.
+
+        This is an opt-in alternative to passing the objects one by one to
+        import_stage (see the ``dkan-harvester import-batch`` paster command),
+        and sets their state and report status as the harvest queue does.
+        The datasets are written in a single transaction, with a savepoint
+        per object so that a failing one does not undo the others, and they
+        are sent to the search index once it is committed, with a single
+        search index commit. Object errors are saved after the transaction.
+        If it can not be committed the objects are imported one at a time.
+
+        Returns the number of objects imported without errors.
+        '''
+        harvest_objects = list(harvest_objects)
+        if not harvest_objects:
+            return 0
+        if len(set(obj.harvest_job_id for obj in harvest_objects)) > 1:
+            raise ValueError('The harvest objects of a batch must belong to '
+                             'the same job')
+
+        batch = self._batch = ImportBatch()
+        indexing = toolkit.config.get('ckan.search.automatic_indexing')
+        toolkit.config['ckan.search.automatic_indexing'] = 'false'
+        try:
+            for harvest_object in harvest_objects:
+                self._import_batch_object(harvest_object)
+            with self._metrics.timer('import.batch_commit'):
+                model.Session.commit()
+        except Exception, e:
+            log.error('Could not import a batch of %d harvest objects, '
+                      'importing them one at a time: %s',
+                      len(harvest_objects), e)
+            model.Session.rollback()
+            batch = None
+        finally:
+            self._batch = None
+            if indexing is None:
+                toolkit.config.pop('ckan.search.automatic_indexing', None)
+            else:
+                toolkit.config['ckan.search.automatic_indexing'] = indexing
 
-            params['offset'] = str(int(params['offset']) + int(params['limit']))
+        if batch is None:
+            # Groups and organizations created for the batch are gone
+            self._lookup_cache = None
+            imported = sum(1 for harvest_object in harvest_objects
+                           if self._import_single_object(harvest_object))
+        else:
+            if batch.package_ids:
+                try:
+                    with self._metrics.timer('import.batch_index'):
+                        search.rebuild(package_ids=sorted(batch.package_ids),
+                                       defer_commit=True)
+                        search.commit()
+                except Exception, e:
+                    log.error('Could not index the datasets of a batch, they '
+                              'need to be reindexed: %s (%s)', e,
+                              ', '.join(sorted(batch.package_ids)))
+            for message, obj, stage, line in batch.errors:
+                super(DKANHarvester, self)._save_object_error(
+                    message, obj, stage, line)
+            imported = batch.imported
+        self._metrics.incr('import.batches')
+        self._metrics.flush()
+        self._metrics_pending = 0
+        return imported
+
+    def _import_batch_object(self, harvest_object):
+        harvest_object.import_started = datetime.datetime.utcnow()
+        harvest_object.state = 'IMPORT'
+        savepoint = model.Session.begin_nested()
+        try:
+            result = self.import_stage(harvest_object)
+        except Exception, e:
+            self._save_object_error('%s' % e, harvest_object, 'Import')
+            result = False
+        if result:
+            savepoint.commit()
+            self._batch.imported += 1
+            if result != 'unchanged' and harvest_object.package_id:
+                self._batch.package_ids.add(harvest_object.package_id)
+        else:
+            savepoint.rollback()
+            # Groups and organizations created for it are gone too
+            self._lookup_cache = None
+        self._set_import_status(harvest_object, result)
+
+    def _import_single_object(self, harvest_object):
+        # It may have been set for the batch that could not be committed
+        harvest_object.import_finished = None
+        harvest_object.import_started = datetime.datetime.utcnow()
+        harvest_object.state = 'IMPORT'
+        harvest_object.save()
+        try:
+            result = self.import_stage(harvest_object)
+        except Exception, e:
+            self._save_object_error('%s' % e, harvest_object, 'Import')
+            result = False
+        self._set_import_status(harvest_object, result)
+        harvest_object.save()
+        return bool(result)
+
+    def _set_import_status(self, harvest_object, result):
+        '''Sets the state and report status of an imported object the same
+        way as the harvest queue.'''
+        harvest_object.import_finished = datetime.datetime.utcnow()
+        if not result:
+            harvest_object.state = 'ERROR'
+            harvest_object.report_status = 'errored'
+            return
+        harvest_object.state = 'COMPLETE'
+        if result == 'unchanged':
+            harvest_object.report_status = 'not modified'
+        elif harvest_object.current is False:
+            harvest_object.report_status = 'deleted'
+        elif len(model.Session.query(HarvestObject.id)
+                 .filter(HarvestObject.package_id ==
+                         harvest_object.package_id)
+                 .limit(2).all()) == 2:
+            harvest_object.report_status = 'updated'
+        else:
+            harvest_object.report_status = 'added'
+
+    def _create_or_update_package_deferred(self, package_dict,
+                                           harvest_object):
+        '''Same as HarvesterBase._create_or_update_package with
+        ``package_dict_form='package_show'``, but nothing is committed, as
+        that is left to import_stage_batch, and errors are raised.'''
+        schema = default_create_package_schema()
+        schema['id'] = [ignore_missing, unicode]
+        schema['__junk'] = [ignore]
+        context = {'model': model, 'session': model.Session,
+                   'user': self._get_user_name(),
+                   'api_version': self.api_version, 'schema': schema,
+                   'ignore_auth': True, 'defer_commit': True}
+
+        if self.config.get('clean_tags', False):
+            package_dict['tags'] = self._clean_tags(
+                package_dict.get('tags', []))
 
-        return pkg_dicts
+        try:
+            existing_package_dict = self._find_existing_package(package_dict)
+        except NotFound:
+            existing_package_dict = None
+
+        if existing_package_dict is not None:
+            # The name may have been changed when it was first imported
+            package_dict['name'] = existing_package_dict['name']
+            if 'metadata_modified' in package_dict and \
+                    package_dict['metadata_modified'] <= \
+                    existing_package_dict.get('metadata_modified'):
+                log.info('No changes to package with GUID %s, skipping...',
+                         harvest_object.guid)
+                return 'unchanged'
+
+            log.info('Package with GUID %s exists and needs to be updated',
+                     harvest_object.guid)
+            context['id'] = package_dict['id']
+            new_package = get_action('package_update')(context, package_dict)
+
+            # Flag the other objects of the package as not current anymore
+            model.Session.connection().execute(
+                update(harvest_object_table)
+                .where(harvest_object_table.c.package_id ==
+                       bindparam('b_package_id'))
+                .values(current=False),
+                b_package_id=new_package['id'])
+            harvest_object.package_id = new_package['id']
+            harvest_object.current = True
+            harvest_object.add()
+        else:
+            package_dict['name'] = self._gen_new_name(
+                package_dict.get('name') or package_dict['title'])
+            log.info('Package with GUID %s does not exist, let\'s create it',
+                     harvest_object.guid)
+            harvest_object.current = True
+            harvest_object.package_id = package_dict['id']
+            harvest_object.add()
+            # The harvest object is flushed before its package exists
+            model.Session.execute(
+                'SET CONSTRAINTS harvest_object_package_id_fkey DEFERRED')
+            model.Session.flush()
+            get_action('package_create')(context, package_dict)
+        return True
 
-    def import_stage(self, harvest_object):
+    def _import_stage(self, harvest_object):
         log.debug('In DKANHarvester import_stage')
 
         base_context = {'model': model, 'session': model.Session,
                         'user': self._get_user_name()}
+        if self._batch is not None:
+            # Groups and organizations are committed with the batch
+            base_context['defer_commit'] = True
         if not harvest_object:
             log.error('No harvest object received')
             return False
@@ -415,24 +1345,38 @@ class DKANHarvester(HarvesterBase):
                                     harvest_object, 'Import')
             return False
 
-        self._set_config(harvest_object.job.source.config)
+        self._set_config(harvest_object.job.source.config,
+                         harvest_object.job.source.id)
+        harvest_config = self.harvest_config
+        metrics = self._get_import_metrics(harvest_object)
+        metrics.incr('import.objects')
 
         try:
-            package_dict = json.loads(harvest_object.content)
+            package_dict = decode_content(harvest_object.content)
 
             if package_dict.get('type') == 'harvest':
                 log.warn('Remote dataset is a harvest source, ignoring...')
                 return True
 
+            lookups = self._get_lookup_cache(harvest_object)
+
+            # Skip the datasets that have not changed since they were last
+            # imported
+            fingerprint = content_fingerprint(package_dict,
+                                              harvest_config.digest)
+            if self._is_unchanged(harvest_object, fingerprint):
+                self._skipped_unchanged += 1
+                metrics.incr('import.skipped_unchanged')
+                log.info('Dataset %s has not changed since the last import, '
+                         'skipping (%d skipped in this job)',
+                         harvest_object.guid, self._skipped_unchanged)
+                return 'unchanged'
+
             # Set default tags if needed
-            default_tags = self.config.get('default_tags', [])
-            if default_tags:
-                if not 'tags' in package_dict:
-                    package_dict['tags'] = []
-                package_dict['tags'].extend(
-                    [t for t in default_tags if t not in package_dict['tags']])
-
-            remote_groups = self.config.get('remote_groups', None)
+            enrichment = self._get_enrichment(harvest_object)
+            enrichment.add_tags(package_dict)
+
+            remote_groups = harvest_config.remote_groups
             if not remote_groups in ('only_local', 'create'):
                 # Ignore remote groups
                 package_dict.pop('groups', None)
@@ -444,34 +1388,23 @@ class DKANHarvester(HarvesterBase):
                 validated_groups = []
 
                 for group_ in package_dict['groups']:
-                    try:
-                        data_dict = {'id': group_['id']}
-                        group = get_action('group_show')(base_context.copy(), data_dict)
-                        validated_groups.append({'id': group['id'], 'name': group['name']})
-
-                    except NotFound, e:
-                        log.info('Group %s is not available', group_)
-                        if remote_groups == 'create':
-                            try:
-                                group = self._get_group(harvest_object.source.url, group_)
-                            except RemoteResourceError:
-                                log.error('Could not get remote group %s', group_)
-                                continue
-
-                            for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name']:
-                                group.pop(key, None)
-
-                            get_action('group_create')(base_context.copy(), group)
-                            log.info('Group %s has been newly created', group_)
-                            validated_groups.append({'id': group['id'], 'name': group['name']})
+                    group = self._get_local_group(
+                        lookups, base_context, harvest_object, group_,
+                        create=(remote_groups == 'create'))
+                    if group:
+                        validated_groups.append(group)
 
                 package_dict['groups'] = validated_groups
 
             # Local harvest source organization
-            source_dataset = get_action('package_show')(base_context.copy(), {'id': harvest_object.source.id})
+            source_dataset = lookups.get_or_load(
+                ('package', harvest_object.source.id),
+                lambda: self._show_local(base_context, 'package_show',
+                                         harvest_object.source.id),
+                NotFound)
             local_org = source_dataset.get('owner_org')
 
-            remote_orgs = self.config.get('remote_orgs', None)
+            remote_orgs = harvest_config.remote_orgs
 
             if not remote_orgs in ('only_local', 'create'):
                 # Assign dataset to the source organization
@@ -485,70 +1418,15 @@ class DKANHarvester(HarvesterBase):
                 remote_org = package_dict['owner_org']
 
                 if remote_org:
-                    try:
-                        data_dict = {'id': remote_org}
-                        org = get_action('organization_show')(base_context.copy(), data_dict)
-                        validated_org = org['id']
-                    except NotFound, e:
-                        log.info('Organization %s is not available', remote_org)
-                        if remote_orgs == 'create':
-                            try:
-                                try:
-                                    org = self._get_organization(harvest_object.source.url, remote_org)
-                                except RemoteResourceError:
-                                    # fallback if remote CKAN exposes organizations as groups
-                                    # this especially targets older versions of CKAN
-                                    org = self._get_group(harvest_object.source.url, remote_org)
-
-                                for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name', 'type']:
-                                    org.pop(key, None)
-                                get_action('organization_create')(base_context.copy(), org)
-                                log.info('Organization %s has been newly created', remote_org)
-                                validated_org = org['id']
-                            except (RemoteResourceError, ValidationError):
-                                log.error('Could not get remote org %s', remote_org)
+                    validated_org = self._get_local_organization(
+                        lookups, base_context, harvest_object, remote_org,
+                        create=(remote_orgs == 'create'))
 
                 package_dict['owner_org'] = validated_org or local_org
 
-            # Set default groups if needed
-            default_groups = self.config.get('default_groups', [])
-            if default_groups:
-                if not 'groups' in package_dict:
-                    package_dict['groups'] = []
-                existing_group_ids = [g['id'] for g in package_dict['groups']]
-                package_dict['groups'].extend(
-                    [g for g in self.config['default_group_dicts']
-                     if g['id'] not in existing_group_ids])
-
-            # Set default extras if needed
-            default_extras = self.config.get('default_extras', {})
-            def get_extra(key, package_dict):
-                for extra in package_dict.get('extras', []):
-                    if extra['key'] == key:
-                        return extra
-            if default_extras:
-                override_extras = self.config.get('override_extras', False)
-                if not 'extras' in package_dict:
-                    package_dict['extras'] = []
-                for key, value in default_extras.iteritems():
-                    existing_extra = get_extra(key, package_dict)
-                    if existing_extra and not override_extras:
-                        continue  # no need for the default
-                    if existing_extra:
-                        package_dict['extras'].remove(existing_extra)
-                    # Look for replacement strings
-                    if isinstance(value, basestring):
-                        value = value.format(
-                            harvest_source_id=harvest_object.job.source.id,
-                            harvest_source_url=
-                            harvest_object.job.source.url.strip('/'),
-                            harvest_source_title=
-                            harvest_object.job.source.title,
-                            harvest_job_id=harvest_object.job.id,
-                            harvest_object_id=harvest_object.id,
-                            dataset_id=package_dict['id'])
-
-                    package_dict['extras'].append({'key': key, 'value': value})
+            # Set default groups and extras if needed
+            enrichment.add_groups(package_dict)
+            enrichment.add_extras(package_dict, harvest_object.id)
 
             for resource in package_dict.get('resources', []):
                 # Clear remote url_type for resources (eg datastore, upload) as
@@ -561,8 +1439,41 @@ class DKANHarvester(HarvesterBase):
                 # key.
                 resource.pop('revision_id', None)
 
-            result = self._create_or_update_package(
-                package_dict, harvest_object, package_dict_form='package_show')
+            existing = model.Session.query(model.Package.id,
+                                           model.Package.metadata_modified) \
+                .filter(model.Package.id == package_dict['id']).first()
+            if existing and 'resources' in package_dict and \
+                    self.config.get('diff_resources', True) and \
+                    self._will_update(package_dict, existing[1]):
+                # Only the resources that changed are written again
+                local_resources = get_action('package_show')(
+                    base_context.copy(),
+                    {'id': package_dict['id']}).get('resources', [])
+                package_dict['resources'], counts = diff_resources(
+                    package_dict['resources'], local_resources)
+                for key, count in counts.items():
+                    if count:
+                        metrics.incr('import.resources_%s' % key, count)
+                log.info('Resources of dataset %s: %d unchanged, %d '
+                         'updated, %d added, %d removed', package_dict['id'],
+                         counts['unchanged'], counts['updated'],
+                         counts['added'], counts['removed'])
+            with metrics.timer('import.create_or_update'):
+                if self._batch is not None:
+                    result = self._create_or_update_package_deferred(
+                        package_dict, harvest_object)
+                else:
+                    result = self._create_or_update_package(
+                        package_dict, harvest_object,
+                        package_dict_form='package_show')
+            if result == 'unchanged':
+                metrics.incr('import.unchanged')
+            elif result:
+                metrics.incr('import.updated' if existing
+                             else 'import.created')
+
+            if result:
+                self._save_fingerprint(harvest_object, result, fingerprint)
 
             log.info(result)
             return result
@@ -573,164 +1484,341 @@ class DKANHarvester(HarvesterBase):
         except Exception, e:
             self._save_object_error('%s' % e, harvest_object, 'Import')
 
-    def _convert_dkan_package_to_ckan(self, package):
-        """
-        Function: Change the package dict's DKAN-style
-        to CKAN-style
-        Return: <dict>
-        """
-        resources = []
-        try:
-            if 'extras' not in package:
-                package['extras'] = []
-
-            if 'title' not in package:
-                raise ValueError("Dataset has not title")
-
-            if 'name' not in package:
-                package['name'] = munge.munge_title_to_name(package['title'])
-
-            if 'description' in package:
-                package['notes'] = package['description']
-
-            for license in model.Package.get_license_register().values():
-                if license.title == package['license_title']:
-                    package['license_id'] = license.id
-                    break
-
-            if 'private' not in package:
-                package['private'] = False
-            else:
-                package['private'] = True if package['private'] != 'Publicado' else False
-
-            package['state'] = package['state'].lower()
-            package['type'] = package['type'].lower()
-
-            if 'metadata_created' in package:
-                package['metadata_created'] = self._convert_date_package_handling_error(package, 'metadata_created')
+    def _get_import_metrics(self, harvest_object):
+        '''Returns the import metrics of the job of this harvest object.
 
-            if 'metadata_modified' in package:
-                package['metadata_modified'] = self._convert_date_package_handling_error(package, 'metadata_modified')
-
-            if 'revision_timestamp' in package:
-                package['revision_timestamp'] = self._convert_date_package_handling_error(package, 'revision_timestamp')
-
-            if 'resources' not in package:
-                raise ValueError('Dataset has no resources')
+        They are flushed every ``metrics_flush_every`` objects, once no
+        objects of the job are left to import and when a harvest object from
+        another job comes in, as there is no call at the end of the import of
+        a job.
+        '''
+        job_id = harvest_object.harvest_job_id
+        if self._metrics.stage != 'import' or self._metrics.job_id != job_id:
+            if self._metrics.stage == 'import':
+                self._metrics.flush()
+            self._metrics = Metrics(get_sinks(self.config.get('metrics')),
+                                    job_id, 'import')
+            self._metrics_pending = 0
+        return self._metrics
+
+    def _is_job_imported(self, harvest_object):
+        '''Checks if there are no objects of the job of this harvest object
+        waiting to be fetched and imported.'''
+        return model.Session.query(HarvestObject.id) \
+            .filter(HarvestObject.harvest_job_id ==
+                    harvest_object.harvest_job_id) \
+            .filter(HarvestObject.state == 'WAITING') \
+            .first() is None
+
+    def _save_gather_error(self, message, job):
+        self._metrics.incr('errors.gather')
+        super(DKANHarvester, self)._save_gather_error(message, job)
+
+    def _save_object_error(self, message, obj, stage=u'Fetch', line=None):
+        self._metrics.incr('errors.%s' % stage.lower())
+        if self._batch is not None:
+            # Saving it now would commit the batch, it is saved afterwards
+            self._batch.errors.append((message, obj, stage, line))
+            return
+        super(DKANHarvester, self)._save_object_error(message, obj, stage,
+                                                      line)
+
+    def _get_lookup_cache(self, harvest_object):
+        '''Returns the lookup cache for the job of this harvest object.
+
+        Groups, organizations and the harvest source dataset are the same for
+        most of the datasets of a job, so their lookups are cached until a
+        harvest object from another job comes in.
+        '''
+        job_id = harvest_object.harvest_job_id
+        if self._lookup_cache is None or self._lookup_cache_job_id != job_id:
+            self._lookup_cache = LookupCache(
+                max_size=int(self.config.get('lookup_cache_size', 1000)),
+                ttl=self.config.get('lookup_cache_ttl', 600))
+            self._lookup_cache_job_id = job_id
+            self._skipped_unchanged = 0
+        return self._lookup_cache
+
+    def _get_enrichment(self, harvest_object):
+        '''Returns the default tags, groups and extras of the source for the
+        job of this harvest object, with the extra templates parsed.
+
+        They are prepared again when a harvest object from another job, or
+        with another source config, comes in.
+        '''
+        key = (harvest_object.harvest_job_id, self.harvest_config.digest)
+        if self._enrichment is None or self._enrichment_key != key:
+            self._enrichment = Enrichment(self.harvest_config,
+                                          harvest_object.job)
+            self._enrichment_key = key
+        return self._enrichment
+
+    def _is_unchanged(self, harvest_object, fingerprint):
+        '''Checks if a dataset is the same as when it was last imported.
+
+        That is the case if the current harvest object for its GUID has the
+        same content fingerprint and its package still exists.
+        '''
+        if self.config.get('force_all', False) or \
+                not self.config.get('skip_unchanged', True):
+            return False
 
-            package = self._fix_tags(package)
+        previous = model.Session.query(HarvestObjectExtra.value) \
+            .join(HarvestObject,
+                  HarvestObjectExtra.harvest_object_id == HarvestObject.id) \
+            .join(model.Package, model.Package.id == HarvestObject.package_id) \
+            .filter(HarvestObject.guid == harvest_object.guid) \
+            .filter(HarvestObject.harvest_source_id ==
+                    harvest_object.harvest_source_id) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.id != harvest_object.id) \
+            .filter(HarvestObjectExtra.key == FINGERPRINT_EXTRA) \
+            .filter(model.Package.state == 'active') \
+            .first()
+        return previous is not None and previous[0] == fingerprint
+
+    def _will_update(self, package_dict, local_modified):
+        '''Checks if _create_or_update_package will update the existing
+        package, which it does not if the remote one was not modified after
+        it.'''
+        if 'metadata_modified' not in package_dict:
+            return True
+        local_modified = local_modified.isoformat() if local_modified \
+            else None
+        return not package_dict['metadata_modified'] <= local_modified
+
+    def _save_fingerprint(self, harvest_object, result, fingerprint):
+        '''Stores the fingerprint of the imported content on the current
+        harvest object for its GUID.
+
+        That is the object itself if its package was written. If the package
+        was left as it was, because the remote one was not modified, it is
+        the one that imported it, which may not have a fingerprint yet.
+        '''
+        if result == 'unchanged':
+            current = model.Session.query(HarvestObject.id) \
+                .filter(HarvestObject.guid == harvest_object.guid) \
+                .filter(HarvestObject.harvest_source_id ==
+                        harvest_object.harvest_source_id) \
+                .filter(HarvestObject.current == True) \
+                .filter(HarvestObject.id != harvest_object.id) \
+                .first()
+            if current is None:
+                return
+            harvest_object_id = current[0]
+            model.Session.query(HarvestObjectExtra) \
+                .filter(HarvestObjectExtra.harvest_object_id ==
+                        harvest_object_id) \
+                .filter(HarvestObjectExtra.key == FINGERPRINT_EXTRA) \
+                .delete(synchronize_session=False)
+        elif harvest_object.current:
+            harvest_object_id = harvest_object.id
+        else:
+            return
+        extra = HarvestObjectExtra(harvest_object_id=harvest_object_id,
+                                   key=FINGERPRINT_EXTRA, value=fingerprint)
+        if self._batch is not None:
+            extra.add()
+        else:
+            extra.save()
+
+    def _show_local(self, context, action, id_):
+        '''Calls a local *_show action and keeps only what import_stage uses.'''
+        data_dict = {'id': id_}
+        if action == 'package_show':
+            result = get_action(action)(context.copy(), data_dict)
+            return {'id': result['id'], 'owner_org': result.get('owner_org')}
+        # The datasets of the group are not needed, and can be a lot
+        data_dict['include_datasets'] = False
+        result = get_action(action)(context.copy(), data_dict)
+        return {'id': result['id'], 'name': result['name']}
+
+    def _get_remote(self, lookups, key, fetch):
+        return lookups.get_or_load(key, fetch, RemoteResourceError)
+
+    def _get_local_group(self, lookups, context, harvest_object, group_,
+                         create=False):
+        '''Returns the local group for a remote one as an id/name dict.
+
+        If the group does not exist locally it is created from the remote
+        group when ``create`` is True, otherwise None is returned.
+        '''
+        key = ('group', group_['id'])
+        try:
+            return lookups.get_or_load(
+                key,
+                lambda: self._show_local(context, 'group_show', group_['id']),
+                NotFound)
+        except NotFound:
+            log.info('Group %s is not available', group_)
+            if not create:
+                return None
 
-            for resource in package['resources']:
-                resource['description'] = resource['name']
+        with lookups.lock_for(key):
+            # It may have been created while waiting for the lock
+            group = lookups.get(key)
+            if group and group is not lookups.MISSING:
+                return group
 
-                if not resource.get('url', ''):
-                    next
+            try:
+                group = self._get_remote(
+                    lookups, ('remote_group', group_['id']),
+                    lambda: self._get_group(harvest_object.source.url,
+                                            group_))
+            except RemoteResourceError:
+                log.error('Could not get remote group %s', group_)
+                return None
 
-                if 'size' in resource:
-                    if type(resource['size']) == unicode or type(resource['size']) == str:
-                        clean_size = resource['size'].replace('KB', '').replace('MB', '').strip()
-                        try:
-                            resource['size'] = int(float(clean_size))
-                        except:
-                            log.error(u'Incorrect size file format Package: {0}, Resource: {1}'.format(package['name'], resource['name']))
-                            resource['size'] = 0
-                            return None
+            group = dict(group)
+            for key_ in ['packages', 'created', 'users', 'groups', 'tags',
+                         'extras', 'display_name']:
+                group.pop(key_, None)
 
-                self._convert_date_resource_handling_error(resource, 'created', package['name'])
-                self._convert_date_resource_handling_error(resource, 'last_modified', package['name'], last_modified=True)
+            try:
+                get_action('group_create')(context.copy(), group)
+                log.info('Group %s has been newly created', group_)
+            except ValidationError, e:
+                # Another import process may have just created it
+                try:
+                    group = self._show_local(context, 'group_show',
+                                             group['id'])
+                except NotFound:
+                    raise e
 
-                if 'revision_id' in resource:
-                    del resource['revision_id']
+            group = {'id': group['id'], 'name': group['name']}
+            lookups.set(key, group)
+            return group
 
-                if 'format' not in resource:
-                    resource['format'] = MIMETYPE_FORMATS.get(resource.get('mimetype'), '')
+    def _get_local_organization(self, lookups, context, harvest_object,
+                                remote_org, create=False):
+        '''Returns the id of the local organization for a remote one.
 
-                resources.append(resource)
+        If the organization does not exist locally it is created from the
+        remote organization when ``create`` is True, otherwise None is
+        returned.
+        '''
+        key = ('organization', remote_org)
+        try:
+            return lookups.get_or_load(
+                key,
+                lambda: self._show_local(context, 'organization_show',
+                                         remote_org),
+                NotFound)['id']
+        except NotFound:
+            log.info('Organization %s is not available', remote_org)
+            if not create:
+                return None
 
-            package['resources'] = resources
+        with lookups.lock_for(key):
+            # It may have been created while waiting for the lock
+            org = lookups.get(key)
+            if org and org is not lookups.MISSING:
+                return org['id']
 
-            if 'private' in package:
-                # DKAN appears to have datasets with private=True which are
-                # still public: https://github.com/NuCivic/dkan/issues/950. If
-                # they were really private then we'd not get be able to access
-                # them, so assume they are not private.
-                package['private'] = False
+            try:
+                try:
+                    org = self._get_remote(
+                        lookups, ('remote_org', remote_org),
+                        lambda: self._get_organization(
+                            harvest_object.source.url, remote_org))
+                except RemoteResourceError:
+                    # fallback if remote CKAN exposes organizations as groups
+                    # this especially targets older versions of CKAN
+                    org = self._get_remote(
+                        lookups, ('remote_group', remote_org),
+                        lambda: self._get_group(harvest_object.source.url,
+                                                {'id': remote_org}))
+
+                org = dict(org)
+                for key_ in ['packages', 'created', 'users', 'groups', 'tags',
+                             'extras', 'display_name', 'type']:
+                    org.pop(key_, None)
+                try:
+                    get_action('organization_create')(context.copy(), org)
+                    log.info('Organization %s has been newly created',
+                             remote_org)
+                except ValidationError, e:
+                    # Another import process may have just created it
+                    try:
+                        org = self._show_local(context, 'organization_show',
+                                               org['id'])
+                    except NotFound:
+                        raise e
+            except (RemoteResourceError, ValidationError):
+                log.error('Could not get remote org %s', remote_org)
+                return None
 
-            return package
-        except Exception, e:
-            log.error('Unable to get convert DKAN to CKAN package: %s' % e)
-            return None
+            lookups.set(key, {'id': org['id'], 'name': org['name']})
+            return org['id']
+
+    def _get_mapping(self):
+        '''Returns the mapping pipeline of the source, compiled from its
+        ``mapping`` spec (or the default one) once per harvest run.'''
+        if self._mapping is None:
+            self._mapping = compile_spec((self.config or {}).get('mapping'),
+                                         self._get_license_index(),
+                                         self._date_converter)
+        return self._mapping
+
+    def _log_rejections(self):
+        '''Logs the datasets that could not be converted in the gather
+        stage, by step and reason.'''
+        if not self._rejections:
+            return
+        reasons = collections.Counter((rejection.step, rejection.reason)
+                                      for rejection in self._rejections)
+        log.warning('%d remote datasets could not be converted: %s',
+                    len(self._rejections),
+                    '; '.join('%s (step %s): %d' % (reason, step, count)
+                              for (step, reason), count
+                              in reasons.most_common()))
+        for rejection in self._rejections:
+            log.debug('Dataset %s (%s) rejected in step %s: %s',
+                      rejection.package_id, rejection.name, rejection.step,
+                      rejection.reason)
 
-    def _convert_date_package_handling_error(self, package, key, last_modified=False):
-        """
-        Function: Convert package's format dates
-        Return: <string>
-        """
-        try:
-            return self._convert_date(package[key], last_modified=last_modified)
-        except:
-            log.error(
-                    u'Incorrect date metadata_created format in Package {0}: {1}'.format(package['name'], package[key])
-            )
-            return datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
-
-    def _convert_date_resource_handling_error(self, resource, key, package_name, last_modified=False):
+    def _convert_dkan_package_to_ckan(self, package):
         """
-        Function: Convert resources's format dates
-        Return: <string>
+        Function: Change the package dict's DKAN-style
+        to CKAN-style
+        Return: <dict>
         """
-        try:
-            return self._convert_date(resource[key], last_modified=last_modified)
-        except:
-            log.error(
-                u'Incorrect date last_modified format in Package: {0}, Source: {1} Date: {2}'.format(package_name, resource['name'], resource[key])
-            )
-            return datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+        packages, rejections = self._get_mapping().apply([package])
+        for rejection in rejections:
+            log.error('Unable to get convert DKAN to CKAN package: %s',
+                      rejection.reason)
+        return packages[0] if packages else None
 
     def _convert_date(self, date, last_modified=False):
         """
         Function: Convert generic format to ckan dates format
         Return: <string>
         """
-        try:
-            date_object = datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.%f")
-            return date
-        except:
-            pass
+        return self._date_converter.convert(date, last_modified=last_modified)
 
-        try:
-            date_object = datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S")
-            return date
-        except:
-            pass
 
-        date_correct_format = date.replace('Date changed\t', '')[4:].lstrip() if last_modified else date[4:].lstrip()
-        date_object = datetime.datetime.strptime(date_correct_format, '%m/%d/%Y - %H:%M:%S')
+class ImportBatch(object):
+    '''State of a chunk of harvest objects imported by import_stage_batch.'''
 
-        return date_object.strftime("%Y-%m-%dT%H:%M:%S.%f")
-
-    def _fix_tags(self, package_dict):
-        """
-        Function: Purge the vocabulary tags
-        Return: <dict>
-        """
-        tags = []
-        tag_aux = None
-
-        for tag in package_dict.get('tags', []):
-            tag_aux = tag
-            if 'vocabulary_id' in tag_aux:
-                tag_aux['vocabulary_id'] = None
-            tags.append(tag_aux)
-
-
-        package_dict['tags'] = tags
-
-        return package_dict
+    def __init__(self):
+        self.errors = []
+        self.package_ids = set()
+        self.imported = 0
 
 
 class ContentFetchError(Exception):
-    pass
+
+    def __init__(self, message='', status=None, timeout=False,
+                 retry_after=None, transient=False):
+        super(ContentFetchError, self).__init__(message)
+        # HTTP status of the response, if there was one
+        self.status = status
+        self.timeout = timeout
+        # Seconds the server asked to wait before trying again
+        self.retry_after = retry_after
+        # Whether the request may work if tried again (eg the connection was
+        # reset)
+        self.transient = transient
 
 
 class ContentNotFoundError(ContentFetchError):
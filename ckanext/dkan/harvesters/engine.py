@@ -0,0 +1,100 @@
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+log = __import__('logging').getLogger(__name__)
+
+ENGINES = ('threads', 'bounded')
+
+
+class Deadline(object):
+    '''Time budget shared by all the requests of a harvest stage.'''
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.expires = time.time() + seconds if seconds else None
+
+    def remaining(self):
+        '''Returns the seconds left, or None if there is no deadline.'''
+        if self.expires is None:
+            return None
+        return max(0, self.expires - time.time())
+
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+
+class ThreadEngine(object):
+    '''Makes the requests of a search from a pool of its own threads.
+
+    With a concurrency of 1 the requests are made one after the other in the
+    calling thread.
+    '''
+
+    def __init__(self, concurrency=1):
+        self.concurrency = concurrency
+        self._pool = ThreadPool(concurrency) if concurrency > 1 else None
+
+    def call(self, fetch, *args):
+        '''Makes a single request, such as a lookup, in the calling
+        thread.'''
+        return fetch(*args)
+
+    def imap(self, fetch, items):
+        '''Calls ``fetch`` for each item and yields the results in order,
+        each one as soon as it and the ones before it are done.'''
+        if self._pool is None:
+            return (fetch(item) for item in items)
+        return self._pool.imap(fetch, items)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+class BoundedEngine(ThreadEngine):
+    '''Makes the requests from a pool of threads that is kept for the life
+    of the process, with no more than ``concurrency`` requests in flight.
+
+    The bound covers the search pages as well as the lookups of groups,
+    organizations and datasets made through ``call``, from whichever thread
+    they come. Closing it does nothing, as it is used by later searches and
+    lookups too.
+    '''
+
+    def __init__(self, concurrency=32):
+        self.concurrency = concurrency
+        self._pool = ThreadPool(concurrency)
+        self._slots = threading.BoundedSemaphore(concurrency)
+
+    def imap(self, fetch, items):
+        return self._pool.imap(lambda item: self.call(fetch, item), items)
+
+    def call(self, fetch, *args):
+        with self._slots:
+            return fetch(*args)
+
+    def close(self):
+        pass
+
+
+_bounded_engines = {}
+_bounded_engines_lock = threading.Lock()
+
+
+def get_engine(name, concurrency):
+    '''Returns a fetch engine, ``name`` being one of ENGINES.
+
+    Bounded engines are created once per concurrency and shared by the
+    sources of the process that use the same one. Thread engines are new
+    each time and have to be closed after use.
+    '''
+    if name == 'threads':
+        return ThreadEngine(concurrency)
+    if name == 'bounded':
+        with _bounded_engines_lock:
+            if concurrency not in _bounded_engines:
+                _bounded_engines[concurrency] = BoundedEngine(concurrency)
+            return _bounded_engines[concurrency]
+    raise ValueError('Unknown fetch engine: %s' % name)
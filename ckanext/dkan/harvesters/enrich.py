@@ -0,0 +1,139 @@
+import re
+import string
+
+# Name of the value a placeholder refers to, eg "a" for "a.b" or "a[0]"
+_FIELD_ROOT_RE = re.compile(r'[^.[]*')
+
+
+class Template(object):
+    '''A default extra template with the job placeholders filled in.
+
+    The template is parsed once and what is left to do for each dataset is
+    formatting the placeholders that vary, such as ``{dataset_id}``. The
+    result is the same as ``template.format(**values)``.
+    '''
+
+    _formatter = string.Formatter()
+
+    def __init__(self, template, job_values):
+        self.template = template
+        self.job_values = job_values
+        # Literal strings and (field, format spec, conversion) tuples
+        self.parts = []
+        for literal, field, spec, conversion in \
+                self._formatter.parse(template):
+            if literal:
+                self._add_literal(literal)
+            if field is None:
+                continue
+            if _FIELD_ROOT_RE.match(field).group() in job_values and \
+                    '{' not in spec:
+                self._add_literal(
+                    self._format(field, spec, conversion, job_values))
+            else:
+                self.parts.append((field, spec, conversion))
+        # Empty templates are still templates
+        self._empty = template[:0]
+
+    def _add_literal(self, literal):
+        if self.parts and isinstance(self.parts[-1], basestring):
+            self.parts[-1] += literal
+        else:
+            self.parts.append(literal)
+
+    def _format(self, field, spec, conversion, values):
+        value = self._formatter.get_field(field, (), values)[0]
+        value = self._formatter.convert_field(value, conversion)
+        if '{' in spec:
+            spec = self._formatter.vformat(spec, (), values)
+        return self._formatter.format_field(value, spec)
+
+    def render(self, values):
+        '''Returns the template formatted with ``values``, the dataset
+        placeholders.'''
+        if len(self.parts) == 1 and isinstance(self.parts[0], basestring):
+            return self.parts[0]
+        values = dict(self.job_values, **values)
+        return self._empty.join(
+            part if isinstance(part, basestring)
+            else self._format(part[0], part[1], part[2], values)
+            for part in self.parts)
+
+
+class Enrichment(object):
+    '''The default tags, groups and extras of a harvest source, prepared
+    for the datasets of a job.
+
+    Templates are parsed once, and the tags, groups and extras of each
+    dataset are indexed by name, id and key so that merging the defaults
+    takes a single pass over them.
+    '''
+
+    def __init__(self, harvest_config, job):
+        self.default_tags = harvest_config.default_tags
+        self.default_tag_names = harvest_config.default_tag_names
+        self.default_group_dicts = harvest_config.default_group_dicts
+        self.default_group_ids = harvest_config.default_group_ids
+        self.override_extras = harvest_config.override_extras
+        job_values = {
+            'harvest_source_id': job.source.id,
+            'harvest_source_url': job.source.url.strip('/'),
+            'harvest_source_title': job.source.title,
+            'harvest_job_id': job.id,
+        }
+        self.default_extras = tuple(
+            (key, Template(value, job_values) if is_template else None,
+             value)
+            for key, value, is_template in harvest_config.default_extras)
+
+    def add_tags(self, package_dict):
+        if not self.default_tags:
+            return
+        tags = package_dict.setdefault('tags', [])
+        missing_tag_names = self.default_tag_names.difference(
+            tag.get('name') for tag in tags)
+        if missing_tag_names:
+            tags.extend(dict(tag) for tag in self.default_tags
+                        if tag.get('name') in missing_tag_names)
+
+    def add_groups(self, package_dict):
+        if not self.default_group_dicts:
+            return
+        groups = package_dict.setdefault('groups', [])
+        missing_group_ids = self.default_group_ids.difference(
+            group['id'] for group in groups)
+        if missing_group_ids:
+            groups.extend(dict(group) for group in self.default_group_dicts
+                          if group['id'] in missing_group_ids)
+
+    def add_extras(self, package_dict, harvest_object_id):
+        '''Adds the default extras, replacing the ones the dataset has if
+        ``override_extras`` is set. Replaced extras are moved to the end,
+        after the ones that are kept.'''
+        if not self.default_extras:
+            return
+        extras = package_dict.setdefault('extras', [])
+        # Index of the first extra with each key
+        index = {}
+        for i, extra in enumerate(extras):
+            index.setdefault(extra['key'], i)
+
+        values = None
+        replaced = set()
+        added = []
+        for key, template, value in self.default_extras:
+            if key in index:
+                if not self.override_extras:
+                    continue  # no need for the default
+                replaced.add(index[key])
+            if template is not None:
+                if values is None:
+                    values = {'harvest_object_id': harvest_object_id,
+                              'dataset_id': package_dict['id']}
+                value = template.render(values)
+            added.append({'key': key, 'value': value})
+
+        if replaced:
+            extras[:] = [extra for i, extra in enumerate(extras)
+                         if i not in replaced]
+        extras.extend(added)
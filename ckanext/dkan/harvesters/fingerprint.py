@@ -0,0 +1,21 @@
+import hashlib
+import json
+
+
+def content_fingerprint(package_dict, salt=None):
+    '''Returns a hash of the content of a package dict.
+
+    The dict is serialized with sorted keys and no extra whitespace, so the
+    same content always gives the same fingerprint regardless of the order
+    of the keys. ``salt`` (eg the hash of the harvest source configuration)
+    is hashed along with it, so that changing the configuration changes
+    every fingerprint.
+    '''
+    canonical = json.dumps(package_dict, sort_keys=True,
+                           separators=(',', ':'))
+    sha1 = hashlib.sha1()
+    if salt:
+        sha1.update(salt)
+        sha1.update('\n')
+    sha1.update(canonical)
+    return sha1.hexdigest()
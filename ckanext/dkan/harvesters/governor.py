@@ -0,0 +1,128 @@
+import email.utils
+import random
+import threading
+import time
+
+log = __import__('logging').getLogger(__name__)
+
+
+class TokenBucket(object):
+    '''Rate limiter allowing ``rate`` calls per second, in bursts of up to
+    ``burst`` calls.'''
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Waits until a call is allowed.'''
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostGovernor(object):
+    '''Limits the requests made to a remote host.
+
+    At most ``max_in_flight`` requests are made at the same time and, if
+    ``rate`` is given, no more than ``rate`` requests per second (with bursts
+    of ``burst``). When the host asks to slow down (``pause``) no request is
+    made until the time is up. A ``budget`` semaphore, shared with the
+    governors of other hosts, limits the requests made to all of them.
+    '''
+
+    def __init__(self, max_in_flight=4, rate=None, burst=1, budget=None):
+        self.max_in_flight = max_in_flight
+        self._semaphore = threading.Semaphore(max_in_flight)
+        self._bucket = TokenBucket(rate, burst) if rate else None
+        self._budget = budget
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Waits until a request can be made. ``release`` must follow.'''
+        self._semaphore.acquire()
+        try:
+            while True:
+                wait = self._paused_until - time.time()
+                if wait <= 0:
+                    break
+                time.sleep(wait)
+            if self._bucket:
+                self._bucket.acquire()
+            if self._budget:
+                self._budget.acquire()
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def release(self):
+        if self._budget:
+            self._budget.release()
+        self._semaphore.release()
+
+    def pause(self, seconds):
+        '''Holds back all the requests to the host for ``seconds``.'''
+        with self._lock:
+            self._paused_until = max(self._paused_until,
+                                     time.time() + seconds)
+
+
+def backoff_delay(attempt, base=1.0, max_delay=60.0, retry_after=None):
+    '''Returns the seconds to wait before retrying a failed request.
+
+    The delay doubles with each ``attempt`` (starting at 0) up to
+    ``max_delay``, and a random part of it is dropped so that the retries of
+    several workers do not all come at once. A ``retry_after`` sent by the
+    server takes precedence, as long as it is within ``max_delay``.
+    '''
+    if retry_after is not None:
+        return min(max_delay, max(0, retry_after))
+    delay = min(max_delay, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def parse_retry_after(value):
+    '''Returns the seconds in a Retry-After header, or None.
+
+    The header holds either a number of seconds or an HTTP date.
+    '''
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+def get_governor(host, max_in_flight=4, rate=None, burst=1, budget=None):
+    '''Returns the HostGovernor for ``host``, creating it if needed.
+
+    Governors are shared by all the harvest sources of the same host. They
+    are created again if the settings change.
+    '''
+    settings = (max_in_flight, rate, burst, budget)
+    with _governors_lock:
+        entry = _governors.get(host)
+        if entry is None or entry[0] != settings:
+            entry = _governors[host] = (
+                settings, HostGovernor(max_in_flight, rate, burst, budget))
+        return entry[1]
@@ -0,0 +1,138 @@
+import sqlite3
+import threading
+import time
+import zlib
+
+log = __import__('logging').getLogger(__name__)
+
+
+class CachedResponse(object):
+
+    def __init__(self, url, etag, last_modified, body):
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.body = body
+
+    def conditional_headers(self):
+        '''Headers to ask the server for the body only if it has changed.'''
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache(object):
+    '''Cache of HTTP responses stored in a SQLite database.
+
+    Only responses with an ETag or Last-Modified header are worth keeping,
+    as they can be revalidated with a conditional request. Bodies are
+    stored compressed. Once they take up more than ``max_size`` bytes the
+    least recently used ones are deleted.
+
+    The database can be shared by several harvest sources and processes.
+    Errors from the database are logged and otherwise ignored, so the cache
+    never makes a harvest fail.
+    '''
+
+    def __init__(self, path, max_size=100 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30,
+                                           check_same_thread=False)
+        self._connection.text_factory = str
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS response ('
+                'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+                'body BLOB, size INTEGER, accessed REAL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS response_accessed '
+                'ON response (accessed)')
+
+    def get(self, url):
+        '''Returns the CachedResponse for ``url``, or None.'''
+        try:
+            with self._lock:
+                row = self._connection.execute(
+                    'SELECT etag, last_modified, body FROM response '
+                    'WHERE url = ?', (url,)).fetchone()
+                if row is None:
+                    return None
+                with self._connection:
+                    self._connection.execute(
+                        'UPDATE response SET accessed = ? WHERE url = ?',
+                        (time.time(), url))
+            etag, last_modified, body = row
+            body = zlib.decompress(str(body))
+        except (sqlite3.Error, zlib.error), e:
+            log.warning('Could not read the response cache %s: %s',
+                        self.path, e)
+            return None
+        return CachedResponse(url, etag, last_modified, body)
+
+    def set(self, url, etag, last_modified, body):
+        '''Stores a response, evicting old ones if the cache gets too big.'''
+        compressed = zlib.compress(body)
+        if len(compressed) > self.max_size:
+            return
+        try:
+            with self._lock:
+                with self._connection:
+                    self._connection.execute(
+                        'INSERT OR REPLACE INTO response '
+                        '(url, etag, last_modified, body, size, accessed) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (url, etag, last_modified, sqlite3.Binary(compressed),
+                         len(compressed), time.time()))
+                    self._evict()
+        except sqlite3.Error, e:
+            log.warning('Could not write to the response cache %s: %s',
+                        self.path, e)
+
+    def _evict(self):
+        total = self._connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self._connection.execute(
+            'SELECT url, size FROM response ORDER BY accessed')
+        evicted = []
+        for url, size in rows:
+            if total <= self.max_size:
+                break
+            evicted.append((url,))
+            total -= size
+        self._connection.executemany('DELETE FROM response WHERE url = ?',
+                                     evicted)
+        log.debug('Evicted %d responses from the cache', len(evicted))
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(path, max_size):
+    '''Returns the ResponseCache for ``path``, opening it if needed.
+
+    Returns None if the cache can not be opened, in which case the harvest
+    goes on without it.
+    '''
+    with _caches_lock:
+        if path in _caches:
+            cache = _caches[path]
+        else:
+            try:
+                cache = ResponseCache(path, max_size)
+            except sqlite3.Error, e:
+                log.warning('Could not open the response cache %s, not '
+                            'using it: %s', path, e)
+                cache = None
+            # A cache that could not be opened is not tried again
+            _caches[path] = cache
+        if cache is not None:
+            cache.max_size = max_size
+        return cache
@@ -0,0 +1,116 @@
+import json
+
+WHITESPACE = ' \t\n\r'
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader(object):
+    '''Buffer over an iterator of string chunks.'''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, at_least=1):
+        '''Reads chunks until ``at_least`` more characters are available.
+
+        Returns False if the data ran out first.
+        '''
+        # Drop what has been consumed, so the buffer does not keep growing
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        target = len(self.buf) + at_least
+        pieces = [self.buf]
+        length = len(self.buf)
+        while length < target:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.eof = True
+                break
+            pieces.append(chunk)
+            length += len(chunk)
+        self.buf = ''.join(pieces)
+        return length >= target
+
+    def peek(self):
+        '''Returns the next non-whitespace character, or '' at the end.'''
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected %r at position %d, found %r' %
+                             (chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        '''Decodes the next JSON value.'''
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                value, end = None, None
+            # A value right at the end of the buffer may be cut short (eg a
+            # number), so it is only taken if something follows it
+            if end is not None and (end < len(self.buf) or self.eof):
+                self.pos = end
+                return value
+            if self.eof:
+                raise ValueError('Truncated JSON at position %d' % self.pos)
+            # Read at least as much again as is pending, so that a big value
+            # is not decoded from the start over and over
+            self.fill(max(len(self.buf) - self.pos, 65536))
+
+
+def iter_array_items(chunks, key='result'):
+    '''Yields the items of the array under ``key`` in a JSON object.
+
+    The JSON is read from ``chunks``, an iterable of strings such as the body
+    of an HTTP response, and only one item is decoded at a time. The other
+    members of the object are decoded and thrown away. If the array holds
+    a single array (as some DKAN versions return it), the items of that one
+    are yielded. Nothing is yielded if ``key`` is not found. Raises
+    ValueError if the JSON is not valid.
+    '''
+    reader = _Reader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        member = reader.value()
+        reader.expect(':')
+        if member != key:
+            reader.value()
+            if reader.expect(',}') == '}':
+                return
+            continue
+
+        if reader.peek() != '[':
+            # Not an array, it is decoded in one go
+            value = reader.value()
+            for item in (value if isinstance(value, list) else []):
+                yield item
+            return
+
+        reader.expect('[')
+        if reader.peek() == '[':
+            reader.expect('[')
+        if reader.peek() == ']':
+            return
+        while True:
+            yield reader.value()
+            if reader.expect(',]') == ']':
+                return
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from ckan import model
+
+log = __import__('logging').getLogger(__name__)
+
+# License titles used by Spanish-language DKAN portals, mapped to the ids of
+# the CKAN default licenses. Harvest sources can add their own with the
+# ``license_aliases`` setting.
+DEFAULT_LICENSE_ALIASES = {
+    u'Creative Commons Atribución': 'cc-by',
+    u'Creative Commons Atribución Compartir Igual': 'cc-by-sa',
+    u'Creative Commons Atribución-CompartirIgual': 'cc-by-sa',
+    u'Creative Commons No Comercial': 'cc-nc',
+    u'Creative Commons Dominio Público': 'cc-zero',
+    u'Licencia no especificada': 'notspecified',
+    u'No especificada': 'notspecified',
+    u'Otra (Abierta)': 'other-open',
+    u'Otra (Atribución)': 'other-at',
+    u'Otra (Dominio público)': 'other-pd',
+    u'Otra (No comercial)': 'other-nc',
+    u'Otra (No abierta)': 'other-closed',
+}
+
+
+def normalize_license_title(title):
+    '''Lower cases a license title and collapses its whitespace.'''
+    if isinstance(title, str):
+        title = title.decode('utf-8', 'replace')
+    return u' '.join(title.split()).lower()
+
+
+class LicenseIndex(object):
+    '''Maps remote license titles to the ids of the local licenses.
+
+    The index is built from the CKAN license register the first time it is
+    used and rebuilt whenever the register changes, so a harvest run only
+    pays for it once instead of scanning every license for every dataset.
+    Titles are compared case and whitespace insensitively, and ``aliases``
+    (title -> license id or title) are checked as well.
+    '''
+
+    def __init__(self, aliases=None):
+        self.aliases = dict(DEFAULT_LICENSE_ALIASES)
+        self.aliases.update(aliases or {})
+        self._signature = None
+        self._ids_by_title = {}
+
+    def get_license_id(self, title):
+        '''Returns the id of the license with this title, or None.'''
+        if not isinstance(title, basestring):
+            return None
+        self._refresh()
+        return self._ids_by_title.get(normalize_license_title(title))
+
+    def _refresh(self):
+        register = model.Package.get_license_register()
+        signature = (id(register), len(register))
+        if signature == self._signature:
+            return
+
+        ids_by_title = {}
+        license_ids = set()
+        for license in register.values():
+            license_ids.add(license.id)
+            if license.title:
+                ids_by_title.setdefault(
+                    normalize_license_title(license.title), license.id)
+
+        for alias, target in self.aliases.iteritems():
+            if target in license_ids:
+                license_id = target
+            else:
+                license_id = ids_by_title.get(normalize_license_title(target))
+            if license_id is None:
+                log.debug('Ignoring alias for unknown license %r', target)
+                continue
+            ids_by_title.setdefault(normalize_license_title(alias), license_id)
+
+        self._ids_by_title = ids_by_title
+        self._signature = signature
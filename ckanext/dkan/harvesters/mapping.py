@@ -0,0 +1,329 @@
+import collections
+import copy
+import datetime
+import time
+
+import ckan.lib.munge as munge
+
+log = __import__('logging').getLogger(__name__)
+
+MIMETYPE_FORMATS = {
+    'text/html': 'HTML',
+    'text/csv': 'CSV',
+    'text/xml': 'XML',
+    'application/pdf': 'PDF',
+    'application/zip': 'ZIP',
+    'application/rdf+xml': 'RDF',
+    'application/json': 'JSON',
+    'application/vnd.ms-excel': 'XLS',
+    'application/vnd.google-earth.kml+xml': 'KML',
+    'application/msword': 'DOC',
+}
+
+# How DKAN datasets are turned into CKAN ones, unless the harvest source
+# configures its own "mapping". Each step is a dict with the step type as
+# its key, and "resources": true for the steps applied to every resource.
+DEFAULT_SPEC = (
+    {'default': {'extras': []}},
+    {'require': ['title']},
+    {'munge_name': 'title'},
+    {'copy': {'notes': 'description'}},
+    {'require': ['license_title']},
+    {'license': 'license_title'},
+    {'private_unless': ['Publicado']},
+    {'lower': ['state', 'type']},
+    {'dates': ['metadata_created', 'metadata_modified',
+               'revision_timestamp']},
+    {'require': ['resources']},
+    {'purge_tag_vocabularies': True},
+    {'require': ['name'], 'resources': True},
+    {'copy': {'description': 'name'}, 'resources': True},
+    {'size': ['size'], 'resources': True},
+    {'check_dates': ['created'], 'resources': True},
+    {'check_dates': ['last_modified'], 'last_modified': True,
+     'resources': True},
+    {'drop': ['revision_id'], 'resources': True},
+    {'format_from_mimetype': MIMETYPE_FORMATS, 'resources': True},
+    # DKAN appears to have datasets with private=True which are still
+    # public: https://github.com/NuCivic/dkan/issues/950. If they were
+    # really private then we'd not get be able to access them, so assume
+    # they are not private.
+    {'set': {'private': False}},
+)
+
+# Options of a step that are not its type
+STEP_OPTIONS = frozenset(['resources', 'last_modified'])
+
+Rejection = collections.namedtuple('Rejection',
+                                   ['package_id', 'name', 'step', 'reason'])
+
+
+class Rejected(Exception):
+    '''Raised by a step when a dataset can not be harvested.'''
+
+
+class Step(object):
+
+    def __init__(self, name, function, resources=False):
+        self.name = name
+        self.function = function
+        self.resources = resources
+
+    def __call__(self, package):
+        if self.resources:
+            for resource in package.get('resources', ()):
+                self.function(resource)
+        else:
+            self.function(package)
+
+
+class Pipeline(object):
+    '''A mapping spec compiled into a flat list of steps.
+
+    Pages of datasets go through each step in turn, the whole page at once,
+    so the time taken by each step can be measured per page.
+    '''
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def apply(self, packages, metrics=None):
+        '''Converts a page of remote datasets, modifying them.
+
+        Returns the converted datasets and the Rejections of the ones that
+        could not be converted, which are left out. The time taken by each
+        step is recorded as ``mapping.<step name>`` timings in ``metrics``.
+        '''
+        packages = list(packages)
+        rejections = []
+        for step in self.steps:
+            started = time.time()
+            rejected = False
+            for i, package in enumerate(packages):
+                try:
+                    step(package)
+                except Exception, e:
+                    rejections.append(Rejection(
+                        package.get('id'), package.get('name'), step.name,
+                        e.message if isinstance(e, Rejected)
+                        else '%s: %s' % (e.__class__.__name__, e)))
+                    packages[i] = None
+                    rejected = True
+            if rejected:
+                packages = [p for p in packages if p is not None]
+            if metrics is not None:
+                metrics.timing('mapping.%s' % step.name,
+                               time.time() - started)
+        return packages, rejections
+
+
+def expand_spec(spec):
+    '''Returns the steps of a spec, replacing "default" by the default
+    spec.'''
+    steps = []
+    for step in spec or ['default']:
+        if step == 'default':
+            steps.extend(DEFAULT_SPEC)
+        else:
+            steps.append(step)
+    return steps
+
+
+def validate_spec(spec):
+    '''Raises ValueError if ``spec`` is not a valid mapping spec.'''
+    if not isinstance(spec, list):
+        raise ValueError('mapping must be a list of steps')
+    for step in expand_spec(spec):
+        if not isinstance(step, dict):
+            raise ValueError('mapping steps must be dictionaries or '
+                             '"default": %r' % (step,))
+        types = [key for key in step if key not in STEP_OPTIONS]
+        if len(types) != 1 or types[0] not in _STEP_TYPES:
+            raise ValueError('mapping step must have one of: %s: %r' %
+                             (', '.join(sorted(_STEP_TYPES)), step))
+
+
+def compile_spec(spec, license_index, date_converter):
+    '''Compiles a mapping spec into a Pipeline.
+
+    ``license_index`` finds license ids by title and ``date_converter``
+    converts the remote dates.
+    '''
+    context = {'license_index': license_index,
+               'date_converter': date_converter}
+    steps = []
+    names = collections.Counter()
+    for step in expand_spec(spec):
+        type_ = [key for key in step if key not in STEP_OPTIONS][0]
+        names[type_] += 1
+        name = type_ if names[type_] == 1 else '%s_%d' % (type_,
+                                                           names[type_])
+        function = _STEP_TYPES[type_](step[type_], step, context)
+        steps.append(Step(name, function, step.get('resources', False)))
+    return Pipeline(steps)
+
+
+# Step types. Each one takes the value and options of the step and returns
+# the function applied to every dataset, or resource.
+
+def _default(fields, step, context):
+    def default(item):
+        for key, value in fields.items():
+            if key not in item:
+                item[key] = copy.deepcopy(value)
+    return default
+
+
+def _set(fields, step, context):
+    def set_(item):
+        for key, value in fields.items():
+            item[key] = copy.deepcopy(value)
+    return set_
+
+
+def _require(keys, step, context):
+    what = 'Resource' if step.get('resources') else 'Dataset'
+
+    def require(item):
+        for key in keys:
+            if key not in item:
+                raise Rejected('%s has no %s' % (what, key))
+    return require
+
+
+def _copy(fields, step, context):
+    def copy_(item):
+        for target, source in fields.items():
+            if source in item:
+                item[target] = item[source]
+    return copy_
+
+
+def _drop(keys, step, context):
+    def drop(item):
+        for key in keys:
+            item.pop(key, None)
+    return drop
+
+
+def _lower(keys, step, context):
+    what = 'Resource' if step.get('resources') else 'Dataset'
+
+    def lower(item):
+        for key in keys:
+            if key not in item:
+                raise Rejected('%s has no %s' % (what, key))
+            item[key] = item[key].lower()
+    return lower
+
+
+def _munge_name(source, step, context):
+    def munge_name(item):
+        if 'name' not in item:
+            item['name'] = munge.munge_title_to_name(item[source])
+    return munge_name
+
+
+def _license(source, step, context):
+    license_index = context['license_index']
+
+    def license(item):
+        license_id = license_index.get_license_id(item[source])
+        if license_id:
+            item['license_id'] = license_id
+    return license
+
+
+def _private_unless(public_values, step, context):
+    public_values = frozenset(public_values)
+
+    def private_unless(item):
+        item['private'] = 'private' in item and \
+            item['private'] not in public_values
+    return private_unless
+
+
+def _dates(keys, step, context):
+    converter = context['date_converter']
+    last_modified = step.get('last_modified', False)
+
+    def dates(item):
+        for key in keys:
+            if key in item:
+                try:
+                    item[key] = converter.convert(
+                        item[key], last_modified=last_modified)
+                except Exception:
+                    log.error(u'Incorrect date %s format in Package %s: %s',
+                              key, item.get('name'), item[key])
+                    item[key] = datetime.datetime.now().strftime(
+                        '%Y-%m-%dT%H:%M:%S.%f')
+    return dates
+
+
+def _check_dates(keys, step, context):
+    converter = context['date_converter']
+    last_modified = step.get('last_modified', False)
+
+    def check_dates(item):
+        for key in keys:
+            if key not in item:
+                raise Rejected('Resource has no %s' % key)
+            try:
+                converter.convert(item[key], last_modified=last_modified)
+            except Exception:
+                log.error(u'Incorrect date %s format in Resource %s: %s',
+                          key, item.get('name'), item[key])
+    return check_dates
+
+
+def _size(keys, step, context):
+    def size(item):
+        for key in keys:
+            value = item.get(key)
+            if isinstance(value, basestring):
+                clean_size = value.replace('KB', '').replace('MB', '') \
+                    .strip()
+                try:
+                    item[key] = int(float(clean_size))
+                except ValueError:
+                    raise Rejected('Incorrect size file format in Resource '
+                                   '%s: %s' % (item.get('name'), value))
+    return size
+
+
+def _format_from_mimetype(formats, step, context):
+    def format_from_mimetype(item):
+        if 'format' not in item:
+            item['format'] = formats.get(item.get('mimetype'), '')
+    return format_from_mimetype
+
+
+def _purge_tag_vocabularies(enabled, step, context):
+    def purge_tag_vocabularies(item):
+        if not enabled:
+            return
+        tags = list(item.get('tags', []))
+        for tag in tags:
+            if 'vocabulary_id' in tag:
+                tag['vocabulary_id'] = None
+        item['tags'] = tags
+    return purge_tag_vocabularies
+
+
+_STEP_TYPES = {
+    'default': _default,
+    'set': _set,
+    'require': _require,
+    'copy': _copy,
+    'drop': _drop,
+    'lower': _lower,
+    'munge_name': _munge_name,
+    'license': _license,
+    'private_unless': _private_unless,
+    'dates': _dates,
+    'check_dates': _check_dates,
+    'size': _size,
+    'format_from_mimetype': _format_from_mimetype,
+    'purge_tag_vocabularies': _purge_tag_vocabularies,
+}
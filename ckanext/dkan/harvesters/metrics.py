@@ -0,0 +1,184 @@
+import contextlib
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+log = __import__('logging').getLogger(__name__)
+
+
+class Metrics(object):
+    '''Counters and timers of a harvest job stage.
+
+    Every counter and timing is kept for the summary of the stage and also
+    passed on to the ``sinks`` as it happens. ``flush`` hands the summary to
+    the sinks. It is safe to use from several threads.
+    '''
+
+    def __init__(self, sinks=None, job_id=None, stage=None):
+        self.sinks = list(sinks or ())
+        self.job_id = job_id
+        self.stage = stage
+        self.started = time.time()
+        self._counters = {}
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        for sink in self.sinks:
+            sink.incr(name, value)
+
+    def timing(self, name, seconds):
+        with self._lock:
+            count, total, maximum = self._timers.get(name, (0, 0.0, 0.0))
+            self._timers[name] = (count + 1, total + seconds,
+                                  max(maximum, seconds))
+        for sink in self.sinks:
+            sink.timing(name, seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        '''Times the ``with`` block, whether it raises or not.'''
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.timing(name, time.time() - started)
+
+    def summary(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timers = dict(
+                (name, {'count': count, 'total': round(total, 3),
+                        'mean': round(total / count, 3),
+                        'max': round(maximum, 3)})
+                for name, (count, total, maximum) in self._timers.items())
+        return {'job_id': self.job_id, 'stage': self.stage,
+                'elapsed': round(time.time() - self.started, 3),
+                'counters': counters, 'timers': timers}
+
+    def flush(self):
+        '''Passes the summary to the sinks.'''
+        if not self.sinks:
+            return
+        summary = self.summary()
+        for sink in self.sinks:
+            try:
+                sink.flush(summary)
+            except Exception, e:
+                log.warning('Could not write the harvest metrics to %r: %s',
+                            sink, e)
+
+
+class LoggingSink(object):
+    '''Logs the summary of each stage.'''
+
+    def incr(self, name, value):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def flush(self, summary):
+        timers = ', '.join(
+            '%s %.3fs/%d' % (name, timer['total'], timer['count'])
+            for name, timer in sorted(summary['timers'].items()))
+        counters = ', '.join('%s %s' % item
+                             for item in sorted(summary['counters'].items()))
+        log.info('Harvest job %s %s metrics after %.1fs: %s; timers (total/'
+                 'count): %s', summary['job_id'], summary['stage'],
+                 summary['elapsed'], counters or 'no counters',
+                 timers or 'none')
+
+
+class StatsdSink(object):
+    '''Sends counters and timings to statsd over UDP as they happen.
+
+    Sending is fire and forget, errors are ignored so that a missing statsd
+    server does not affect the harvest.
+    '''
+
+    def __init__(self, host='localhost', port=8125, prefix='ckanext.dkan'):
+        self.address = (host, int(port))
+        self.prefix = prefix.rstrip('.') + '.' if prefix else ''
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data, self.address)
+        except (socket.error, socket.gaierror):
+            pass
+
+    def incr(self, name, value):
+        self._send('%s%s:%d|c' % (self.prefix, name, value))
+
+    def timing(self, name, seconds):
+        self._send('%s%s:%d|ms' % (self.prefix, name, seconds * 1000))
+
+    def flush(self, summary):
+        pass
+
+    def __repr__(self):
+        return 'StatsdSink(%s:%d)' % self.address
+
+
+class FileSink(object):
+    '''Writes the summary of each stage to a JSON file per job and stage.
+
+    The file is ``<job id>-<stage>.json`` in ``directory`` and is replaced
+    every time the stage is flushed, so it always has the latest figures.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def incr(self, name, value):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def flush(self, summary):
+        path = os.path.join(self.directory, '%s-%s.json' % (
+            summary['job_id'], summary['stage']))
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+
+    def __repr__(self):
+        return 'FileSink(%s)' % self.directory
+
+
+_statsd_sinks = {}
+_statsd_sinks_lock = threading.Lock()
+
+
+def get_sinks(metrics_config):
+    '''Returns the sinks for the ``metrics`` setting of a harvest source.
+
+    The setting is a dictionary, where ``log`` (default true) logs the
+    summary of each stage, ``statsd`` ("host:port") sends the metrics to
+    statsd, ``prefix`` is the statsd prefix and ``dir`` is a directory to
+    write the summaries to.
+    '''
+    metrics_config = metrics_config or {}
+    sinks = []
+    if metrics_config.get('log', True):
+        sinks.append(LoggingSink())
+    if metrics_config.get('statsd'):
+        host, _, port = metrics_config['statsd'].partition(':')
+        key = (host, int(port or 8125),
+               metrics_config.get('prefix', 'ckanext.dkan'))
+        # One socket per statsd server, rather than one per job
+        with _statsd_sinks_lock:
+            if key not in _statsd_sinks:
+                _statsd_sinks[key] = StatsdSink(*key)
+            sinks.append(_statsd_sinks[key])
+    if metrics_config.get('dir'):
+        sinks.append(FileSink(metrics_config['dir']))
+    return sinks
@@ -0,0 +1,75 @@
+log = __import__('logging').getLogger(__name__)
+
+
+class AdaptivePager(object):
+    '''Chooses the number of datasets to ask for in each search page.
+
+    It starts with ``page_size`` and, within ``min_size`` and ``max_size``:
+
+    * halves the page size when a page takes longer than ``target_seconds``
+      or is bigger than ``max_bytes``, or when a request times out or gets
+      a server error (see ``shrink``)
+    * doubles it when full pages come back in less than half that time and
+      size
+    * never asks for more than the remote returned in a full page again, as
+      that is the maximum page size of the remote (see ``cap``)
+    '''
+
+    def __init__(self, page_size=100, min_size=10, max_size=1000,
+                 target_seconds=10.0, max_bytes=None):
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.limit = min(max(page_size, self.min_size), self.max_size)
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+
+    def record(self, limit, elapsed, size, count):
+        '''Adjusts the page size after a page of ``limit`` datasets.
+
+        ``elapsed`` is the time the request took, ``size`` the length of the
+        response and ``count`` the number of datasets it contained. Several
+        pages requested with the same limit do not compound each other.
+        '''
+        too_slow = self.target_seconds and elapsed > self.target_seconds
+        too_big = self.max_bytes and size > self.max_bytes
+        if too_slow or too_big:
+            new_limit = max(self.min_size, limit // 2)
+            if new_limit < self.limit:
+                log.info('Page of %d datasets took %.1fs (%d bytes), '
+                         'reducing the page size to %d',
+                         limit, elapsed, size, new_limit)
+                self.limit = new_limit
+            return
+
+        # Only full pages say anything about how bigger ones would do
+        if count < limit:
+            return
+        fast = not self.target_seconds or elapsed < self.target_seconds / 2
+        small = not self.max_bytes or size < self.max_bytes / 2
+        if fast and small:
+            new_limit = min(self.max_size, limit * 2)
+            if new_limit > self.limit:
+                log.debug('Increasing the page size to %d', new_limit)
+                self.limit = new_limit
+
+    def shrink(self):
+        '''Halves the page size after a failed request.
+
+        The page size will not grow back to the size that failed. Returns
+        False if it is already at the minimum, in which case there is no
+        point in trying again.
+        '''
+        if self.limit <= self.min_size:
+            return False
+        self.limit = max(self.min_size, self.limit // 2)
+        self.max_size = self.limit
+        return True
+
+    def cap(self, max_size):
+        '''Sets the maximum page size the remote is known to support.'''
+        max_size = max(self.min_size, max_size)
+        if max_size < self.max_size:
+            log.info('The remote returns at most %d datasets per page',
+                     max_size)
+            self.max_size = max_size
+            self.limit = min(self.limit, max_size)
@@ -0,0 +1,64 @@
+import json
+
+# Fields set by the local CKAN, which say nothing about the remote resource
+IGNORED_FIELDS = frozenset(['id', 'package_id', 'position', 'revision_id',
+                            'url_type', 'tracking_summary'])
+
+
+def _normalize(value):
+    if value is None:
+        return u''
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, sort_keys=True)
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return unicode(value).strip()
+
+
+def resource_changed(remote, local):
+    '''Checks if the fields of a remote resource differ from the local one.
+
+    Only the fields of the remote resource are compared, a missing field
+    being the same as an empty one and numbers the same as their text.
+    '''
+    return any(_normalize(value) != _normalize(local.get(key))
+               for key, value in remote.items() if key not in IGNORED_FIELDS)
+
+
+def diff_resources(remote_resources, local_resources):
+    '''Works out which remote resources changed since they were imported.
+
+    Remote resources are matched to the local ones by id, or else by URL.
+    Returns the resources to save for the dataset and the number of them
+    unchanged, updated, added and removed. Unchanged resources are returned
+    as they are locally, so saving them writes nothing, and updated ones
+    take the id of the local resource they replace.
+    '''
+    by_id = dict((resource['id'], resource) for resource in local_resources)
+    by_url = {}
+    for resource in local_resources:
+        if resource.get('url'):
+            by_url.setdefault(_normalize(resource['url']), resource)
+
+    counts = {'unchanged': 0, 'updated': 0, 'added': 0, 'removed': 0}
+    matched = set()
+    resources = []
+    for remote in remote_resources:
+        local = by_id.get(remote.get('id'))
+        if local is None or local['id'] in matched:
+            local = by_url.get(_normalize(remote.get('url')))
+        if local is None or local['id'] in matched:
+            counts['added'] += 1
+            resources.append(remote)
+            continue
+        matched.add(local['id'])
+        if resource_changed(remote, local):
+            counts['updated'] += 1
+            resources.append(dict(remote, id=local['id']))
+        else:
+            counts['unchanged'] += 1
+            local = dict(local)
+            local.pop('revision_id', None)
+            resources.append(local)
+    counts['removed'] = len(by_id) - len(matched)
+    return resources, counts
@@ -0,0 +1,206 @@
+import datetime
+import multiprocessing
+import threading
+import urlparse
+
+from sqlalchemy import func
+
+from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest.model import HarvestGatherError, HarvestJob, \
+    HarvestObject, HarvestSource
+from ckanext.harvest.queue import get_fetch_publisher
+from ckan import model
+from ckan.plugins import PluginImplementations
+
+from ckanext.dkan.harvesters.dkanharvester import DKANHarvester
+
+log = __import__('logging').getLogger(__name__)
+
+
+class GatherTask(object):
+    '''A harvest job waiting to be gathered by the runner.
+
+    ``changed`` is the mean number of datasets gathered and ``seconds`` the
+    mean duration of the last gathers of its source, None if it has never
+    been gathered.
+    '''
+
+    def __init__(self, job_id, source_id, url, changed=None, seconds=None):
+        self.job_id = job_id
+        self.source_id = source_id
+        self.host = urlparse.urlsplit(url).netloc.lower()
+        self.changed = changed
+        self.seconds = seconds
+
+    @property
+    def priority(self):
+        '''Higher goes first.
+
+        Sources never gathered go first, as nothing is known about them. The
+        others go by the datasets they usually change and how long they take,
+        so sources with many changes are fresh sooner and slow sources do
+        not start last and hold up the end of the run.
+        '''
+        if self.changed is None:
+            return float('inf')
+        return (self.changed + 1) * max(self.seconds, 1)
+
+    def __repr__(self):
+        return 'GatherTask(%s, %s)' % (self.job_id, self.host)
+
+
+def run_gathers(tasks, gather, workers=8, initializer=None, initargs=()):
+    '''Calls ``gather(task)`` for each task from a pool of ``workers``
+    processes and returns the results by job id, None for the failed ones.
+
+    Tasks start in priority order, but each host gets a fair share of the
+    workers: a host can not take more than its part of them while the
+    tasks of other hosts wait. Harvesters are singletons with the state of
+    the job being run, hence processes rather than threads. ``gather`` must
+    be a module level function, ``initializer`` is called with
+    ``initargs`` when each process starts.
+    '''
+    pending = sorted(tasks, key=lambda task: task.priority, reverse=True)
+    running = {}
+    results = {}
+    done = threading.Condition()
+
+    def finished(outcome):
+        task, result = outcome
+        with done:
+            results[task.job_id] = result
+            running[task.host] -= 1
+            done.notify()
+
+    pool = multiprocessing.Pool(workers, initializer, initargs)
+    try:
+        with done:
+            while pending or sum(running.values()):
+                task = None
+                if pending and sum(running.values()) < workers:
+                    hosts = set(task_.host for task_ in pending) | \
+                        set(host for host, count in running.items() if count)
+                    share = max(1, workers // len(hosts))
+                    task = next((task_ for task_ in pending
+                                 if running.get(task_.host, 0) < share), None)
+                if task is None:
+                    done.wait()
+                    continue
+                pending.remove(task)
+                running[task.host] = running.get(task.host, 0) + 1
+                log.info('Gathering harvest job %s from %s (%d running, %d '
+                         'waiting)', task.job_id, task.host,
+                         sum(running.values()), len(pending))
+                pool.apply_async(_run_task, (gather, task),
+                                 callback=finished)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def _run_task(gather, task):
+    try:
+        return task, gather(task)
+    except Exception:
+        log.exception('Gather of harvest job %s failed', task.job_id)
+        return task, None
+
+
+def get_gather_tasks(source_type, runs=5):
+    '''Returns the GatherTasks for the new jobs of the active sources of
+    ``source_type``, with the history of their last ``runs`` gathers.'''
+    jobs = model.Session.query(HarvestJob.id, HarvestSource.id,
+                               HarvestSource.url) \
+        .join(HarvestSource, HarvestJob.source_id == HarvestSource.id) \
+        .filter(HarvestJob.status == u'New') \
+        .filter(HarvestSource.type == source_type) \
+        .filter(HarvestSource.active == True) \
+        .all()
+    if not jobs:
+        return []
+
+    history = {}
+    rows = model.Session.query(HarvestJob.source_id,
+                               HarvestJob.gather_started,
+                               HarvestJob.gather_finished,
+                               func.count(HarvestObject.id)) \
+        .outerjoin(HarvestObject,
+                   HarvestObject.harvest_job_id == HarvestJob.id) \
+        .filter(HarvestJob.source_id.in_(set(job[1] for job in jobs))) \
+        .filter(HarvestJob.gather_finished != None) \
+        .group_by(HarvestJob.id, HarvestJob.source_id,
+                  HarvestJob.gather_started, HarvestJob.gather_finished) \
+        .order_by(HarvestJob.gather_started.desc())
+    for source_id, started, finished, objects in rows:
+        source_history = history.setdefault(source_id, [])
+        if len(source_history) < runs:
+            source_history.append(
+                (objects, (finished - started).total_seconds()))
+
+    tasks = []
+    for job_id, source_id, url in jobs:
+        task = GatherTask(job_id, source_id, url)
+        if history.get(source_id):
+            gathers = history[source_id]
+            task.changed = float(sum(g[0] for g in gathers)) / len(gathers)
+            task.seconds = sum(g[1] for g in gathers) / len(gathers)
+        tasks.append(task)
+    return tasks
+
+
+def start_jobs(tasks):
+    '''Sets the jobs of the tasks as running, so the harvest queue does not
+    send them to the gather consumer as well.'''
+    for task in tasks:
+        job = HarvestJob.get(task.job_id)
+        job.status = u'Running'
+        job.save()
+
+
+def init_worker(request_budget):
+    '''Sets up a runner process, ``request_budget`` being a semaphore that
+    limits the requests in flight from all the processes.'''
+    DKANHarvester._request_budget = request_budget
+
+
+def gather_job(task):
+    '''Gathers the harvest job of a task and queues its harvest objects to
+    be fetched, the same way as the gather consumer of the harvest queue.
+    The objects of the sources with ``batch_import`` set are not queued, as
+    they are left to the ``dkan-harvester import-batch`` command.
+
+    Returns the number of harvest objects gathered, or None if the gather
+    stage failed.
+    '''
+    job = HarvestJob.get(task.job_id)
+    publisher = get_fetch_publisher()
+    try:
+        harvester = next(harvester_
+                         for harvester_ in PluginImplementations(IHarvester)
+                         if harvester_.info()['name'] == job.source.type)
+        job.gather_started = datetime.datetime.utcnow()
+        try:
+            object_ids = harvester.gather_stage(job)
+        finally:
+            job.gather_finished = datetime.datetime.utcnow()
+            job.save()
+        if not isinstance(object_ids, list):
+            # There is nothing to gather too when no datasets changed since
+            # the last harvest, which is not an error
+            if model.Session.query(HarvestGatherError.id) \
+                    .filter(HarvestGatherError.harvest_job_id == job.id) \
+                    .first() is None:
+                return 0
+            log.error('Gather stage failed for harvest job %s', task.job_id)
+            return None
+        if (getattr(harvester, 'config', None) or {}).get('batch_import'):
+            log.info('Leaving the %d harvest objects of job %s to be '
+                     'imported in batches', len(object_ids), task.job_id)
+            return len(object_ids)
+        for object_id in object_ids:
+            publisher.send({'harvest_object_id': object_id})
+        return len(object_ids)
+    finally:
+        publisher.close()
+        model.Session.remove()
@@ -0,0 +1,334 @@
+"""Microbenchmarks for the DKAN to CKAN conversion hot paths.
+
+Run them with::
+
+    python -m ckanext.dkan.tests.benchmark
+    python -m ckanext.dkan.tests.benchmark --save     # store a baseline
+    python -m ckanext.dkan.tests.benchmark --compare  # check against it
+
+Each benchmark reports its throughput (items per second, best of several
+rounds) and the number of objects allocated per item. The latter is the net
+number of objects tracked by the garbage collector that each item leaves
+behind, which is stable from run to run unlike the timings.
+
+With ``--compare`` the exit status is 1 if a benchmark got slower or
+allocates more than the baseline allows, so it can be used in CI. Timings
+depend on the machine, so baselines should be saved on the machine they are
+compared on.
+
+The fixtures are synthetic DKAN datasets: many resources, DKAN style dates,
+sizes like "12 KB", vocabulary tags and English and Spanish license titles.
+The CKAN license register is replaced with a fixed one, so no database or
+network access is needed.
+"""
+import argparse
+import copy
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import mock
+
+from ckan import model
+
+from ckanext.dkan.harvesters.dates import DateConverter
+from ckanext.dkan.harvesters.dkanharvester import DKANHarvester
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__),
+                                'benchmark_baseline.json')
+
+LICENSES = [
+    ('cc-by', 'Creative Commons Attribution'),
+    ('cc-by-sa', 'Creative Commons Attribution Share-Alike'),
+    ('cc-zero', 'Creative Commons CCZero'),
+    ('cc-nc', 'Creative Commons Non-Commercial (Any)'),
+    ('odc-odbl', 'Open Data Commons Open Database License (ODbL)'),
+    ('notspecified', 'License not specified'),
+    ('other-open', 'Other (Open)'),
+]
+
+LICENSE_TITLES = [title for license_id, title in LICENSES] + [
+    u'Creative Commons Atribuci\xf3n',
+    u'Otra (Abierta)',
+    u'creative commons  attribution',
+    u'Some unknown license',
+]
+
+MIMETYPES = ['text/csv', 'application/json', 'application/vnd.ms-excel',
+             'application/pdf', 'application/zip', 'text/html', None]
+
+
+class FakeLicense(object):
+
+    def __init__(self, id, title):
+        self.id = id
+        self.title = title
+
+
+LICENSE_REGISTER = dict((license_id, FakeLicense(license_id, title))
+                        for license_id, title in LICENSES)
+
+
+def dkan_date(rnd):
+    return 'Sat, %02d/%02d/20%02d - %02d:%02d:%02d' % (
+        rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(10, 19),
+        rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+
+
+def iso_date(rnd):
+    return '20%02d-%02d-%02dT%02d:%02d:%02d' % (
+        rnd.randint(10, 19), rnd.randint(1, 12), rnd.randint(1, 28),
+        rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+
+
+def make_dates(count, seed=0):
+    '''Returns a list of (date, last_modified) as found in DKAN datasets.'''
+    rnd = random.Random(seed)
+    dates = []
+    for i in range(count):
+        kind = rnd.random()
+        if kind < 0.5:
+            dates.append((dkan_date(rnd), False))
+        elif kind < 0.8:
+            dates.append((iso_date(rnd), False))
+        else:
+            dates.append(('Date changed\t' + dkan_date(rnd), True))
+    return dates
+
+
+def make_package(rnd, i, resources=20):
+    '''Returns a synthetic package dict as returned by the DKAN API.'''
+    package = {
+        'id': 'b0c6e5a4-%04d-4c4d-9c7e-%012d' % (i % 10000, i),
+        'name': 'dataset-%d' % i,
+        'title': u'Conjunto de datos %d' % i,
+        'description': u'<p>Descripci\xf3n del conjunto %d</p>' % i * 5,
+        'license_title': rnd.choice(LICENSE_TITLES),
+        'state': 'Active',
+        'type': 'Dataset',
+        'private': rnd.choice(['Publicado', 'Borrador']),
+        'metadata_created': dkan_date(rnd),
+        'metadata_modified': dkan_date(rnd),
+        'revision_timestamp': dkan_date(rnd),
+        'author': 'Author %d' % i,
+        'organization': {'id': 'org-%d' % (i % 20), 'name': 'org-%d' % (i % 20),
+                         'title': 'Organization %d' % (i % 20)},
+        'groups': [{'id': 'group-%d' % (i % 7), 'name': 'group-%d' % (i % 7)}],
+        'tags': [{'id': 'tag-%d' % t, 'name': 'tag %d' % t,
+                  'vocabulary_id': 'vocab-%d' % (t % 3)}
+                 for t in rnd.sample(range(100), 6)],
+        'extras': [],
+        'resources': [],
+    }
+    for r in range(resources):
+        mimetype = rnd.choice(MIMETYPES)
+        resource = {
+            'id': '%s-%d' % (package['id'], r),
+            'name': u'Recurso %d' % r,
+            'url': 'http://example.com/datasets/%d/resource-%d' % (i, r),
+            'size': '%s %s' % (rnd.choice(['12', '3.5', '812', '0.3']),
+                               rnd.choice(['KB', 'MB'])),
+            'created': dkan_date(rnd),
+            'last_modified': 'Date changed\t' + dkan_date(rnd),
+            'revision_id': 'rev-%d' % r,
+        }
+        if mimetype:
+            resource['mimetype'] = mimetype
+        package['resources'].append(resource)
+    return package
+
+
+def make_packages(count, resources=20, seed=0):
+    rnd = random.Random(seed)
+    return [make_package(rnd, i, resources) for i in range(count)]
+
+
+def measure(run, setup, items, rounds):
+    '''Runs ``run(setup())`` ``rounds`` times and returns the results.
+
+    ``setup`` prepares the input of each round, so that building it is not
+    measured. Returns (items per second of the best round, objects per item).
+    '''
+    best = None
+    allocations = None
+    for i in range(rounds):
+        data = setup()
+        gc.collect()
+        gc.disable()
+        try:
+            before = len(gc.get_objects())
+            started = time.time()
+            result = run(data)
+            elapsed = time.time() - started
+            after = len(gc.get_objects())
+        finally:
+            gc.enable()
+        del result, data
+        best = elapsed if best is None else min(best, elapsed)
+        allocations = after - before if allocations is None \
+            else min(allocations, after - before)
+    return items / max(best, 1e-9), float(allocations) / items
+
+
+def bench_convert_package(harvester, packages, rounds):
+    def setup():
+        return copy.deepcopy(packages)
+
+    def run(data):
+        return [harvester._convert_dkan_package_to_ckan(p) for p in data]
+
+    return measure(run, setup, len(packages), rounds)
+
+
+def bench_convert_date(harvester, dates, rounds):
+    def setup():
+        # Start each round with a cold cache, as a new harvest job would
+        harvester._date_converter = DateConverter()
+        return dates
+
+    def run(data):
+        return [harvester._convert_date(date, last_modified=last_modified)
+                for date, last_modified in data]
+
+    return measure(run, setup, len(dates), rounds)
+
+
+def bench_convert_page(harvester, packages, rounds, page_size=100):
+    '''Converts ``packages`` a page at a time, as the gather stage does.'''
+    def setup():
+        data = copy.deepcopy(packages)
+        return [data[i:i + page_size]
+                for i in range(0, len(data), page_size)]
+
+    def run(pages):
+        mapping = harvester._get_mapping()
+        return [mapping.apply(page)[0] for page in pages]
+
+    return measure(run, setup, len(packages), rounds)
+
+
+def bench_search_dedup(harvester, packages, rounds, page_size=100,
+                       overlap=10):
+    '''Pages through ``packages`` with ``_search_for_datasets``.
+
+    Each page repeats the last ``overlap`` datasets of the previous one, as
+    happens when datasets are added while paging, so the duplicates have to
+    be weeded out.
+    '''
+    harvester.config = {'page_size': page_size, 'page_size_min': page_size,
+                        'page_size_max': page_size,
+                        'page_target_seconds': None}
+
+    def setup():
+        pages = {}
+        offset = 0
+        while offset < len(packages):
+            start = max(0, offset - overlap)
+            pages[offset] = copy.deepcopy(packages[start:start + page_size])
+            offset += len(pages[offset])
+        return pages
+
+    def run(pages):
+        def fetch(url):
+            offset = int(url.rsplit('offset=', 1)[1].split('&')[0])
+            page = pages.get(offset, [])
+            return page, str(offset), 0, None, 0.0
+
+        harvester._fetch_search_page = fetch
+        try:
+            return [p for page in
+                    harvester._search_for_datasets('http://dkan.example.com')
+                    for p in page]
+        finally:
+            del harvester._fetch_search_page
+
+    return measure(run, setup, len(packages), rounds)
+
+
+def run_benchmarks(packages=500, resources=20, rounds=5):
+    harvester = DKANHarvester()
+    harvester.config = {}
+    fixtures = make_packages(packages, resources)
+    dates = make_dates(packages * resources)
+
+    results = {}
+    with mock.patch.object(model.Package, 'get_license_register',
+                           return_value=LICENSE_REGISTER):
+        for name, bench, data in (
+                ('convert_package', bench_convert_package, fixtures),
+                ('convert_date', bench_convert_date, dates),
+                ('convert_page', bench_convert_page, fixtures),
+                ('search_dedup', bench_search_dedup, fixtures)):
+            items_per_sec, allocations = bench(harvester, data, rounds)
+            results[name] = {'items_per_sec': round(items_per_sec, 1),
+                             'allocations_per_item': round(allocations, 2)}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Returns the descriptions of the regressions against ``baseline``.'''
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['items_per_sec'] < \
+                base['items_per_sec'] * (1 - tolerance):
+            regressions.append('%s: %.1f items/s, baseline %.1f' % (
+                name, result['items_per_sec'], base['items_per_sec']))
+        # Allocations are deterministic, any meaningful increase counts
+        if result['allocations_per_item'] > \
+                base['allocations_per_item'] * 1.05 + 0.5:
+            regressions.append('%s: %.2f allocations/item, baseline %.2f' % (
+                name, result['allocations_per_item'],
+                base['allocations_per_item']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--packages', type=int, default=500)
+    parser.add_argument('--resources', type=int, default=20,
+                        help='resources per package')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare the results with the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown allowed by --compare (default 0.2)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.packages, args.resources, args.rounds)
+    for name, result in sorted(results.items()):
+        print '%-16s %12.1f items/s %10.2f allocations/item' % (
+            name, result['items_per_sec'], result['allocations_per_item'])
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'packages': args.packages,
+                       'resources': args.resources,
+                       'results': results}, f, indent=2, sort_keys=True)
+        print 'Baseline saved to %s' % args.baseline
+
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print 'REGRESSION %s' % regression
+        if regressions:
+            return 1
+        print 'No regressions against %s' % args.baseline
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
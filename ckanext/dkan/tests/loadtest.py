@@ -0,0 +1,415 @@
+"""Load test of the DKAN harvester against a local stub DKAN portal.
+
+Run it with::
+
+    python -m ckanext.dkan.tests.loadtest --datasets 100000
+    python -m ckanext.dkan.tests.loadtest --datasets 20000 --latency 0.05 \\
+        --error-rate 0.01 --inserts 50 --config '{"gather_workers": 4}'
+
+An in-process HTTP server emulates the DKAN API endpoints used by the
+harvester (``current_package_list_with_resources``, ``package_list``,
+``group_show`` and ``organization_show``). The number of datasets, their
+size, the latency of the responses, the rate of server errors and datasets
+inserted while the harvester pages through them can be set.
+
+``DKANHarvester.gather_stage`` and ``import_stage`` are then run against it
+with the CKAN side (database session, harvest objects and actions) replaced
+by an in-memory stub, so only the harvester itself is measured. The report
+has the wall time of each stage, the requests per endpoint, the peak RSS of
+the process (server included) and how many datasets were gathered twice or
+missed.
+
+The server runs in the same process, so it competes with the harvester for
+the GIL: use ``--latency`` to model a remote portal rather than relying on
+the absolute throughput.
+"""
+import argparse
+import BaseHTTPServer
+import collections
+import gzip
+import json
+import random
+import resource
+import socket
+import SocketServer
+import StringIO
+import sys
+import threading
+import time
+import urlparse
+
+import mock
+
+from ckan.logic import NotFound, ValidationError
+
+from ckanext.dkan.harvesters import dkanharvester
+from ckanext.dkan.harvesters.dkanharvester import DKANHarvester
+from ckanext.dkan.tests.benchmark import make_package
+
+ACTION_PATH = '/api/3/action/'
+
+
+class StubDKANPortal(object):
+    '''The datasets of the stub portal and how it behaves.
+
+    Datasets are generated from their number when requested, so a portal
+    with lots of them takes little memory. Every search request inserts one
+    of the ``inserts`` new datasets at a random position, until they run
+    out.
+    '''
+
+    def __init__(self, datasets=1000, resources=5, payload_size=0,
+                 latency=0.0, error_rate=0.0, inserts=0, seed=0):
+        self.order = range(datasets)
+        self.next_number = datasets
+        self.resources = resources
+        self.payload_size = payload_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.inserts = inserts
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.served = collections.Counter()
+
+    def dataset(self, number):
+        package = make_package(random.Random(number), number, self.resources)
+        package['owner_org'] = package['organization']['name']
+        if self.payload_size:
+            package['notes'] = 'x' * self.payload_size
+        return package
+
+    def dataset_ids(self):
+        with self.lock:
+            return set(self.dataset(number)['id'] for number in self.order)
+
+    def handle(self, action, params):
+        '''Returns the (status, response dict) for an API request.'''
+        with self.lock:
+            self.requests[action] += 1
+            failed = self.error_rate and \
+                self.random.random() < self.error_rate
+            if failed:
+                self.errors[action] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return 500, {'success': False, 'error': 'Stub server error'}
+
+        if action == 'current_package_list_with_resources':
+            offset = int(params.get('offset', 0))
+            limit = int(params.get('limit', 100))
+            with self.lock:
+                numbers = self.order[offset:offset + limit]
+                self.served.update(numbers)
+                if self.inserts:
+                    self.inserts -= 1
+                    self.order.insert(
+                        self.random.randint(0, len(self.order)),
+                        self.next_number)
+                    self.next_number += 1
+            return 200, {'help': 'Stub DKAN', 'success': True,
+                         'result': [self.dataset(n) for n in numbers]}
+        if action == 'package_list':
+            with self.lock:
+                numbers = list(self.order)
+            return 200, {'success': True,
+                         'result': ['dataset-%d' % n for n in numbers]}
+        if action in ('group_show', 'organization_show'):
+            name = params.get('id', '')
+            return 200, {'success': True,
+                         'result': {'id': name, 'name': name,
+                                    'title': name.replace('-', ' ').title(),
+                                    'description': '', 'packages': []}}
+        return 404, {'success': False, 'error': 'Not found'}
+
+
+class StubDKANHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # The harvester may ask for //api/... as it joins the source URL and
+        # the API path
+        path, _, query = self.path.partition('?')
+        path = '/' + path.lstrip('/')
+        action = path[len(ACTION_PATH):] if path.startswith(ACTION_PATH) \
+            else None
+        params = dict(urlparse.parse_qsl(query))
+        status, response = self.server.portal.handle(action, params)
+
+        body = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if self.server.gzip and \
+                'gzip' in (self.headers.get('accept-encoding') or ''):
+            buf = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubDKANServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, portal, gzip=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubDKANHandler)
+        self.portal = portal
+        self.gzip = gzip
+
+    def handle_error(self, request, client_address):
+        # The harvester closing its idle connections is not an error
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class _Record(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _Query(object):
+    '''Query that finds nothing, whatever the filters.'''
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def first(self):
+        return None
+
+    def scalar(self):
+        return None
+
+
+class StubCKAN(object):
+    '''In-memory replacement of what the harvester uses from CKAN.'''
+
+    def __init__(self):
+        self.objects = collections.OrderedDict()
+        self.pending = []
+        self.extras = []
+        self.packages = {}
+        self.groups = {}
+        self.organizations = {}
+        self.gather_errors = []
+        self.object_errors = []
+        self.commits = 0
+        self.lock = threading.Lock()
+
+    # model.Session
+
+    def add(self, obj):
+        self.pending.append(obj)
+
+    def commit(self):
+        for obj in self.pending:
+            if hasattr(obj, 'guid'):
+                self.objects[obj.id] = obj
+            else:
+                self.extras.append(obj)
+        self.pending = []
+        self.commits += 1
+
+    def rollback(self):
+        self.pending = []
+
+    def query(self, *args, **kwargs):
+        return _Query()
+
+    # Model classes
+
+    def harvest_object(self, id=None, guid=None, job=None, content=None):
+        return _Record(id=id, guid=guid, job=job, content=content,
+                       harvest_job_id=job.id, source=job.source,
+                       harvest_source_id=job.source.id, current=False,
+                       package_id=None, import_finished=None)
+
+    def harvest_object_extra(self, **kwargs):
+        extra = _Record(**kwargs)
+        extra.save = lambda: self.extras.append(extra)
+        return extra
+
+    # Actions
+
+    def get_action(self, name):
+        def action(context, data_dict):
+            with self.lock:
+                if name == 'package_show':
+                    return {'id': data_dict['id'], 'owner_org': 'local-org'}
+                store = self.groups if name.startswith('group_') \
+                    else self.organizations
+                if name.endswith('_show'):
+                    if data_dict['id'] not in store:
+                        raise NotFound()
+                    return store[data_dict['id']]
+                if name.endswith('_create'):
+                    if data_dict['id'] in store:
+                        raise ValidationError({'name': ['Already exists']})
+                    store[data_dict['id']] = data_dict
+                    return data_dict
+            raise NotImplementedError(name)
+        return action
+
+    # Harvester methods
+
+    def create_or_update_package(self, package_dict, harvest_object,
+                                 package_dict_form=None):
+        with self.lock:
+            self.packages[package_dict['id']] = package_dict
+        harvest_object.package_id = package_dict['id']
+        harvest_object.current = True
+        return True
+
+    def save_gather_error(self, message, job):
+        self.gather_errors.append(message)
+
+    def save_object_error(self, message, obj, stage=u'Fetch', line=None):
+        self.object_errors.append(message)
+
+    def patch(self, harvester):
+        '''Returns the patchers that plug the stub into ``harvester``.'''
+        model = mock.Mock()
+        model.Session.add.side_effect = self.add
+        model.Session.commit.side_effect = self.commit
+        model.Session.rollback.side_effect = self.rollback
+        model.Session.query.side_effect = self.query
+        return [
+            mock.patch.multiple(
+                dkanharvester, model=model,
+                HarvestObject=self.harvest_object,
+                HarvestObjectExtra=self.harvest_object_extra,
+                get_action=self.get_action,
+                toolkit=mock.Mock()),
+            mock.patch.multiple(
+                harvester,
+                last_error_free_job=lambda job: None,
+                _get_user_name=lambda: 'harvest',
+                _is_unchanged=lambda obj, fingerprint: False,
+                _is_job_imported=lambda obj: False,
+                _create_or_update_package=self.create_or_update_package,
+                _save_gather_error=self.save_gather_error,
+                _save_object_error=self.save_object_error,
+                create=True),
+        ]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_load_test(portal, config=None, do_import=True, gzip=False):
+    '''Harvests ``portal`` once and returns the figures of the run.'''
+    server = StubDKANServer(portal, gzip=gzip)
+    server.start()
+    ckan = StubCKAN()
+    harvester = DKANHarvester()
+    source = _Record(id='loadtest-source', url=server.url + '/',
+                     title='Load test', config=json.dumps(config or {}))
+    job = _Record(id='loadtest-job', source=source, source_id=source.id)
+
+    patchers = ckan.patch(harvester)
+    for patcher in patchers:
+        patcher.start()
+    try:
+        started = time.time()
+        object_ids = harvester.gather_stage(job) or []
+        gather_time = time.time() - started
+        gather_requests = sum(portal.requests.values())
+
+        imported = 0
+        started = time.time()
+        if do_import:
+            for object_id in object_ids:
+                if harvester.import_stage(ckan.objects[object_id]):
+                    imported += 1
+            # There is no call at the end of the import stage of a job
+            harvester._metrics.flush()
+        import_time = time.time() - started
+    finally:
+        for patcher in reversed(patchers):
+            patcher.stop()
+        harvester._get_http_client().close()
+        server.shutdown()
+        server.server_close()
+
+    guids = [ckan.objects[object_id].guid for object_id in object_ids]
+    remote_ids = portal.dataset_ids()
+    return {
+        'datasets': len(remote_ids),
+        'harvest_objects': len(object_ids),
+        'gather_seconds': round(gather_time, 2),
+        'gather_datasets_per_second': round(
+            len(object_ids) / max(gather_time, 1e-9), 1),
+        'gather_requests': gather_requests,
+        'import_seconds': round(import_time, 2),
+        'import_datasets_per_second': round(
+            imported / max(import_time, 1e-9), 1),
+        'imported': imported,
+        'requests': dict(portal.requests),
+        'server_errors': dict(portal.errors),
+        'served_twice': sum(1 for count in portal.served.values()
+                            if count > 1),
+        'duplicate_objects': len(guids) - len(set(guids)),
+        'missed': len(remote_ids - set(guids)),
+        'gather_errors': len(ckan.gather_errors),
+        'import_errors': len(ckan.object_errors),
+        'commits': ckan.commits,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--datasets', type=int, default=10000)
+    parser.add_argument('--resources', type=int, default=5,
+                        help='resources per dataset')
+    parser.add_argument('--payload-size', type=int, default=0,
+                        help='bytes of padding added to each dataset')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the server waits before responding')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests that get a 500 error')
+    parser.add_argument('--inserts', type=int, default=0,
+                        help='datasets inserted while paging, one per '
+                             'search request')
+    parser.add_argument('--gzip', action='store_true',
+                        help='compress the responses')
+    parser.add_argument('--config', default='{}',
+                        help='harvest source configuration (JSON)')
+    parser.add_argument('--no-import', action='store_true',
+                        help='only run the gather stage')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    portal = StubDKANPortal(
+        datasets=args.datasets, resources=args.resources,
+        payload_size=args.payload_size, latency=args.latency,
+        error_rate=args.error_rate, inserts=args.inserts, seed=args.seed)
+    results = run_load_test(portal, json.loads(args.config),
+                            do_import=not args.no_import, gzip=args.gzip)
+    print json.dumps(results, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,37 @@
+"""Tests for harvesters/archive.py."""
+import gzip
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.dkan.harvesters.archive import ResponseArchive
+
+
+def test_record_and_replay():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'responses.jsonl.gz')
+        archive = ResponseArchive(path, 'record')
+        archive.record('http://example.com/a', 0.5, body='{"first": 1}')
+        archive.record('http://example.com/b', 0.1, body='\xff\xfe')
+        archive.record('http://example.com/a', 2.0,
+                       error={'message': 'HTTP error: 503', 'status': 503})
+
+        # The archive can be read as a whole too
+        assert_equal(len(gzip.open(path).readlines()), 3)
+
+        archive = ResponseArchive(path, 'replay')
+        first = archive.replay('http://example.com/a')
+        assert_equal((first.elapsed, first.body, first.error),
+                     (0.5, '{"first": 1}', None))
+        assert_equal(archive.replay('http://example.com/b').body, '\xff\xfe')
+        # Requests to the same URL are replayed in order, then the last one
+        # is repeated
+        for i in range(2):
+            assert_equal(archive.replay('http://example.com/a').error,
+                         {'message': 'HTTP error: 503', 'status': 503})
+        assert_equal(archive.replay('http://example.com/c'), None)
+    finally:
+        shutil.rmtree(directory)
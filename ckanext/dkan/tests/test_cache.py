@@ -0,0 +1,57 @@
+"""Tests for harvesters/cache.py."""
+import time
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.dkan.harvesters.cache import LookupCache
+
+
+class _NotFound(Exception):
+    pass
+
+
+def test_lru():
+    cache = LookupCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # Using "a" makes "b" the least recently used
+    assert_equal(cache.get('a'), 1)
+    cache.set('c', 3)
+    assert_equal([cache.get(key) for key in 'abc'], [1, None, 3])
+    assert_equal((cache.hits, cache.misses), (3, 1))
+
+
+def test_ttl():
+    cache = LookupCache(ttl=0.01)
+    cache.set('a', 1)
+    assert_equal(cache.get('a'), 1)
+    time.sleep(0.02)
+    assert_equal(cache.get('a', 'expired'), 'expired')
+
+
+def test_get_or_load():
+    cache = LookupCache()
+    calls = []
+
+    def load():
+        calls.append(1)
+        return 'value'
+    assert_equal(cache.get_or_load('a', load), 'value')
+    assert_equal(cache.get_or_load('a', load), 'value')
+    assert_equal(len(calls), 1)
+
+
+def test_not_found_is_cached():
+    cache = LookupCache()
+    calls = []
+
+    def load():
+        calls.append(1)
+        raise _NotFound()
+    for i in range(2):
+        assert_raises(_NotFound, cache.get_or_load, 'a', load, _NotFound)
+    assert_equal(len(calls), 1)
+    assert_equal(cache.get('a'), LookupCache.MISSING)
+    # Until it is replaced
+    cache.set('a', 'created')
+    assert_equal(cache.get_or_load('a', load, _NotFound), 'created')
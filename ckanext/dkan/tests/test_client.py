@@ -0,0 +1,78 @@
+"""Tests for harvesters/client.py."""
+import BaseHTTPServer
+import gzip
+import SocketServer
+import StringIO
+import threading
+
+from ckanext.dkan.harvesters.client import HTTPClient
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    client_addresses = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        _Handler.client_addresses.add(self.client_address)
+        if self.path == '/moved':
+            self.send_response(302)
+            self.send_header('Location', '/page')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = 'content of %s' % self.path
+        compress = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if compress:
+            buf = StringIO.StringIO()
+            gzip_file = gzip.GzipFile(fileobj=buf, mode='w')
+            gzip_file.write(body)
+            gzip_file.close()
+            body = buf.getvalue()
+        self.send_response(200)
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestHTTPClient(object):
+
+    def setup(self):
+        _Handler.client_addresses = set()
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuses_connections_and_decompresses(self):
+        client = HTTPClient(timeout=5)
+        for i in range(3):
+            response = client.open(self.base_url + '/page?offset=%d' % i)
+            assert response.status == 200
+            assert response.read() == 'content of /page?offset=%d' % i
+        client.close()
+
+        assert len(_Handler.client_addresses) == 1
+
+    def test_follows_redirects(self):
+        client = HTTPClient(timeout=5)
+        response = client.open(self.base_url + '/moved')
+        body = response.read()
+        client.close()
+
+        assert response.status == 200
+        assert body == 'content of /page'
@@ -0,0 +1,42 @@
+"""Tests for harvesters/codec.py."""
+import json
+
+from nose.tools import assert_equal, assert_raises, assert_true
+
+from ckanext.dkan.harvesters.codec import (COMPRESSED_PREFIX, decode_content,
+                                           encode_content)
+
+PACKAGE = {
+    'id': 'abc',
+    'title': u'Presupuesto de egresos \xf1',
+    'resources': [{'url': 'http://example.com/%d.csv' % i, 'format': 'CSV'}
+                  for i in range(100)],
+}
+
+
+def test_plain_content_is_compact_json():
+    content = encode_content(PACKAGE)
+    assert_equal(json.loads(content), PACKAGE)
+    assert_true(', ' not in content and ': ' not in content)
+
+
+def test_compressed_round_trip():
+    content = encode_content(PACKAGE, compress=True)
+    assert_true(content.startswith(COMPRESSED_PREFIX))
+    assert_true(len(content) < len(json.dumps(PACKAGE)))
+    assert_equal(decode_content(content), PACKAGE)
+    assert_equal(decode_content(unicode(content)), PACKAGE)
+
+
+def test_small_content_is_not_compressed():
+    assert_equal(encode_content({'id': 'abc'}, compress=True),
+                 '{"id":"abc"}')
+
+
+def test_decodes_existing_json():
+    assert_equal(decode_content(json.dumps(PACKAGE)), PACKAGE)
+
+
+def test_invalid_content():
+    assert_raises(ValueError, decode_content, COMPRESSED_PREFIX + 'eJz')
+    assert_raises(ValueError, decode_content, 'not json')
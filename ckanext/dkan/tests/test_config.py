@@ -0,0 +1,38 @@
+"""Tests for harvesters/config.py."""
+import json
+
+from nose.tools import assert_equal, assert_true
+
+from ckanext.dkan.harvesters.config import HarvestConfig, get_harvest_config
+
+
+def test_from_dict():
+    harvest_config = HarvestConfig.from_dict({
+        'default_tags': [{'name': 'a'}, {'name': 'b'}],
+        'default_group_dicts': [{'id': 'group-id', 'name': 'group'}],
+        'default_extras': {'plain': 'value', 'template': '{dataset_id}',
+                           'number': 1},
+        'api_version': '2',
+    })
+    assert_equal(harvest_config.default_tag_names, frozenset(['a', 'b']))
+    assert_equal(harvest_config.default_group_ids, frozenset(['group-id']))
+    assert_equal(sorted(harvest_config.default_extras),
+                 [('number', 1, False), ('plain', 'value', False),
+                  ('template', '{dataset_id}', True)])
+    assert_equal(harvest_config.api_version, 2)
+    assert_equal(harvest_config.override_extras, False)
+    assert_equal(HarvestConfig.from_dict({}).default_tags, ())
+
+
+def test_get_harvest_config():
+    config_str = json.dumps({'default_tags': [{'name': 'a'}]})
+    harvest_config = get_harvest_config(config_str, 'source')
+    assert_equal(harvest_config.settings, {'default_tags': [{'name': 'a'}]})
+    # Parsed once per source and config
+    assert_true(get_harvest_config(config_str, 'source') is harvest_config)
+    assert_true(get_harvest_config(config_str, 'other') is not
+                harvest_config)
+    changed = get_harvest_config(json.dumps({}), 'source')
+    assert_equal(changed.default_tags, ())
+    assert_true(changed.digest != harvest_config.digest)
+    assert_equal(get_harvest_config(None).settings, {})
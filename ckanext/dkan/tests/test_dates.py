@@ -0,0 +1,37 @@
+"""Tests for harvesters/dates.py."""
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.dkan.harvesters.dates import (DateConverter, convert_date_fast,
+                                           convert_date_slow)
+
+SAMPLES = [
+    ('2016-10-01T12:00:00', False),
+    ('2016-10-01T12:00:00.123456', False),
+    ('Sat, 10/01/2016 - 12:00:00', False),
+    ('Sat, 1/2/2016 - 3:04:05', False),
+    ('Date changed\tSat, 10/01/2016 - 12:00:00', True),
+]
+
+
+def test_fast_path_matches_strptime():
+    for date, last_modified in SAMPLES:
+        assert_equal(convert_date_fast(date, last_modified),
+                     convert_date_slow(date, last_modified))
+
+
+def test_fast_path_leaves_odd_dates_to_strptime():
+    for date in ('2016-02-30T12:00:00', 'Sat, 13/01/2016 - 12:00:00',
+                 'Sat, 10/01/1850 - 12:00:00', '2016-10-01 12:00:00'):
+        assert_equal(convert_date_fast(date), None)
+
+
+def test_converter():
+    converter = DateConverter(max_cache_size=2)
+    for date, last_modified in SAMPLES * 2:
+        assert_equal(converter.convert(date, last_modified),
+                     convert_date_slow(date, last_modified))
+    assert_equal(converter.fallbacks, 0)
+
+    assert_raises(ValueError, converter.convert, 'yesterday')
+    assert_raises(ValueError, converter.convert, 'yesterday')
+    assert_equal(converter.fallbacks, 1)
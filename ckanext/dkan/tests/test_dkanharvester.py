@@ -0,0 +1,703 @@
+"""Tests for harvesters/dkanharvester.py."""
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import urlparse
+
+from nose.tools import assert_equal, assert_true
+
+from ckan.logic import NotFound, ValidationError
+
+from ckanext.dkan.harvesters import dkanharvester
+from ckanext.dkan.harvesters.config import get_harvest_config
+from ckanext.dkan.harvesters.dkanharvester import ContentFetchError, \
+    DKANHarvester, HarvestObject
+from ckanext.dkan.harvesters.fingerprint import content_fingerprint
+from ckanext.dkan.harvesters.metrics import Metrics
+
+
+class _Response(object):
+
+    def __init__(self, status, headers=None, body=''):
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def iter_content(self):
+        yield self.body
+
+    def read(self):
+        return self.body
+
+    def close(self):
+        pass
+
+
+class _Client(object):
+    '''Fake HTTP client answering with ``responses`` in turn.'''
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def open(self, url, headers=None):
+        self.requests.append((url, headers))
+        return self.responses.pop(0)
+
+
+class _Remote(object):
+    '''Fake remote DKAN search, returning at most ``max_page`` datasets per
+    page and timing out on pages bigger than ``timeout_above``.'''
+
+    def __init__(self, count, max_page=1000, timeout_above=None,
+                 modified=None):
+        self.ids = ['dataset-%03d' % i for i in range(count)]
+        # Modification date of each dataset, by id
+        self.modified = dict(zip(self.ids, modified or ()))
+        self.max_page = max_page
+        self.timeout_above = timeout_above
+        self.requests = []
+        # Called with the offset of each page before it is returned
+        self.on_page = None
+
+    def fetch_search_page(self, url):
+        query = dict(urlparse.parse_qsl(urlparse.urlsplit(url).query))
+        offset, limit = int(query['offset']), int(query['limit'])
+        self.requests.append((offset, limit))
+        if self.timeout_above and limit > self.timeout_above:
+            return None, None, None, ContentFetchError('timed out',
+                                                       timeout=True), 0.0
+        if self.on_page:
+            self.on_page(offset)
+        ids = self.ids[offset:offset + min(limit, self.max_page)]
+        digest = hashlib.sha1(' '.join(ids)).digest()
+        packages = []
+        for id_ in ids:
+            package = {'id': id_}
+            if id_ in self.modified:
+                package['metadata_modified'] = self.modified[id_]
+            packages.append(package)
+        return packages, digest, 100, None, 0.0
+
+
+def _search(remote, modified_since=None, rejections=None, **config):
+    harvester = DKANHarvester()
+    harvester.config = dict({'mapping': [{'require': ['id']}]}, **config)
+    harvester._mapping = None
+    harvester._rejections = rejections
+    harvester._metrics = Metrics()
+    harvester._fetch_search_page = remote.fetch_search_page
+    try:
+        return [package['id']
+                for page in harvester._search_for_datasets(
+                    'http://remote', modified_since=modified_since)
+                for package in page]
+    finally:
+        del harvester._fetch_search_page
+        del harvester._rejections
+
+
+def test_search_rejections():
+    # Only the first dataset has a modification date
+    remote = _Remote(3, modified=['2016-10-01T00:00:00'])
+    mapping = [{'require': ['metadata_modified']}]
+    rejections = []
+    assert_equal(_search(remote, rejections=rejections, mapping=mapping),
+                 ['dataset-000'])
+    assert_equal(len(rejections), 2)
+    # Outside of a gather stage they are not kept
+    assert_equal(_search(remote, mapping=mapping), ['dataset-000'])
+
+
+def test_search_remote_page_limit():
+    # The remote returns fewer datasets than asked for. The search moves on
+    # from where each short page ended, asking again for the pages of the
+    # batch after it, and is capped to 30 datasets per page once the next
+    # page shows that the short one was not the last.
+    remote = _Remote(100, max_page=30)
+    assert_equal(_search(remote, page_size=50), remote.ids)
+    assert_equal(remote.requests,
+                 [(0, 50), (30, 50), (60, 30), (90, 30), (100, 30)])
+
+    remote = _Remote(100, max_page=30)
+    assert_equal(_search(remote, page_size=50, gather_workers=3), remote.ids)
+    assert_equal(remote.requests[:6],
+                 [(0, 50), (50, 50), (100, 50), (30, 50), (80, 50),
+                  (130, 50)])
+    assert_equal(remote.requests[6:9], [(60, 30), (90, 30), (120, 30)])
+
+
+def test_search_shrinks_after_timeouts():
+    remote = _Remote(100, timeout_above=25)
+    ids = _search(remote, page_size=100, page_size_min=10,
+                  page_size_max=100)
+    assert_equal(ids, remote.ids)
+    # The failed page is asked for again from the same offset
+    assert_equal(remote.requests[:4],
+                 [(0, 100), (0, 50), (0, 25), (25, 25)])
+
+
+def test_search_skips_duplicates():
+    remote = _Remote(60)
+
+    def add_dataset(offset):
+        # A new dataset sorted first pushes the others one page down
+        if offset == 20:
+            remote.ids.insert(0, 'dataset-new')
+    remote.on_page = add_dataset
+    ids = _search(remote, page_size=20, page_size_max=20)
+    assert_equal(len(ids), len(set(ids)))
+    assert_equal(sorted(ids), sorted(remote.ids[1:]))
+
+
+def test_response_cache_not_modified():
+    directory = tempfile.mkdtemp()
+    harvester = DKANHarvester()
+    harvester.config = {'response_cache': {
+        'path': os.path.join(directory, 'cache.db')}}
+    harvester._metrics = Metrics()
+    harvester._http_client = _Client(
+        _Response(200, {'etag': '"v1"'}, '{"result": []}'),
+        _Response(304))
+    try:
+        url = 'http://remote/api/3/action/package_show?id=a'
+        assert_equal(harvester._get_content(url), '{"result": []}')
+        # The second time the cached body is revalidated, not downloaded
+        assert_equal(harvester._get_content(url), '{"result": []}')
+        assert_equal(harvester._http_client.requests[1][1],
+                     {'If-None-Match': '"v1"'})
+    finally:
+        harvester._http_client = None
+        shutil.rmtree(directory)
+
+
+def test_search_bounded_engine():
+    # Pages per round follow fetch_concurrency, not gather_workers
+    remote = _Remote(100)
+    ids = _search(remote, page_size=20, page_size_max=20,
+                  fetch_engine='bounded', fetch_concurrency=3)
+    assert_equal(ids, remote.ids)
+    assert_equal(sorted(remote.requests[:3]), [(0, 20), (20, 20), (40, 20)])
+
+
+def test_page_time_leaves_out_retries():
+    harvester = DKANHarvester()
+    harvester.config = {'retry_backoff': 0.3, 'max_retries': 1}
+    harvester._metrics = Metrics()
+    harvester._http_client = _Client(_Response(503),
+                                     _Response(200, body='{"result": []}'))
+    try:
+        pkg_dicts, digest, size, error, elapsed = \
+            harvester._fetch_search_page('http://retried/search')
+    finally:
+        harvester._http_client = None
+    assert_equal((pkg_dicts, error), ([], None))
+    # The page is not slow because of the backoff before the retry
+    assert elapsed < 0.1, elapsed
+
+
+def _dates(count, newest_first=True):
+    dates = ['2016-01-01T00:00:%02d' % i for i in range(count)]
+    return dates[::-1] if newest_first else dates
+
+
+def test_search_modified_since():
+    # Newest first, datasets 0 to 24 were modified since the cutoff
+    remote = _Remote(60, modified=_dates(60))
+    ids = _search(remote, modified_since=_dates(60)[24], page_size=10,
+                  page_size_max=10)
+    assert_equal(ids, remote.ids[:25])
+    # Paging stops at the first page with only older datasets
+    assert_equal(remote.requests, [(0, 10), (10, 10), (20, 10), (30, 10)])
+
+
+def test_search_modified_since_unsorted():
+    # Oldest first, so every page has to be checked
+    remote = _Remote(60, modified=_dates(60, newest_first=False))
+    ids = _search(remote, modified_since=_dates(60, False)[35],
+                  page_size=10, page_size_max=10)
+    assert_equal(ids, remote.ids[35:])
+    assert_equal(len(remote.requests), 7)
+
+
+class _Job(object):
+
+    def __init__(self, gather_started=None):
+        self.id = 'job'
+        self.source_id = 'source'
+        self.gather_started = gather_started
+        self.source = self
+        self.url = 'http://remote'
+
+
+def test_gather_without_high_water_mark():
+    harvester = DKANHarvester()
+    harvester.config = {}
+    searches = []
+
+    def search(base_url, fq_terms=None, modified_since=None):
+        searches.append(modified_since)
+        return iter([])
+
+    def gather(harvest_job, pages, package_ids, object_ids):
+        list(pages)
+        object_ids.append('object')
+
+    previous_job = _Job(datetime.datetime(2016, 10, 1))
+    harvester.last_error_free_job = lambda harvest_job: previous_job
+    harvester._search_for_datasets = search
+    harvester._gather_harvest_objects = gather
+    try:
+        for high_water_mark in (None, '2016-09-30T08:00:00'):
+            harvester._get_high_water_mark = \
+                lambda harvest_job, last_job: high_water_mark
+            assert_equal(harvester._gather_stage(_Job()), ['object'])
+    finally:
+        for name in ('last_error_free_job', '_search_for_datasets',
+                     '_gather_harvest_objects', '_get_high_water_mark'):
+            delattr(harvester, name)
+    # Without one, the datasets are not filtered by the time of the last
+    # job, which is not in the time zone of the remote
+    assert_equal(searches, [None, '2016-09-30T08:00:00'])
+
+
+
+class _GatherSession(object):
+    '''Fake session failing the commits numbered in ``failing``.'''
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.events = []
+
+    def add(self, obj):
+        if isinstance(obj, _GatherObject):
+            self.events.append(obj.guid)
+
+    def commit(self):
+        self.events.append('commit')
+        if self.events.count('commit') in self.failing:
+            raise Exception('deadlock')
+
+    def rollback(self):
+        self.events.append('rollback')
+
+
+class _GatherObject(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _gather_objects(count, failing=()):
+    harvester = DKANHarvester()
+    harvester.config = {'gather_batch_size': 2}
+    harvester._metrics = Metrics()
+    errors = []
+    harvester._save_gather_error = lambda message, job: errors.append(message)
+    session = _GatherSession(failing)
+    ids = iter(range(count))
+    pages = [[{'id': 'dataset-%d' % i, 'name': 'dataset-%d' % i}]
+             for i in range(count)]
+    package_ids = set()
+    object_ids = []
+    try:
+        with _patched(dkanharvester, HarvestObject=_GatherObject,
+                      HarvestObjectExtra=_GatherObject,
+                      make_uuid=lambda: 'object-%d' % next(ids),
+                      model=type('Model', (object,), {'Session': session})):
+            harvester._gather_harvest_objects('job', pages, package_ids,
+                                              object_ids)
+    finally:
+        del harvester._save_gather_error
+    return session.events, sorted(package_ids), object_ids, errors
+
+
+def test_gather_commits_in_batches():
+    events, package_ids, object_ids, errors = _gather_objects(5)
+    assert_equal(events, ['dataset-0', 'dataset-1', 'commit',
+                          'dataset-2', 'dataset-3', 'commit',
+                          'dataset-4', 'commit'])
+    assert_equal(object_ids, ['object-%d' % i for i in range(5)])
+    assert_equal(errors, [])
+
+
+def test_gather_batch_commit_fails():
+    events, package_ids, object_ids, errors = _gather_objects(5, failing=(2,))
+    assert_equal(events, ['dataset-0', 'dataset-1', 'commit',
+                          'dataset-2', 'dataset-3', 'commit', 'rollback',
+                          'dataset-4', 'commit'])
+    # Only the datasets of the failed batch are lost
+    assert_equal(object_ids, ['object-0', 'object-1', 'object-4'])
+    assert_equal(package_ids, ['dataset-0', 'dataset-1', 'dataset-4'])
+    assert_equal(len(errors), 1)
+    assert_true(errors[0].startswith('Unable to save harvest objects for '
+                                     '2 datasets'))
+
+@contextlib.contextmanager
+def _patched(obj, **values):
+    originals = dict((name, getattr(obj, name)) for name in values)
+    for name, value in values.items():
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(obj, name, value)
+
+
+class _Savepoint(object):
+
+    def __init__(self, events):
+        self.events = events
+
+    def commit(self):
+        self.events.append('release')
+
+    def rollback(self):
+        self.events.append('rollback to savepoint')
+
+
+class _BatchQuery(object):
+
+    def filter(self, *args):
+        return self
+
+    def limit(self, limit):
+        return self
+
+    def all(self):
+        return []
+
+
+class _BatchSession(object):
+
+    def __init__(self):
+        self.events = []
+
+    def begin_nested(self):
+        self.events.append('savepoint')
+        return _Savepoint(self.events)
+
+    def commit(self):
+        self.events.append('commit')
+
+    def rollback(self):
+        self.events.append('rollback')
+
+    def query(self, *args):
+        return _BatchQuery()
+
+    def execute(self, statement):
+        pass
+
+    def flush(self):
+        pass
+
+
+class _Search(object):
+
+    def __init__(self):
+        self.rebuilt = []
+
+    def rebuild(self, package_ids, defer_commit=False):
+        self.rebuilt.extend(package_ids)
+
+    def commit(self):
+        pass
+
+
+class _Object(object):
+
+    def __init__(self, id_, content):
+        self.id = self.guid = id_
+        self.content = content
+        self.harvest_job_id = 'job'
+        self.import_finished = None
+        self.package_id = None
+        self.current = None
+
+    def add(self):
+        pass
+
+
+def _package_create(context, package_dict):
+    if not package_dict.get('title'):
+        raise ValidationError({'title': ['Missing value']})
+    return package_dict
+
+
+def _import_batch(objects, existing):
+    harvester = DKANHarvester()
+    harvester.config = {}
+    harvester._metrics = Metrics()
+    harvester._import_stage = lambda obj: \
+        harvester._create_or_update_package_deferred(dict(obj.content), obj)
+
+    def find_existing_package(package_dict):
+        if package_dict['id'] not in existing:
+            raise NotFound()
+        return existing[package_dict['id']]
+
+    harvester._find_existing_package = find_existing_package
+    harvester._gen_new_name = lambda name: name
+    harvester._get_user_name = lambda: 'harvest'
+    session = _BatchSession()
+    search = _Search()
+    saved_errors = []
+    config = {}
+    try:
+        with _patched(dkanharvester,
+                      model=type('Model', (object,), {'Session': session}),
+                      toolkit=type('Toolkit', (object,), {'config': config}),
+                      search=search,
+                      get_action=lambda name: {
+                          'package_create': _package_create}[name],
+                      default_create_package_schema=dict), \
+                _patched(dkanharvester.HarvesterBase,
+                         _save_object_error=lambda self, message, *args:
+                         saved_errors.append((message, session.events[:]))):
+            imported = harvester.import_stage_batch(objects)
+    finally:
+        for name in ('_import_stage', '_find_existing_package',
+                     '_gen_new_name', '_get_user_name'):
+            delattr(harvester, name)
+    # Automatic indexing is left as it was
+    assert_equal(config, {})
+    return imported, session.events, search.rebuilt, saved_errors
+
+
+def test_import_stage_batch():
+    objects = [
+        _Object('new', {'id': 'new', 'name': 'new', 'title': 'New'}),
+        _Object('invalid', {'id': 'invalid', 'name': 'invalid'}),
+        _Object('unchanged', {'id': 'unchanged', 'title': 'Unchanged',
+                              'metadata_modified': '2016-10-01'}),
+    ]
+    existing = {'unchanged': {'name': 'unchanged',
+                              'metadata_modified': '2016-10-01'}}
+    imported, events, rebuilt, saved_errors = _import_batch(objects,
+                                                            existing)
+    assert_equal(imported, 2)
+    # The invalid dataset does not undo the others, which are committed at
+    # once, and only the created one needs to be indexed
+    assert_equal(events, ['savepoint', 'release',
+                          'savepoint', 'rollback to savepoint',
+                          'savepoint', 'release', 'commit'])
+    assert_equal(rebuilt, ['new'])
+    # The error is saved after the commit
+    assert_equal(len(saved_errors), 1)
+    assert_equal(saved_errors[0][1][-1], 'commit')
+    assert_equal([(obj.state, obj.report_status) for obj in objects],
+                 [('COMPLETE', 'added'), ('ERROR', 'errored'),
+                  ('COMPLETE', 'not modified')])
+
+
+def test_import_stage_already_imported():
+    harvester = DKANHarvester()
+    harvest_object = _Object('imported', {'id': 'imported'})
+    harvest_object.import_finished = datetime.datetime(2016, 10, 1)
+    harvester._import_stage = None
+    try:
+        # Objects imported in a batch are not imported again by the fetch
+        # consumer
+        assert_equal(harvester.import_stage(harvest_object), 'unchanged')
+    finally:
+        del harvester._import_stage
+
+
+class _Extra(object):
+    value = object()
+    harvest_object_id = object()
+    key = object()
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def save(self):
+        _FingerprintSession.instance.saved.append(self.__dict__)
+
+
+class _Package(object):
+    id = object()
+    metadata_modified = object()
+    state = object()
+
+
+class _FingerprintQuery(object):
+
+    def __init__(self, session, entity):
+        self.session = session
+        self.entity = entity
+
+    def join(self, *args):
+        return self
+
+    def filter(self, *args):
+        return self
+
+    def first(self):
+        if self.entity is _Extra.value:
+            return self.session.previous
+        if self.entity is HarvestObject.id:
+            # The object that imported the dataset last time
+            return ('previous-object',)
+        # The dataset does not exist yet
+        return None
+
+    def delete(self, synchronize_session):
+        self.session.deleted.append(self.entity)
+
+
+class _FingerprintSession(object):
+    instance = None
+
+    def __init__(self, previous):
+        self.previous = previous
+        self.saved = []
+        self.deleted = []
+        _FingerprintSession.instance = self
+
+    def query(self, *entities):
+        return _FingerprintQuery(self, entities[0])
+
+
+class _Source(object):
+    id = 'source'
+    url = 'http://remote'
+    title = 'Remote'
+    config = '{}'
+
+
+class _ImportJob(object):
+    id = 'fingerprint-job'
+    source = _Source()
+
+
+_PACKAGE = {'id': 'dataset', 'name': 'dataset', 'title': 'Dataset'}
+
+
+def _import_fingerprinted(previous, result):
+    harvest_object = _Object('object', json.dumps(_PACKAGE))
+    harvest_object.guid = 'dataset'
+    harvest_object.harvest_source_id = 'source'
+    harvest_object.harvest_job_id = 'fingerprint-job'
+    harvest_object.job = _ImportJob()
+    harvest_object.source = _Source()
+    harvester = DKANHarvester()
+    harvester._metrics = Metrics()
+    written = []
+    errors = []
+
+    def create_or_update_package(package_dict, harvest_object,
+                                 package_dict_form):
+        written.append(package_dict['id'])
+        if result is True:
+            harvest_object.current = True
+        return result
+
+    harvester._create_or_update_package = create_or_update_package
+    harvester._show_local = lambda context, action, id_: \
+        {'id': id_, 'owner_org': 'org'}
+    harvester._save_object_error = lambda message, *args: \
+        errors.append(message)
+    session = _FingerprintSession(previous)
+    try:
+        with _patched(dkanharvester, HarvestObjectExtra=_Extra,
+                      model=type('Model', (object,),
+                                 {'Session': session, 'Package': _Package})):
+            returned = harvester.import_stage(harvest_object)
+    finally:
+        for name in ('_create_or_update_package', '_show_local',
+                     '_save_object_error'):
+            delattr(harvester, name)
+    assert_equal(errors, [])
+    return returned, written, session
+
+
+def test_import_stage_skips_unchanged():
+    fingerprint = content_fingerprint(_PACKAGE,
+                                      get_harvest_config('{}').digest)
+    returned, written, session = _import_fingerprinted((fingerprint,), True)
+    assert_equal(returned, 'unchanged')
+    assert_equal(written, [])
+    assert_equal(session.saved, [])
+
+
+def test_import_stage_imports_changed():
+    returned, written, session = _import_fingerprinted(('changed',), True)
+    assert_equal(returned, True)
+    assert_equal(written, ['dataset'])
+    fingerprint = content_fingerprint(_PACKAGE,
+                                      get_harvest_config('{}').digest)
+    assert_equal(session.saved, [{'harvest_object_id': 'object',
+                                  'key': 'content_fingerprint',
+                                  'value': fingerprint}])
+    # Nor is it skipped without a previous fingerprint
+    returned, written, session = _import_fingerprinted(None, True)
+    assert_equal(written, ['dataset'])
+
+
+def test_import_stage_fingerprints_not_modified():
+    # The remote dataset was not modified, but its content changed, eg with
+    # a new source configuration
+    returned, written, session = _import_fingerprinted(('changed',),
+                                                       'unchanged')
+    assert_equal(returned, 'unchanged')
+    assert_equal(written, ['dataset'])
+    # The fingerprint is stored on the object that imported it instead
+    assert_equal(session.deleted, [_Extra])
+    assert_equal([extra['harvest_object_id'] for extra in session.saved],
+                 ['previous-object'])
+
+
+class _FlushedMetrics(object):
+
+    def __init__(self):
+        self.flushes = 0
+
+    def timing(self, name, seconds):
+        pass
+
+    def flush(self):
+        self.flushes += 1
+
+
+class _WaitingQuery(object):
+
+    def __init__(self, waiting):
+        self.waiting = waiting
+
+    def filter(self, *args):
+        return self
+
+    def first(self):
+        return self.waiting.pop(0) if self.waiting else None
+
+
+def test_import_stage_flushes_at_end_of_job():
+    harvester = DKANHarvester()
+    harvester.config = {'metrics_flush_every': 100}
+    harvester._metrics = metrics = _FlushedMetrics()
+    harvester._metrics_pending = 0
+    harvester._import_stage = lambda harvest_object: True
+    # Another object of the job is waiting to be imported after the first
+    waiting = [('object-2',)]
+    session = type('Session', (object,),
+                   {'query': lambda self, *args: _WaitingQuery(waiting)})()
+    try:
+        with _patched(dkanharvester,
+                      model=type('Model', (object,), {'Session': session})):
+            harvester.import_stage(_Object('object-1', '{}'))
+            assert_equal(metrics.flushes, 0)
+            harvester.import_stage(_Object('object-2', '{}'))
+            assert_equal(metrics.flushes, 1)
+    finally:
+        del harvester._import_stage
+        harvester._metrics = Metrics()
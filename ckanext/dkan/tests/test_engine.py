@@ -0,0 +1,56 @@
+"""Tests for harvesters/engine.py."""
+import threading
+import time
+
+from nose.tools import assert_equal, assert_true
+
+from ckanext.dkan.harvesters.engine import Deadline, ThreadEngine, \
+    get_engine
+
+
+def test_imap_in_order():
+    for engine in (ThreadEngine(1), ThreadEngine(4),
+                   get_engine('bounded', 4)):
+        try:
+            # The first items take the longest
+            results = engine.imap(
+                lambda i: time.sleep(0.01 * (5 - i)) or i * 2, range(5))
+            assert_equal(list(results), [0, 2, 4, 6, 8])
+        finally:
+            engine.close()
+
+
+def test_bounded_concurrency():
+    state = {'in_flight': 0, 'max': 0}
+    lock = threading.Lock()
+
+    def fetch(i):
+        with lock:
+            state['in_flight'] += 1
+            state['max'] = max(state['max'], state['in_flight'])
+        time.sleep(0.02)
+        with lock:
+            state['in_flight'] -= 1
+
+    engine = get_engine('bounded', 3)
+    assert_true(get_engine('bounded', 3) is engine)
+    # A search and lookups from other threads at the same time
+    threads = [threading.Thread(
+        target=lambda: list(engine.imap(fetch, range(6))))]
+    threads.extend(threading.Thread(target=engine.call, args=(fetch, i))
+                   for i in range(6))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(state['max'], 3)
+
+
+def test_deadline():
+    assert_equal(Deadline().remaining(), None)
+    assert_true(not Deadline().expired())
+    deadline = Deadline(0.01)
+    assert_true(0 < deadline.remaining() <= 0.01)
+    time.sleep(0.02)
+    assert_true(deadline.expired())
+    assert_equal(deadline.remaining(), 0)
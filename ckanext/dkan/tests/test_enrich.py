@@ -0,0 +1,52 @@
+"""Tests for harvesters/enrich.py."""
+from nose.tools import assert_equal
+
+from ckanext.dkan.harvesters.config import HarvestConfig
+from ckanext.dkan.harvesters.enrich import Enrichment, Template
+
+
+class _Source(object):
+    id = 'source-id'
+    url = 'http://example.com/'
+    title = 'Example'
+
+
+class _Job(object):
+    id = 'job-id'
+    source = _Source()
+
+
+def test_template():
+    job_values = {'harvest_source_id': 'source-id',
+                  'harvest_job_id': 'job-id'}
+    values = {'dataset_id': 'dataset', 'harvest_object_id': 'object',
+              'width': 12}
+    for template in ['{harvest_source_id}/{dataset_id}', 'no placeholders',
+                     '{dataset_id:>10}|{harvest_job_id!r}', '{{literal}}',
+                     '{harvest_source_id:>{width}}', '']:
+        assert_equal(Template(template, job_values).render(values),
+                     template.format(**dict(job_values, **values)))
+
+
+def test_enrichment():
+    harvest_config = HarvestConfig.from_dict({
+        'default_tags': [{'name': 'a'}, {'name': 'b'}],
+        'default_extras': {'source': '{harvest_source_url}/{dataset_id}',
+                           'kept': 'default'},
+        'override_extras': True,
+    })
+    enrichment = Enrichment(harvest_config, _Job())
+    package = {'id': 'dataset', 'tags': [{'name': 'b'}],
+               'extras': [{'key': 'source', 'value': 'remote'},
+                          {'key': 'other', 'value': 'remote'}]}
+    enrichment.add_tags(package)
+    enrichment.add_groups(package)
+    enrichment.add_extras(package, 'object')
+    assert_equal(package['tags'], [{'name': 'b'}, {'name': 'a'}])
+    assert 'groups' not in package
+    # Replaced extras go after the ones that are kept
+    extras = [(e['key'], e['value']) for e in package['extras']]
+    assert_equal(extras[0], ('other', 'remote'))
+    assert_equal(sorted(extras[1:]),
+                 [('kept', 'default'),
+                  ('source', 'http://example.com/dataset')])
@@ -0,0 +1,71 @@
+"""Tests for harvesters/governor.py."""
+import threading
+import time
+
+from nose.tools import assert_equal, assert_true
+
+from ckanext.dkan.harvesters.governor import (HostGovernor, backoff_delay,
+                                              parse_retry_after)
+
+
+def test_backoff_delay():
+    for attempt in range(6):
+        delay = backoff_delay(attempt, base=1.0, max_delay=10.0)
+        expected = min(10.0, 2 ** attempt)
+        assert_true(expected / 2 <= delay <= expected, (attempt, delay))
+    assert_equal(backoff_delay(0, retry_after=5), 5)
+    assert_equal(backoff_delay(0, max_delay=10.0, retry_after=3600), 10.0)
+
+
+def test_parse_retry_after():
+    assert_equal(parse_retry_after('120'), 120)
+    assert_equal(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+    assert_equal(parse_retry_after(None), None)
+    assert_equal(parse_retry_after('soon'), None)
+
+
+def test_max_in_flight():
+    governor = HostGovernor(max_in_flight=2)
+    state = {'in_flight': 0, 'max': 0}
+    lock = threading.Lock()
+
+    def request():
+        governor.acquire()
+        try:
+            with lock:
+                state['in_flight'] += 1
+                state['max'] = max(state['max'], state['in_flight'])
+            time.sleep(0.02)
+            with lock:
+                state['in_flight'] -= 1
+        finally:
+            governor.release()
+
+    threads = [threading.Thread(target=request) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(state['max'], 2)
+
+
+def test_rate_limit():
+    governor = HostGovernor(rate=50)
+    started = time.time()
+    for i in range(6):
+        governor.acquire()
+        governor.release()
+    # The first request goes straight away, the other five wait 20ms each
+    assert_true(time.time() - started >= 0.09)
+
+
+def test_budget():
+    budget = threading.Semaphore(1)
+    first, second = HostGovernor(budget=budget), HostGovernor(budget=budget)
+    first.acquire()
+    # The budget is used up, even if the host of the second has slots left
+    assert_true(not budget.acquire(False))
+    first.release()
+    second.acquire()
+    second.release()
+    assert_true(budget.acquire(False))
@@ -0,0 +1,74 @@
+"""Tests for harvesters/httpcache.py."""
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from nose.tools import assert_equal
+
+from ckanext.dkan.harvesters.httpcache import CachedResponse, \
+    ResponseCache, get_response_cache
+
+
+class _TempDir(object):
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp()
+        return self.path
+
+    def __exit__(self, *exc_info):
+        shutil.rmtree(self.path)
+
+
+def test_conditional_headers():
+    assert_equal(CachedResponse('url', '"v1"', 'Sat, 01 Oct 2016 12:00:00 '
+                                'GMT', 'body').conditional_headers(),
+                 {'If-None-Match': '"v1"',
+                  'If-Modified-Since': 'Sat, 01 Oct 2016 12:00:00 GMT'})
+    assert_equal(CachedResponse('url', None, None, 'body')
+                 .conditional_headers(), {})
+
+
+def test_get_and_set():
+    with _TempDir() as directory:
+        cache = ResponseCache(os.path.join(directory, 'cache.db'))
+        assert_equal(cache.get('http://example.com/a'), None)
+        cache.set('http://example.com/a', '"v1"', None, 'body')
+        cached = cache.get('http://example.com/a')
+        assert_equal((cached.etag, cached.last_modified, cached.body),
+                     ('"v1"', None, 'body'))
+
+
+def test_lru_eviction():
+    with _TempDir() as directory:
+        # Random bodies do not compress, so each one takes ~400 bytes
+        cache = ResponseCache(os.path.join(directory, 'cache.db'),
+                              max_size=1000)
+        cache.set('a', '"a"', None, os.urandom(400))
+        time.sleep(0.01)
+        cache.set('b', '"b"', None, os.urandom(400))
+        time.sleep(0.01)
+        # Using "a" makes "b" the least recently used
+        cache.get('a')
+        time.sleep(0.01)
+        cache.set('c', '"c"', None, os.urandom(400))
+        assert_equal([url for url in 'abc' if cache.get(url)], ['a', 'c'])
+        # Bodies bigger than the whole cache are not stored
+        cache.set('d', '"d"', None, os.urandom(2000))
+        assert_equal(cache.get('d'), None)
+
+
+def test_errors_are_ignored():
+    with _TempDir() as directory:
+        path = os.path.join(directory, 'cache.db')
+        cache = ResponseCache(path)
+        cache.set('a', '"a"', None, 'body')
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute('UPDATE response SET body = ?',
+                               (sqlite3.Binary('not compressed'),))
+        connection.close()
+        assert_equal(cache.get('a'), None)
+    # A cache that can not be opened is not used
+    assert_equal(get_response_cache('/nonexistent/cache.db', 1000), None)
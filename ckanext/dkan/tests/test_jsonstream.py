@@ -0,0 +1,44 @@
+"""Tests for harvesters/jsonstream.py."""
+import json
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.dkan.harvesters.jsonstream import iter_array_items
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_items_match_json_loads():
+    response = json.dumps({
+        'help': 'Return a list of datasets',
+        'success': True,
+        'result': [{'id': str(i), 'title': u'Conjunto \xf1 %d' % i,
+                    'resources': [{'size': i * 1.5}], 'private': False}
+                   for i in range(20)],
+        'count': 20,
+    })
+    expected = json.loads(response)['result']
+    for size in (1, 7, 64, len(response)):
+        assert_equal(list(iter_array_items(chunked(response, size))),
+                     expected)
+
+
+def test_nested_result():
+    response = '{"success": true, "result": [[{"id": "a"}, {"id": "b"}]]}'
+    assert_equal(list(iter_array_items(chunked(response, 3))),
+                 [{'id': 'a'}, {'id': 'b'}])
+
+
+def test_missing_and_empty_result():
+    assert_equal(list(iter_array_items(['{"success": false}'])), [])
+    assert_equal(list(iter_array_items(['{"result": []}'])), [])
+    assert_equal(list(iter_array_items(['{}'])), [])
+
+
+def test_invalid_json():
+    for response in ('null', '{"result": [{"id": "a"}', '<html></html>',
+                     '{"result": [1 2]}'):
+        assert_raises(ValueError, list,
+                      iter_array_items(chunked(response, 4)))
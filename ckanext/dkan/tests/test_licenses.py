@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Tests for harvesters/licenses.py."""
+from nose.tools import assert_equal
+
+from ckanext.dkan.harvesters import licenses
+from ckanext.dkan.harvesters.licenses import LicenseIndex, \
+    normalize_license_title
+
+
+class _License(object):
+
+    def __init__(self, id_, title):
+        self.id = id_
+        self.title = title
+
+
+class _Model(object):
+    '''Stands in for ckan.model, with a license register that can be
+    changed.'''
+
+    def __init__(self, *licenses_):
+        self.register = dict((license.id, license) for license in licenses_)
+        self.Package = self
+
+    def get_license_register(self):
+        return self.register
+
+
+def _with_register(*licenses_):
+    def decorator(test):
+        def wrapper():
+            model, licenses.model = licenses.model, _Model(*licenses_)
+            try:
+                test()
+            finally:
+                licenses.model = model
+        wrapper.__name__ = test.__name__
+        return wrapper
+    return decorator
+
+
+def test_normalize_license_title():
+    assert_equal(normalize_license_title('  Creative   Commons\tBY '),
+                 u'creative commons by')
+    assert_equal(normalize_license_title('Atribución'), u'atribución')
+
+
+@_with_register(_License('cc-by', 'Creative Commons Attribution'),
+                _License('odc-odbl', 'Open Data Commons Open Database '
+                                     'License (ODbL)'))
+def test_get_license_id():
+    index = LicenseIndex({'ODbL': 'Open Data Commons Open Database '
+                                  'License (ODbL)',
+                          'Unknown alias': 'no-such-license'})
+    assert_equal(index.get_license_id('creative commons  attribution'),
+                 'cc-by')
+    # Aliases point at license ids or titles
+    assert_equal(index.get_license_id(u'Creative Commons Atribución'),
+                 'cc-by')
+    assert_equal(index.get_license_id('odbl'), 'odc-odbl')
+    assert_equal(index.get_license_id('Unknown alias'), None)
+    assert_equal(index.get_license_id(None), None)
+
+
+@_with_register(_License('cc-by', 'Creative Commons Attribution'))
+def test_register_changes():
+    index = LicenseIndex()
+    assert_equal(index.get_license_id('Other License'), None)
+    licenses.model.register['other'] = _License('other', 'Other License')
+    assert_equal(index.get_license_id('Other License'), 'other')
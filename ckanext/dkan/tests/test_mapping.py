@@ -0,0 +1,76 @@
+"""Tests for harvesters/mapping.py."""
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.dkan.harvesters.dates import DateConverter
+from ckanext.dkan.harvesters.mapping import compile_spec, validate_spec
+from ckanext.dkan.harvesters.metrics import Metrics
+
+
+class _LicenseIndex(object):
+
+    def get_license_id(self, title):
+        return {'Creative Commons Attribution': 'cc-by'}.get(title)
+
+
+def _package(**fields):
+    package = {
+        'id': 'dataset', 'title': 'A Dataset', 'description': 'About it',
+        'license_title': 'Creative Commons Attribution',
+        'private': 'Publicado', 'state': 'Active', 'type': 'Dataset',
+        'metadata_modified': 'Sat, 10/01/2016 - 12:00:00',
+        'tags': [{'name': 'tag', 'vocabulary_id': 'vocabulary'}],
+        'resources': [{'name': 'Data', 'url': 'http://example.com/a.csv',
+                       'size': '12 KB', 'mimetype': 'text/csv',
+                       'revision_id': 'revision',
+                       'created': '2016-10-01T12:00:00',
+                       'last_modified':
+                           'Date changed\tSat, 10/01/2016 - 12:00:00'}]}
+    package.update(fields)
+    return package
+
+
+def _compile(spec=None):
+    return compile_spec(spec, _LicenseIndex(), DateConverter())
+
+
+def test_default_spec():
+    packages, rejections = _compile().apply([_package()])
+    assert_equal(rejections, [])
+    package = packages[0]
+    assert_equal((package['name'], package['notes'], package['license_id']),
+                 ('a-dataset', 'About it', 'cc-by'))
+    assert_equal((package['private'], package['state'], package['type']),
+                 (False, 'active', 'dataset'))
+    assert_equal(package['metadata_modified'], '2016-10-01T12:00:00.000000')
+    assert_equal(package['tags'], [{'name': 'tag', 'vocabulary_id': None}])
+    assert_equal(package['extras'], [])
+    resource = package['resources'][0]
+    assert_equal((resource['description'], resource['size'],
+                  resource['format']), ('Data', 12, 'CSV'))
+    assert 'revision_id' not in resource
+
+
+def test_rejections():
+    metrics = Metrics()
+    no_resources = _package(id='no-resources')
+    del no_resources['resources']
+    bad_size = _package(id='bad-size')
+    bad_size['resources'][0]['size'] = 'big'
+    packages, rejections = _compile().apply(
+        [_package(id='good'), no_resources, bad_size], metrics)
+    assert_equal([package['id'] for package in packages], ['good'])
+    assert_equal([(r.package_id, r.step, r.reason) for r in rejections],
+                 [('no-resources', 'require_3', 'Dataset has no resources'),
+                  ('bad-size', 'size',
+                   'Incorrect size file format in Resource Data: big')])
+    assert 'mapping.size' in metrics.summary()['timers']
+
+
+def test_custom_spec():
+    spec = ['default', {'copy': {'title': 'name'}}, {'drop': ['extras']}]
+    validate_spec(spec)
+    packages, rejections = _compile(spec).apply([_package(name='short')])
+    assert_equal(packages[0]['title'], 'short')
+    assert 'extras' not in packages[0]
+    assert_raises(ValueError, validate_spec, [{'rename': {'a': 'b'}}])
+    assert_raises(ValueError, validate_spec, {'copy': {'a': 'b'}})
@@ -0,0 +1,54 @@
+"""Tests for harvesters/metrics.py."""
+import json
+import os
+import shutil
+import socket
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.dkan.harvesters.metrics import FileSink, Metrics, StatsdSink
+
+
+def test_summary():
+    metrics = Metrics(job_id='job', stage='gather')
+    metrics.incr('pages')
+    metrics.incr('pages', 2)
+    metrics.timing('fetch', 0.5)
+    with metrics.timer('fetch'):
+        pass
+    summary = metrics.summary()
+    assert_equal(summary['counters'], {'pages': 3})
+    assert_equal(summary['timers']['fetch']['count'], 2)
+    assert_equal(summary['timers']['fetch']['max'], 0.5)
+    assert_equal((summary['job_id'], summary['stage']), ('job', 'gather'))
+
+
+def test_statsd_sink():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(5)
+    try:
+        sink = StatsdSink('127.0.0.1', server.getsockname()[1], 'dkan')
+        metrics = Metrics([sink])
+        metrics.incr('http.status.200')
+        metrics.timing('http.request', 0.25)
+        assert_equal(server.recv(1024), 'dkan.http.status.200:1|c')
+        assert_equal(server.recv(1024), 'dkan.http.request:250|ms')
+    finally:
+        server.close()
+
+
+def test_file_sink():
+    directory = tempfile.mkdtemp()
+    try:
+        metrics = Metrics([FileSink(directory)], job_id='job', stage='import')
+        metrics.incr('import.created')
+        metrics.flush()
+        metrics.incr('import.created')
+        metrics.flush()
+        assert_equal(os.listdir(directory), ['job-import.json'])
+        with open(os.path.join(directory, 'job-import.json')) as f:
+            assert_equal(json.load(f)['counters'], {'import.created': 2})
+    finally:
+        shutil.rmtree(directory)
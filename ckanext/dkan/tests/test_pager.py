@@ -0,0 +1,62 @@
+"""Tests for harvesters/pager.py."""
+from nose.tools import assert_equal, assert_false, assert_true
+
+from ckanext.dkan.harvesters.pager import AdaptivePager
+
+
+def test_record():
+    pager = AdaptivePager(page_size=100, min_size=10, max_size=400,
+                          target_seconds=10.0, max_bytes=1000)
+    # Fast and small full pages double the page size, up to the maximum
+    pager.record(100, 1.0, 100, 100)
+    assert_equal(pager.limit, 200)
+    pager.record(200, 1.0, 100, 200)
+    pager.record(400, 1.0, 100, 400)
+    assert_equal(pager.limit, 400)
+    # Short pages say nothing about bigger ones
+    pager = AdaptivePager(page_size=100)
+    pager.record(100, 0.1, 100, 20)
+    assert_equal(pager.limit, 100)
+    # Pages neither fast nor slow leave it as it is
+    pager.record(100, 6.0, 100, 100)
+    assert_equal(pager.limit, 100)
+
+
+def test_record_slow_or_big():
+    pager = AdaptivePager(page_size=100, min_size=10, target_seconds=10.0,
+                          max_bytes=1000)
+    # Several slow pages of the same size only halve it once
+    pager.record(100, 20.0, 100, 100)
+    pager.record(100, 20.0, 100, 100)
+    assert_equal(pager.limit, 50)
+    pager.record(50, 1.0, 5000, 50)
+    assert_equal(pager.limit, 25)
+    for i in range(5):
+        pager.record(pager.limit, 20.0, 100, pager.limit)
+    assert_equal(pager.limit, 10)
+
+
+def test_shrink():
+    pager = AdaptivePager(page_size=40, min_size=10, max_size=1000)
+    assert_true(pager.shrink())
+    assert_equal(pager.limit, 20)
+    # It does not grow back to the size that failed
+    pager.record(20, 0.1, 100, 20)
+    assert_equal(pager.limit, 20)
+    assert_true(pager.shrink())
+    assert_equal(pager.limit, 10)
+    assert_false(pager.shrink())
+    assert_equal(pager.limit, 10)
+
+
+def test_cap():
+    pager = AdaptivePager(page_size=100, min_size=10, max_size=1000)
+    pager.cap(30)
+    assert_equal((pager.limit, pager.max_size), (30, 30))
+    pager.record(30, 0.1, 100, 30)
+    assert_equal(pager.limit, 30)
+    # A bigger cap does not raise the maximum again
+    pager.cap(500)
+    assert_equal(pager.max_size, 30)
+    pager.cap(1)
+    assert_equal(pager.limit, 10)
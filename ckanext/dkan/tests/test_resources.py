@@ -0,0 +1,39 @@
+"""Tests for harvesters/resources.py."""
+from nose.tools import assert_equal
+
+from ckanext.dkan.harvesters.resources import diff_resources
+
+
+def _local(id_, url, **fields):
+    resource = {'id': id_, 'url': url, 'package_id': 'dataset',
+                'position': 0, 'revision_id': 'revision', 'format': 'CSV',
+                'size': 12, 'description': None}
+    resource.update(fields)
+    return resource
+
+
+def test_diff_resources():
+    local = [_local('same', 'http://example.com/same.csv'),
+             _local('changed', 'http://example.com/changed.csv'),
+             _local('local-id', 'http://example.com/moved.csv'),
+             _local('gone', 'http://example.com/gone.csv')]
+    remote = [
+        # Only differs in what CKAN sets and in how the values are written
+        {'id': 'same', 'url': 'http://example.com/same.csv ',
+         'format': 'CSV', 'size': '12', 'position': 3, 'url_type': None},
+        {'id': 'changed', 'url': 'http://example.com/changed.csv',
+         'format': 'XLS'},
+        # Matched by URL, the remote id is not the local one
+        {'id': 'remote-id', 'url': 'http://example.com/moved.csv',
+         'description': 'Moved'},
+        {'id': 'new', 'url': 'http://example.com/new.csv'},
+    ]
+    resources, counts = diff_resources(remote, local)
+    assert_equal(counts, {'unchanged': 1, 'updated': 2, 'added': 1,
+                          'removed': 1})
+    assert_equal([r['id'] for r in resources],
+                 ['same', 'changed', 'local-id', 'new'])
+    # Unchanged resources are saved as they are locally
+    assert_equal(resources[0]['url'], 'http://example.com/same.csv')
+    assert_equal(resources[0]['size'], 12)
+    assert_equal(resources[1]['format'], 'XLS')
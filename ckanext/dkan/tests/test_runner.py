@@ -0,0 +1,149 @@
+"""Tests for harvesters/runner.py."""
+import multiprocessing
+import time
+
+from nose.tools import assert_equal
+
+from ckanext.dkan.harvesters import runner
+from ckanext.dkan.harvesters.runner import GatherTask, gather_job, \
+    run_gathers
+
+_log = None
+
+
+def _init(log):
+    global _log
+    _log = log
+
+
+def _gather(task):
+    _log.append(('start', task.host))
+    time.sleep(0.1)
+    _log.append(('end', task.host))
+    if task.job_id == 'broken':
+        raise Exception('Gather failed')
+    return 10
+
+
+def test_priority():
+    new = GatherTask('new', 'source', 'http://new.example.com')
+    busy = GatherTask('busy', 'source', 'http://a.example.com',
+                      changed=100, seconds=60)
+    quiet = GatherTask('quiet', 'source', 'http://b.example.com',
+                       changed=0, seconds=60)
+    assert_equal(sorted([quiet, busy, new], key=lambda t: t.priority,
+                        reverse=True), [new, busy, quiet])
+
+
+def test_run_gathers_fair_share():
+    tasks = [GatherTask('a%d' % i, 'a', 'http://a.example.com/',
+                        changed=100, seconds=60) for i in range(4)]
+    tasks.append(GatherTask('broken', 'b', 'http://B.example.com/',
+                            changed=0, seconds=1))
+    log = multiprocessing.Manager().list()
+    results = run_gathers(tasks, _gather, workers=2, initializer=_init,
+                          initargs=(log,))
+    assert_equal(results, {'a0': 10, 'a1': 10, 'a2': 10, 'a3': 10,
+                           'broken': None})
+    # b.example.com has less priority, but gets one of the two workers
+    # before a.example.com can take both
+    starts = [host for event, host in log if event == 'start']
+    assert_equal(set(starts[:2]), set(['a.example.com', 'b.example.com']))
+
+
+class _Query(object):
+
+    def __init__(self, result):
+        self.result = result
+
+    def filter(self, *args):
+        return self
+
+    def first(self):
+        return self.result
+
+
+class _Session(object):
+
+    def __init__(self, gather_error):
+        self.gather_error = gather_error
+
+    def query(self, *args):
+        return _Query(self.gather_error)
+
+    def remove(self):
+        pass
+
+
+class _Publisher(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+
+    def close(self):
+        pass
+
+
+class _Harvester(object):
+
+    def __init__(self, result, config=None):
+        self.result = result
+        self.config = config
+
+    def info(self):
+        return {'name': 'dkan'}
+
+    def gather_stage(self, job):
+        return self.result
+
+
+class _Job(object):
+    id = 'job'
+    source = type('Source', (object,), {'type': 'dkan'})
+
+    @classmethod
+    def get(cls, job_id):
+        return cls()
+
+    def save(self):
+        pass
+
+
+def _gather_job(result, gather_error=None, config=None, publisher=None):
+    patched = {'HarvestJob': _Job,
+               'get_fetch_publisher': lambda: publisher or _Publisher(),
+               'PluginImplementations':
+               lambda i: [_Harvester(result, config)],
+               'model': type('Model', (object,),
+                             {'Session': _Session(gather_error)})}
+    originals = dict((name, getattr(runner, name)) for name in patched)
+    for name, value in patched.items():
+        setattr(runner, name, value)
+    try:
+        return gather_job(GatherTask('job', 'source', 'http://example.com'))
+    finally:
+        for name, value in originals.items():
+            setattr(runner, name, value)
+
+
+def test_gather_job():
+    assert_equal(_gather_job(['a', 'b']), 2)
+    # No datasets changed since the last harvest
+    assert_equal(_gather_job(None), 0)
+    # The gather stage saved an error, eg the remote could not be searched
+    assert_equal(_gather_job(None, gather_error=('error',)), None)
+
+
+def test_gather_job_batch_import():
+    publisher = _Publisher()
+    assert_equal(_gather_job(['a', 'b'], publisher=publisher), 2)
+    assert_equal(publisher.messages, [{'harvest_object_id': 'a'},
+                                      {'harvest_object_id': 'b'}])
+    # The objects are left to the import-batch command
+    publisher = _Publisher()
+    assert_equal(_gather_job(['a', 'b'], config={'batch_import': True},
+                             publisher=publisher), 2)
+    assert_equal(publisher.messages, [])
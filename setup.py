@@ -81,6 +81,9 @@ setup(
         [ckan.plugins]
         dkan_harvester=ckanext.dkan.harvesters.dkanharvester:DKANHarvester
         dkan=ckanext.dkan.plugin:DkanPlugin
+
+        [paste.paster_command]
+        dkan-harvester=ckanext.dkan.commands:DKANHarvesterCommand
     ''',
 
     # If you are changing from the default layout of your extension, you may